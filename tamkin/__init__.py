@@ -46,4 +46,6 @@ from tamkin.partf import *
 from tamkin.rotor import *
 from tamkin.timer import *
 from tamkin.pftools import *
+from tamkin.batch import *
 from tamkin.tunneling import *
+from tamkin.microcanonical import *
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+# TAMkin is a post-processing toolkit for normal mode analysis, thermochemistry
+# and reaction kinetics.
+# Copyright (C) 2008-2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, An Ghysels
+# <An.Ghysels@UGent.be> and Matthias Vandichel <Matthias.Vandichel@UGent.be>
+# Center for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all
+# rights reserved unless otherwise stated.
+#
+# This file is part of TAMkin.
+#
+# TAMkin is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# In addition to the regulations of the GNU General Public License,
+# publications and communications based in parts on this program or on
+# parts of this program are required to cite the following article:
+#
+# "TAMkin: A Versatile Package for Vibrational Analysis and Chemical Kinetics",
+# An Ghysels, Toon Verstraelen, Karen Hemelsoet, Michel Waroquier and Veronique
+# Van Speybroeck, Journal of Chemical Information and Modeling, 2010, 50,
+# 1736-1750W
+# http://dx.doi.org/10.1021/ci100099g
+#
+# TAMkin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+# --
+"""Parallel normal mode analysis of many molecules
+
+   The function :func:`run_nma_batch` carries out a series of independent
+   ``Molecule`` -> ``NMA`` -> ``PartFun`` pipelines on a pool of worker
+   processes or threads::
+
+     >>> from functools import partial
+     >>> jobs = [
+     ...     (partial(load_molecule_g03fchk, "reactant.fchk"), Full(), [ExtTrans(), ExtRot()]),
+     ...     (partial(load_molecule_g03fchk, "ts.fchk"), Full(), [ExtTrans(), ExtRot()]),
+     ... ]
+     >>> for index, pf in run_nma_batch(jobs, workers=2):
+     ...     print index, pf.free_energy(300)
+
+   The results are yielded as soon as they are available, i.e. not
+   necessarily in the order of the jobs.
+"""
+
+
+import copy
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from tamkin.data import Molecule
+from tamkin.nma import NMA, Full
+from tamkin.partf import PartFun
+
+
+__all__ = ["run_nma_batch"]
+
+
+# BLAS and LAPACK libraries whose number of threads can be changed at run time:
+# (part of the filename, getter function, setter function)
+_blas_thread_functions = [
+    ("openblas", "openblas_get_num_threads", "openblas_set_num_threads"),
+    ("mkl_rt", "MKL_Get_Max_Threads", "MKL_Set_Num_Threads"),
+]
+
+# attributes of an NMA object that are transferred from the worker processes
+_nma_fields = [
+    "freqs", "modes", "mass", "masses", "masses3", "numbers", "coordinates",
+    "inertia_tensor", "multiplicity", "symmetry_number", "periodic", "energy",
+    "zeros", "title", "chemical_formula", "partial",
+]
+
+
+def run_nma_batch(jobs, workers=None, backend="process", blas_threads=1, do_modes=True):
+    """Run the normal mode analysis of many molecules in parallel.
+
+       Argument:
+        | ``jobs`` -- a list of job specifications. Each job is a tuple
+                      ``(loader, treatment, terms)``, of which the last two
+                      items are optional. The loader is a function without
+                      arguments that returns a Molecule object, e.g.
+                      ``functools.partial(load_molecule_g03fchk, filename)``.
+                      A Molecule object may be given instead of a loader.
+                      The treatment is an instance of a Treatment subclass
+                      [default=Full()]. When the list of partition function
+                      terms is given (possibly empty), a PartFun object is
+                      constructed with a copy of these terms.
+
+       Optional arguments:
+        | ``workers`` -- the number of workers. [default=the number of CPUs
+                         divided by blas_threads]
+        | ``backend`` -- 'process' or 'thread'. [default='process']
+        | ``blas_threads`` -- the number of threads each worker may use in
+                              the BLAS and LAPACK routines. [default=1]
+        | ``do_modes`` -- When False, only the frequencies are computed.
+                          [default=True]
+
+       Returns a generator that yields tuples ``(index, result)`` as soon as
+       a job is completed, where index refers to the position in the list of
+       jobs and result is an NMA or a PartFun object. Use
+       ``dict(run_nma_batch(...))`` to wait for all results. An exception in
+       one of the jobs is raised in the caller and stops the whole batch.
+       Invalid arguments are reported immediately, before any job is started.
+
+       With the 'process' backend, a loader is called in the worker process,
+       such that the Hessian never has to be sent to the worker. Hence, the
+       loaders, treatments and terms must be picklable. A Molecule object given
+       instead of a loader is pickled with its dense Hessian, which is costly
+       for large systems. The results are sent back through binary (npz)
+       files in a temporary directory instead of pickles. The 'thread' backend
+       avoids all such transfers and is efficient because numpy releases the
+       GIL in LAPACK. The same treatment object may be used in several jobs.
+
+       The number of BLAS threads is set with the run-time functions of the
+       OpenBLAS or MKL library loaded by numpy, which are located through
+       /proc/self/maps. On other platforms and with other BLAS libraries,
+       blas_threads has no effect. With the 'thread' backend, the limit applies
+       to the whole process during the batch.
+    """
+    import multiprocessing
+
+    if backend not in ("process", "thread"):
+        raise ValueError("The backend must be 'process' or 'thread', got '%s'." % backend)
+    if blas_threads < 1:
+        raise ValueError("At least one BLAS thread per worker is required.")
+    jobs = [_normalize_job(job) for job in jobs]
+    if workers is None:
+        workers = max(1, multiprocessing.cpu_count()//blas_threads)
+    if workers < 1:
+        raise ValueError("At least one worker is required.")
+    return _iter_nma_batch(jobs, workers, backend, blas_threads, do_modes)
+
+
+def _iter_nma_batch(jobs, workers, backend, blas_threads, do_modes):
+    """Run the jobs of run_nma_batch and yield the results as they come in."""
+    import multiprocessing
+    import multiprocessing.pool
+
+    if backend == "process":
+        workdir = tempfile.mkdtemp(prefix="tamkin_batch_")
+        pool = multiprocessing.Pool(workers, _set_blas_threads, (blas_threads,))
+        old_threads = []
+    else:
+        workdir = None
+        pool = multiprocessing.pool.ThreadPool(workers)
+        old_threads = _set_blas_threads(blas_threads)
+    try:
+        tasks = [
+            (index, loader, treatment, do_modes, workdir)
+            for index, (loader, treatment, terms) in enumerate(jobs)
+        ]
+        for index, nma in pool.imap_unordered(_run_job, tasks):
+            if workdir is not None:
+                nma = _load_nma(nma)
+            terms = jobs[index][2]
+            if terms is None:
+                yield index, nma
+            else:
+                yield index, PartFun(nma, copy.deepcopy(terms))
+    finally:
+        pool.terminate()
+        pool.join()
+        if workdir is not None:
+            shutil.rmtree(workdir, ignore_errors=True)
+        for setter, num_threads in old_threads:
+            setter(num_threads)
+
+
+def _normalize_job(job):
+    """Return a job specification as a tuple (loader, treatment, terms)."""
+    if isinstance(job, Molecule) or callable(job):
+        job = (job,)
+    if len(job) == 0 or len(job) > 3:
+        raise TypeError("A job must be a tuple (loader, treatment, terms), of which the last two items are optional.")
+    loader, treatment, terms = tuple(job) + (None,)*(3 - len(job))
+    if not (isinstance(loader, Molecule) or callable(loader)):
+        raise TypeError("The first item of a job must be a Molecule or a function that returns a Molecule.")
+    if treatment is None:
+        treatment = Full()
+    return loader, treatment, terms
+
+
+def _get_blas_thread_functions():
+    """Return (getter, setter) pairs for the BLAS libraries loaded in this process.
+
+       Environment variables such as OPENBLAS_NUM_THREADS are only read when
+       the library is loaded, i.e. when numpy is imported. Hence, the number
+       of threads is changed with the functions of the loaded libraries
+       instead. An empty list is returned when /proc/self/maps is not
+       available.
+    """
+    import ctypes
+    try:
+        with open("/proc/self/maps") as f:
+            filenames = set(line.split()[-1] for line in f if "/" in line)
+    except IOError:
+        return []
+    result = []
+    for filename in sorted(filenames):
+        basename = os.path.basename(filename)
+        for part, getter_name, setter_name in _blas_thread_functions:
+            if basename.startswith("lib%s" % part):
+                try:
+                    lib = ctypes.CDLL(filename)
+                    result.append((getattr(lib, getter_name), getattr(lib, setter_name)))
+                except (OSError, AttributeError):
+                    pass
+    return result
+
+
+def _set_blas_threads(num_threads):
+    """Limit the number of threads of the BLAS and LAPACK routines.
+
+       Returns a list of pairs (setter, old_num_threads), which can be used to
+       restore the original settings.
+    """
+    result = []
+    for getter, setter in _get_blas_thread_functions():
+        result.append((setter, getter()))
+        setter(num_threads)
+    return result
+
+
+def _run_job(task):
+    """Load a molecule and perform its normal mode analysis in a worker.
+
+       When workdir is not None, the NMA is written to a file in that directory
+       and the filename is returned instead of the NMA object.
+    """
+    index, loader, treatment, do_modes, workdir = task
+    if isinstance(loader, Molecule):
+        molecule = loader
+    else:
+        molecule = loader()
+    nma = NMA(molecule, treatment, do_modes=do_modes)
+    if workdir is None:
+        return index, nma
+    filename = os.path.join(workdir, "nma_%i.npz" % index)
+    _dump_nma(nma, filename)
+    return index, filename
+
+
+def _dump_nma(nma, filename):
+    """Write the attributes of an NMA object to a binary npz file.
+
+       Attributes that are None are left out. The modes are stored as a plain
+       array, as in the checkpoint files of NMA.write_to_file.
+    """
+    arrays = {}
+    for key in _nma_fields:
+        value = getattr(nma, key, None)
+        if key == "zeros":
+            arrays[key] = np.array(value, int)
+        elif value is not None:
+            arrays[key] = np.asarray(value)
+    np.savez(filename, **arrays)
+
+
+def _load_nma(filename):
+    """Load an NMA object from an npz file written by _dump_nma and remove the file."""
+    # bypass the default constructor, as in NMA.read_from_file
+    nma = NMA.__new__(NMA)
+    with np.load(filename, allow_pickle=False) as arrays:
+        for key in _nma_fields:
+            if key in arrays.files:
+                value = arrays[key]
+                if value.ndim == 0:
+                    # scalars and strings
+                    value = value.item()
+                setattr(nma, key, value)
+            else:
+                setattr(nma, key, None)
+    os.remove(filename)
+    return nma
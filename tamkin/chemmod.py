@@ -39,7 +39,7 @@ import numpy as np, csv
 
 from molmod import boltzmann, kjmol, second, meter, mol, planck
 
-from tamkin.partf import PartFun
+from tamkin.partf import PartFun, Sensitivity
 
 
 __all__ = [
@@ -176,7 +176,7 @@ class BaseModel(object):
            contribution would be present.
 
            Argument:
-            | ``temp``  -- the temperature
+            | ``temp``  -- the temperature or an array of temperatures
         """
         return sum(pf.chemical_potential(temp)*st for pf, st in self._iter_pfs())
 
@@ -192,7 +192,7 @@ class BaseModel(object):
         """Compute the internal_heat difference between (+) products and (-) reactants.
 
            Argument:
-            | ``temp`` -- The temperature.
+            | ``temp`` -- The temperature or an array of temperatures.
         """
         return sum(pf.internal_heat(temp)*st for pf, st in self._iter_pfs())
 
@@ -200,7 +200,7 @@ class BaseModel(object):
         """Compute the equilibrium constant at the given temperature.
 
            Argument:
-            | ``temp`` -- The temperature.
+            | ``temp`` -- The temperature or an array of temperatures.
 
            Optional argument:
             | ``do_log`` -- When True, the logarithm of the equilibrium constant
@@ -213,6 +213,52 @@ class BaseModel(object):
         else:
             return np.exp(log_K)
 
+    def sensitivity(self, temp):
+        """Compute the first-order sensitivities of the reaction quantities.
+
+           Argument:
+            | ``temp`` -- The temperature or an array of temperatures.
+
+           Returns a :class:`tamkin.partf.Sensitivity` object with the
+           derivatives of the linear combinations (with the signed
+           stoichiometries) of the thermodynamic quantities of all partition
+           functions. For example, the method ``log`` of the result gives the
+           derivatives of the logarithm of the equilibrium constant and the
+           method ``free_energy`` gives the derivatives of the free energy
+           change.
+
+           The keys of the frequencies and the electronic energies are extended
+           with the partition function they belong to, e.g. ``("freq", pf,
+           3)``. The scaling factors are assumed to be shared by all partition
+           functions, i.e. their keys are not extended.
+        """
+        columns = []
+        for pf, st in self._iter_pfs():
+            sensitivity = pf.sensitivity(temp)
+            for key, column in zip(sensitivity.keys, sensitivity.derivs.swapaxes(0, 1)):
+                if key[0] not in ("freq_scaling", "zp_scaling"):
+                    key = (key[0], pf) + key[1:]
+                columns.append((key, st*column))
+        return Sensitivity.from_columns(temp, columns)
+
+    def equilibrium_constant_sensitivity(self, temp, do_log=False):
+        """Compute the derivatives of the equilibrium constant.
+
+           Argument:
+            | ``temp`` -- The temperature or an array of temperatures.
+
+           Optional argument:
+            | ``do_log`` -- When True, the derivatives of the logarithm of the
+                            equilibrium constant are returned. [default=False]
+
+           Returns an array whose first axis runs over the parameters, see
+           :meth:`sensitivity` for the keys of the parameters.
+        """
+        result = self.sensitivity(temp).log()
+        if not do_log:
+            result = result*self.equilibrium_constant(temp)
+        return result
+
     def write_table(self, temp, filename):
         """Write a CSV file with the principal energies to a file.
 
@@ -344,7 +390,7 @@ class BaseKineticModel(BaseModel):
         """Compute the rate constant of the reaction in this analysis
 
            Arguments:
-            | ``temp`` -- The temperature.
+            | ``temp`` -- The temperature or an array of temperatures.
 
            Optional argument:
             | ``do_log`` -- When True, the logarithm of the rate constant is
@@ -353,6 +399,25 @@ class BaseKineticModel(BaseModel):
         """
         raise NotImplementedError
 
+    def rate_constant_sensitivity(self, temp, do_log=False):
+        """Compute the derivatives of the rate constant.
+
+           Argument:
+            | ``temp`` -- The temperature or an array of temperatures.
+
+           Optional argument:
+            | ``do_log`` -- When True, the derivatives of the logarithm of the
+                            rate constant are returned. [default=False]
+
+           Returns an array whose first axis runs over the parameters, see
+           :meth:`BaseModel.sensitivity` for the keys of the parameters. The
+           tunneling correction, if any, is kept fixed.
+        """
+        result = self.sensitivity(temp).log()
+        if not do_log:
+            result = result*self.rate_constant(temp)
+        return result
+
 
 class KineticModel(BaseKineticModel):
     """A model for the rate constant of a single-step chemical reaction."""
@@ -39,7 +39,7 @@
    output with a standardized interface.
 """
 
-from tamkin.geom import transrot_basis
+from tamkin.geom import transrot_basis, low_rank_update, low_rank_project
 
 from molmod import Molecule as BaseMolecule, MolecularGraph, ReadOnly, \
     UnitCell, ReadOnlyAttribute
@@ -47,12 +47,40 @@ from molmod.periodic import periodic
 from molmod.graphs import cached
 
 import numpy as np
+import threading
 
 
 __all__ = ["Molecule", "BareNucleus", "Proton", "RotScan",
            "translate_pbc"]
 
 
+# guards the creation of the analysis contexts of molecules shared by threads
+_analysis_context_lock = threading.Lock()
+
+
+class _HessianAttribute(ReadOnlyAttribute):
+    """A read-only attribute for a dense or a sparse Hessian.
+
+       Dense Hessians are treated as in a conventional ReadOnlyAttribute.
+       Sparse Hessians must be scipy.sparse matrices with a floating point
+       dtype. CSR and BSR matrices are stored as such, other formats are
+       converted to CSR.
+    """
+
+    def __set__(self, instance, value, do_check=True):
+        if not hasattr(value, "tocsr"):
+            ReadOnlyAttribute.__set__(self, instance, value, do_check)
+            return
+        if value.format not in ("csr", "bsr"):
+            value = value.tocsr()
+        if not np.issubdtype(value.dtype, np.floating):
+            raise ValueError("The dtype of a sparse Hessian must be a subdtype "
+                "of float. Got %s." % value.dtype)
+        if do_check:
+            self.check_wrapper(instance, value)
+        setattr(instance, self.attribute_name, value)
+
+
 class Molecule(BaseMolecule):
     """A container for a Hessian computation output from QM or MM codes."""
 
@@ -69,14 +97,15 @@ class Molecule(BaseMolecule):
     energy = ReadOnlyAttribute(float, none=False)
     gradient = ReadOnlyAttribute(np.ndarray, none=False,
         check=check_gradient, npdim=2, npshape=(None, 3), npdtype=float)
-    hessian = ReadOnlyAttribute(np.ndarray, none=False,
+    hessian = _HessianAttribute(np.ndarray, none=False,
         check=check_hessian, npdim=2, npdtype=float)
     multiplicity = ReadOnlyAttribute(int)
     symmetry_number = ReadOnlyAttribute(int)
     periodic = ReadOnlyAttribute(bool)
     fixed = ReadOnlyAttribute(np.ndarray, npdim=1, npdtype=int)
+    hessian_skipped = ReadOnlyAttribute(np.ndarray, npdim=1, npdtype=int)
 
-    def __init__(self, numbers, coordinates, masses, energy, gradient, hessian, multiplicity=None, symmetry_number=None, periodic=False, title=None, graph=None, symbols=None, unit_cell=None, fixed=None):
+    def __init__(self, numbers, coordinates, masses, energy, gradient, hessian, multiplicity=None, symmetry_number=None, periodic=False, title=None, graph=None, symbols=None, unit_cell=None, fixed=None, hessian_skipped=None):
         """
            Arguments:
             | ``numbers`` -- The atom numbers (integer numpy array with shape N)
@@ -91,7 +120,9 @@ class Molecule(BaseMolecule):
             | ``hessian`` -- The hessian of the energy, i.e. the matrix with
                              second order derivatives towards Cartesian
                              coordinates, in atomic units (float numpy array
-                             with shape 3Nx3N)
+                             with shape 3Nx3N, or a scipy.sparse matrix with
+                             the same shape, preferably CSR or BSR with 3x3
+                             blocks)
             | ``multiplicity`` -- The spin multiplicity of the electronic system
 
            Optional arguments:
@@ -104,6 +135,11 @@ class Molecule(BaseMolecule):
             | ``symbols`` -- A list with atom symbols
             | ``unit_cell`` -- The unit cell vectors for periodic structures
             | ``fixed`` -- An array with indices of fixed atoms
+            | ``hessian_skipped`` -- An array with indices of atoms whose rows
+                                     and columns of the Hessian were not
+                                     loaded (and are zero). Such a molecule
+                                     can only be analyzed with a PHVA in which
+                                     (at least) these atoms are fixed.
         """
         BaseMolecule.__init__(self, numbers, coordinates, title, masses, graph, symbols, unit_cell)
         self.energy = energy
@@ -113,6 +149,24 @@ class Molecule(BaseMolecule):
         self.symmetry_number = symmetry_number
         self.periodic = periodic
         self.fixed = fixed
+        self.hessian_skipped = hessian_skipped
+
+    hessian_is_sparse = property(lambda self: hasattr(self.hessian, "tocsr"),
+        doc="True when the Hessian is a scipy.sparse matrix. (read-only attribute)")
+
+    def get_dense_hessian(self):
+        """Return the Hessian as a dense array, also when it is sparse."""
+        if self.hessian_is_sparse:
+            return self.hessian.toarray()
+        else:
+            return self.hessian
+
+    def _check_complete_hessian(self):
+        """Raise a ValueError when a part of the Hessian was not loaded."""
+        if self.hessian_skipped is not None:
+            raise ValueError("The Hessian blocks of atoms %s were not loaded. "
+                "This molecule can only be used for a PHVA with these atoms "
+                "fixed." % self.hessian_skipped.tolist())
 
     def get_external_basis_new(self, im_threshold=1.0):
         """Create a robust basis for small displacements in the external degrees of freedom.
@@ -183,6 +237,21 @@ class Molecule(BaseMolecule):
 
         return result
 
+    @cached
+    def analysis_context(self):
+        """Reusable intermediate results of normal mode analyses.
+
+           See :class:`tamkin.nma.AnalysisContext`.
+        """
+        from tamkin.nma import AnalysisContext
+        with _analysis_context_lock:
+            # another thread may have created the context in the meantime
+            context = self.__dict__.get("_cache_analysis_context")
+            if context is None:
+                context = AnalysisContext(self)
+                self._cache_analysis_context = context
+            return context
+
     @cached
     def masses3(self):
         """An array with the diagonal of the mass matrix in Cartesian coordinates.
@@ -219,7 +288,7 @@ class Molecule(BaseMolecule):
            overwritten.
         """
         selected = np.array(selected)
-        selected3 = np.array( sum( [[3*at, 3*at+1, 3*at+2] for at in selected] ,[]) )
+        selected3 = (3*selected.reshape((-1,1)) + np.arange(3)).ravel()
 
         # if the following are none, then use the attributes of the original molecule
         if energy is None: energy = self.energy
@@ -230,6 +299,16 @@ class Molecule(BaseMolecule):
             symbols = [self.symbols[at] for at in selected]
         if unit_cell is None:
             unit_cell = self.unit_cell
+        if self.hessian_is_sparse:
+            hessian = self.hessian.tocsr()[selected3,:][:,selected3]
+        else:
+            hessian = self.hessian[np.ix_(selected3, selected3)]
+        # the skipped atoms that are selected, in the new numbering
+        hessian_skipped = None
+        if self.hessian_skipped is not None:
+            hessian_skipped = np.in1d(selected, self.hessian_skipped).nonzero()[0]
+            if len(hessian_skipped) == 0:
+                hessian_skipped = None
 
         return Molecule(
             self.numbers[selected],
@@ -237,7 +316,7 @@ class Molecule(BaseMolecule):
             self.masses[selected],
             energy,
             self.gradient[selected,:],
-            self.hessian[selected3,:][:,selected3],
+            hessian,
             multiplicity,
             symmetry_number = symmetry_number,
             periodic = periodic,
@@ -245,6 +324,7 @@ class Molecule(BaseMolecule):
             graph = graph,
             symbols = symbols,
             unit_cell = unit_cell,
+            hessian_skipped = hessian_skipped,
         )
 
     def write_to_file(self, filename):
@@ -257,10 +337,13 @@ class Molecule(BaseMolecule):
         data = {}
         for key in "numbers", "coordinates", "masses", "energy", "gradient", \
                    "hessian", "multiplicity", "symmetry_number", "periodic", \
-                   "title", "symbols":
+                   "title", "symbols", "hessian_skipped":
             value = getattr(self, key, None)
             if value is not None:
                 data[key] = value
+        if self.hessian_is_sparse:
+            # the checkpoint format only supports dense arrays
+            data["hessian"] = self.get_dense_hessian()
         if self.graph is not None:
             data["edges"] = np.array([tuple(edge) for edge in self.graph.edges])
         if self.unit_cell is not None:
@@ -294,7 +377,7 @@ class Molecule(BaseMolecule):
         for mfield in mandatory_fields:
             constructor_args[mfield] = data[mfield]
         # take the optional arguments if present
-        opt_fields = ["multiplicity", "symmetry_number", "periodic", "title", "symbols"]
+        opt_fields = ["multiplicity", "symmetry_number", "periodic", "title", "symbols", "hessian_skipped"]
         for ofield in opt_fields:
             if ofield in data:
                 constructor_args[ofield] = data[ofield]
@@ -312,6 +395,7 @@ class Molecule(BaseMolecule):
         """Raise the eigenvalues of the global translations and rotations
         to a high value, such that their coupling with the internal vibrations
         becomes negligible, and they can easily be isolated from the vibrations."""
+        self._check_complete_hessian()
 
         # Construct basis for global translations and rotations
         D = self.external_basis.transpose() # mass-weighted
@@ -320,13 +404,12 @@ class Molecule(BaseMolecule):
         U, W, Vt = np.linalg.svd(D, full_matrices=False)
         rank = (abs(W) > abs(W[0])*svd_threshold).sum()
         D = U[:,:rank]
-        proj = np.dot(D,D.transpose())
-
-        proj1 = proj * (self.masses3.reshape((1,-1)))**(0.5)
-        proj2 = proj1* (self.masses3.reshape((-1,1)))**(0.5)
+        # The shift is the rank-k update shift*S.D.D^T.S, where S is the
+        # diagonal matrix with the square roots of the masses.
+        SD = D*np.sqrt(self.masses3).reshape((-1,1))
 
         # Add the shift to the Hessian. The gradient is not changed I guess TODO check this.
-        hessian = self.hessian + shift*proj2
+        hessian = low_rank_update(self.hessian, SD, SD, shift)
 
         # Use the attributes of the original molecule if they exist
         if hasattr(self,"title"): # check if attribute exists
@@ -361,6 +444,7 @@ class Molecule(BaseMolecule):
     def constrain_ext(self):
         """Project the global translational and rotational vectors
         out of the Hessian and the gradient and return a new Molecule instance."""
+        self._check_complete_hessian()
 
         # Construct projector
         D = self.external_basis.transpose() # mass-weighted
@@ -369,20 +453,17 @@ class Molecule(BaseMolecule):
         U, W, Vt = np.linalg.svd(D, full_matrices=False)
         rank = (abs(W) > abs(W[0])*svd_threshold).sum()
         D = U[:,:rank]
-        proj = np.dot(D,D.transpose())
-        #print np.sum((proj-np.dot(proj,proj))**2)
-
-        proj1 = proj * (self.masses3.reshape((1,-1)))**(0.5)
-        proj2 = proj1* (self.masses3.reshape((-1,1)))**(-0.5)
-        projL = np.identity(len(D)) - proj2.transpose()
-        projR = np.identity(len(D)) - proj2
-        # test
-        #print np.sum((projR-np.dot(projR,projR))**2)
-        #print np.sum((projL-np.dot(projL,projL))**2)
+        # The projectors are never formed explicitly. With S the diagonal
+        # matrix with the square roots of the masses, they are
+        # projR = I - A.B^T and projL = I - B.A^T, with A = S^-1.D and B = S.D.
+        sqrt_masses3 = np.sqrt(self.masses3).reshape((-1,1))
+        A = D/sqrt_masses3
+        B = D*sqrt_masses3
 
         # Project hessian and gradient
-        hessian = np.dot(np.dot(projL,self.hessian),projR)
-        gradient = np.dot(projL, self.gradient.reshape((-1,1))).reshape((-1,3))
+        hessian = low_rank_project(self.hessian, A, B)
+        gradient = self.gradient.ravel()
+        gradient = (gradient - np.dot(B, np.dot(A.transpose(), gradient))).reshape((-1,3))
 
         # Use the attributes of the original molecule if they exist
         if hasattr(self,"title"): # check if attribute exists
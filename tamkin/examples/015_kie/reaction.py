@@ -41,10 +41,7 @@ from molmod import * # for the units
 from molmod.isotopes import ame2003
 
 
-def create_kinetic_model(mol_react, mol_trans):
-    # Perform normal mode analysis on the three molecules
-    nma_react = NMA(mol_react, ConstrainExt())
-    nma_trans = NMA(mol_trans, ConstrainExt())
+def create_kinetic_model(nma_react, nma_trans):
     # Construct the two partition functions.
     pf_react = PartFun(nma_react, [ExtTrans(), ExtRot(1), Vibrations(classical=True, freq_scaling=0.9085)])
     pf_trans = PartFun(nma_trans, [ExtTrans(), ExtRot(1), Vibrations(classical=True, freq_scaling=0.9085)])
@@ -52,19 +49,24 @@ def create_kinetic_model(mol_react, mol_trans):
     return KineticModel([pf_react], pf_trans)
 
 
-old_mol_react = load_molecule_g03fchk("reactant.fchk")
-old_mol_trans = load_molecule_g03fchk("trans.fchk")
-old_km = create_kinetic_model(old_mol_react, old_mol_trans)
-print "Original rate constant at 303K =", old_km.rate_constant(303)/old_km.unit, old_km.unit_name
+mol_react = load_molecule_g03fchk("reactant.fchk")
+mol_trans = load_molecule_g03fchk("trans.fchk")
 
 # does not work:
-# mol_react1.masses[0] = 13*amu
+# mol_react.masses[0] = 13*amu
+
+# Perform the normal mode analysis of the original molecules and of the
+# isotopologues in which atom 20 is replaced by N15. Only the masses differ,
+# so the eigenvalue problems of all isotopologues of one molecule are solved
+# with one stacked call to numpy.linalg.eigh.
+isotopologues = [{}, {20: ame2003.masses[7][15]}]
+old_nma_react, new_nma_react = compute_isotopologues(mol_react, isotopologues, ConstrainExt())
+old_nma_trans, new_nma_trans = compute_isotopologues(mol_trans, isotopologues, ConstrainExt())
+
+old_km = create_kinetic_model(old_nma_react, old_nma_trans)
+print "Original rate constant at 303K =", old_km.rate_constant(303)/old_km.unit, old_km.unit_name
 
-new_masses = old_mol_react.masses.copy()
-new_masses[20] = ame2003.masses[7][15]
-new_mol_react = old_mol_react.copy_with(masses=new_masses)
-new_mol_trans = old_mol_trans.copy_with(masses=new_masses)
-new_km = create_kinetic_model(new_mol_react, new_mol_trans)
+new_km = create_kinetic_model(new_nma_react, new_nma_trans)
 print "New rate constant at 303K =", new_km.rate_constant(303)/new_km.unit, new_km.unit_name
 
 print "Ratio at 303K =", old_km.rate_constant(303)/new_km.rate_constant(303)
@@ -37,7 +37,9 @@
 import numpy as np
 
 
-__all__ = ["transrot_basis", "rank_linearity"]
+__all__ = [
+    "transrot_basis", "rank_linearity", "low_rank_update", "low_rank_project",
+]
 
 
 def transrot_basis(coordinates, rot=True):
@@ -111,3 +113,76 @@ def rank_linearity(coordinates, svd_threshold=1e-5, masses3=None):
     external_basis = Vt[:rank]
 
     return rank, external_basis
+
+
+def _to_dense_copy(matrix):
+    """Return a C-contiguous float copy of a dense or scipy.sparse matrix"""
+    if hasattr(matrix, "toarray"):
+        return np.ascontiguousarray(matrix.toarray(), dtype=float)
+    return np.array(matrix, dtype=float, order="C")
+
+
+def low_rank_update(matrix, left, right, alpha=1.0):
+    """Compute ``matrix + alpha*left.right^T`` without forming ``left.right^T``
+
+       Arguments:
+        | matrix  --  A square (N,N) numpy array or scipy.sparse matrix
+        | left  --  A (N,k) array
+        | right  --  A (N,k) array
+
+       Optional argument:
+        | alpha  --  Scale factor for the update [default=1.0]
+
+       The rank-k update is added in place to a dense copy of ``matrix`` with
+       a single BLAS gemm call, which costs O(N^2*k) operations. The result is
+       always a new dense array because a low-rank update fills in any sparse
+       matrix.
+    """
+    from scipy.linalg.blas import get_blas_funcs
+    result = _to_dense_copy(matrix)
+    left = np.asarray(left, dtype=float)
+    right = np.asarray(right, dtype=float)
+    if left.shape[1] == 0:
+        return result
+    gemm = get_blas_funcs("gemm", (result,))
+    # result is C-contiguous, so its transpose is a Fortran array that gemm can
+    # overwrite: result^T += alpha*right.left^T
+    gemm(alpha, right, left, beta=1.0, c=result.T, trans_b=True, overwrite_c=True)
+    return result
+
+
+def low_rank_project(matrix, a, b, left=True, right=True):
+    """Apply the rank-k projectors ``I - b.a^T`` and ``I - a.b^T`` to a matrix
+
+       Arguments:
+        | matrix  --  A square (N,N) numpy array or scipy.sparse matrix
+        | a, b  --  Two (N,k) arrays. When ``b^T.a`` is the identity, the
+                    factors are (oblique) projectors.
+
+       Optional arguments:
+        | left  --  Multiply with ``I - b.a^T`` from the left [default=True]
+        | right  --  Multiply with ``I - a.b^T`` from the right [default=True]
+
+       The dense NxN projectors are never constructed. Only products of the
+       matrix with the thin factors are computed, such that the whole
+       operation boils down to O(N^2*k) work: one or two sparse or dense
+       matrix products with the factors and one rank-k (or rank-2k) update.
+       The result is a new dense array.
+    """
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    if left and right:
+        # (I - b.a^T) M (I - a.b^T) = M - b.Z^T - (X - b.C).b^T
+        # with X = M.a, Z = M^T.a and C = a^T.M.a
+        x = matrix.dot(a)
+        z = matrix.transpose().dot(a)
+        c = np.dot(a.T, x)
+        return low_rank_update(
+            matrix, np.hstack([b, x - np.dot(b, c)]), np.hstack([z, b]), -1.0
+        )
+    elif left:
+        return low_rank_update(matrix, b, matrix.transpose().dot(a), -1.0)
+    elif right:
+        return low_rank_update(matrix, matrix.dot(a), b, -1.0)
+    else:
+        return _to_dense_copy(matrix)
@@ -95,7 +95,40 @@ def iter_floats_file(fn):
     f.close()
 
 
-def load_molecule_g03fchk(fn_freq, fn_ener=None, fn_vdw=None, energy=None, fn_punch=None):
+def _unpack_hessian(packed, natom, phva_fixed=None):
+    """Construct the Hessian from its packed lower triangle.
+
+       Arguments:
+         | ``packed`` -- the lower triangle of the Hessian, row by row
+         | ``natom`` -- the number of atoms
+
+       Optional argument:
+         | ``phva_fixed`` -- atoms whose rows and columns are left out. When
+                             given, a sparse Hessian is returned that only
+                             contains the block of the other atoms.
+    """
+    size = 3*natom
+    if phva_fixed is None:
+        hessian = np.zeros((size, size), float)
+        rows, cols = np.tril_indices(size)
+        hessian[rows, cols] = packed
+        hessian[cols, rows] = packed
+        return hessian
+    from scipy.sparse import csr_matrix
+    mask = np.ones(natom, bool)
+    mask[np.asarray(phva_fixed, int)] = False
+    free3 = (3*mask.nonzero()[0].reshape((-1,1)) + np.arange(3)).ravel()
+    # positions of the free block in the packed lower triangle
+    rows = np.maximum.outer(free3, free3)
+    cols = np.minimum.outer(free3, free3)
+    block = packed[rows*(rows+1)//2 + cols]
+    return csr_matrix(
+        (block.ravel(), (np.repeat(free3, len(free3)), np.tile(free3, len(free3)))),
+        shape=(size, size)
+    )
+
+
+def load_molecule_g03fchk(fn_freq, fn_ener=None, fn_vdw=None, energy=None, fn_punch=None, phva_fixed=None):
     """Load a molecule from Gaussian03 formatted checkpoint files.
 
        Arguments:
@@ -112,6 +145,13 @@ def load_molecule_g03fchk(fn_freq, fn_ener=None, fn_vdw=None, energy=None, fn_pu
          | ``punch`` -- A Gaussian derivatives punch file. When given, the
                         gradient and the Hessian are read from this file
                         instead.
+         | ``phva_fixed`` -- A list of atoms that will be fixed in a PHVA
+                             treatment. When given, the Hessian blocks of these
+                             atoms are not stored and the Hessian becomes a
+                             sparse matrix with only the block of the free
+                             atoms. Such a molecule is only suitable for PHVA
+                             with (at least) these fixed atoms. The atoms are
+                             stored in the hessian_skipped attribute.
     """
 
     fchk_freq = FCHKFile(fn_freq, ignore_errors=True, field_labels=[
@@ -139,19 +179,14 @@ def load_molecule_g03fchk(fn_freq, fn_ener=None, fn_vdw=None, energy=None, fn_pu
     elif fn_punch is None:
         gradient = fchk_freq.fields["Cartesian Gradient"].copy()
         gradient.shape = (natom, 3)
-        hessian = fchk_freq.get_hessian()
+        hessian = _unpack_hessian(
+            fchk_freq.fields["Cartesian Force Constants"], natom, phva_fixed)
     else:
-        gradient = np.zeros((natom, 3), float)
-        hessian = np.zeros((3*natom, 3*natom), float)
         iterator = iter_floats_file(fn_punch)
-        for i in xrange(natom):
-            for j in xrange(3):
-                gradient[i,j] = iterator.next()
-        for i in xrange(3*natom):
-            for j in xrange(i+1):
-                v = iterator.next()
-                hessian[i,j] = v
-                hessian[j,i] = v
+        gradient = np.fromiter(iterator, float, 3*natom)
+        gradient.shape = (natom, 3)
+        packed = np.fromiter(iterator, float, 3*natom*(3*natom+1)//2)
+        hessian = _unpack_hessian(packed, natom, phva_fixed)
 
     if "MicOpt" in fchk_freq.fields:
         fixed = (fchk_freq.fields["MicOpt"] == -2).nonzero()[0]
@@ -160,6 +195,9 @@ def load_molecule_g03fchk(fn_freq, fn_ener=None, fn_vdw=None, energy=None, fn_pu
     else:
         fixed = None
 
+    if phva_fixed is not None:
+        phva_fixed = np.unique(np.asarray(phva_fixed, int))
+
     return Molecule(
         fchk_freq.molecule.numbers,
         fchk_freq.molecule.coordinates,
@@ -172,6 +210,7 @@ def load_molecule_g03fchk(fn_freq, fn_ener=None, fn_vdw=None, energy=None, fn_pu
         False,
         title=fchk_freq.title,
         fixed=fixed,
+        hessian_skipped=phva_fixed,
     )
 
 
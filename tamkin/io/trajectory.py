@@ -137,7 +137,7 @@ def dump_modes_gaussian(filename, nma, selected=None):
 
     ### B) Select some modes
     if selected is not None:
-        modes = np.take(modes, selected, 1)  # modes in columns
+        modes = modes[:,selected]  # modes in columns
         freqs = freqs[selected]
         masses = masses[selected]
         numbers = numbers[selected]
@@ -146,7 +146,7 @@ def dump_modes_gaussian(filename, nma, selected=None):
     ### C) convert modes to the right convention
     masses3_sqrt1 = np.array(sum([[1/m,1/m,1/m] for m in np.sqrt(masses)],[]))
     nmode = modes.shape[1]
-    modes = modes.copy() # avoid modifying the given modes
+    modes = np.array(modes) # avoid modifying the given modes
     for imode in xrange(nmode):
         modes[:,imode] *= masses3_sqrt1
         modes[:,imode] /= np.linalg.norm(modes[:,imode])
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+# TAMkin is a post-processing toolkit for normal mode analysis, thermochemistry
+# and reaction kinetics.
+# Copyright (C) 2008-2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, An Ghysels
+# <An.Ghysels@UGent.be> and Matthias Vandichel <Matthias.Vandichel@UGent.be>
+# Center for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all
+# rights reserved unless otherwise stated.
+#
+# This file is part of TAMkin.
+#
+# TAMkin is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# In addition to the regulations of the GNU General Public License,
+# publications and communications based in parts on this program or on
+# parts of this program are required to cite the following article:
+#
+# "TAMkin: A Versatile Package for Vibrational Analysis and Chemical Kinetics",
+# An Ghysels, Toon Verstraelen, Karen Hemelsoet, Michel Waroquier and Veronique
+# Van Speybroeck, Journal of Chemical Information and Modeling, 2010, 50,
+# 1736-1750W
+# http://dx.doi.org/10.1021/ci100099g
+#
+# TAMkin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+# --
+"""Microcanonical density and sum of states for RRKM and master equations.
+
+   The density of states, rho(E), and the sum of states, N(E), are computed on
+   an equidistant energy grid. Harmonic modes are counted with the direct count
+   algorithm of Beyer and Swinehart. The energy levels of (hindered) rotors are
+   convolved in afterwards. Long convolutions are carried out with FFTs.
+
+   All energies are measured with respect to the zero-point level and are
+   given in atomic units. The main entry point is the class
+   :class:`DensityOfStates`.
+"""
+
+
+from molmod import boltzmann, planck
+
+import numpy as np
+
+from tamkin.partf import PartFun
+
+
+__all__ = [
+    "count_states_harmonic", "remove_states_harmonic", "convolve_counts",
+    "DensityOfStates",
+]
+
+
+def _mode_bins(freq, grain):
+    """Convert a frequency into a number of bins of the energy grid."""
+    bins = int(np.round(planck*freq/grain))
+    if bins <= 0:
+        raise ValueError("The energy grain is too coarse for a mode with frequency %s." % freq)
+    return bins
+
+
+def count_states_harmonic(counts, freqs, grain):
+    """Add harmonic oscillators to a state count with the Beyer-Swinehart algorithm.
+
+       Arguments:
+        | ``counts`` -- an array with the number of states in each energy bin.
+                        This array is modified in-place.
+        | ``freqs`` -- an array with the frequencies of the oscillators
+        | ``grain`` -- the width of the energy bins
+
+       The cost is proportional to the number of modes times the number of
+       bins. Each mode with a quantum of m bins corresponds to the recurrence
+       counts[i] += counts[i-m], which is computed as a cumulative sum over
+       the bins with the same index modulo m.
+    """
+    size = len(counts)
+    for freq in np.array(freqs, dtype=float, ndmin=1):
+        m = _mode_bins(freq, grain)
+        if m >= size:
+            continue
+        tmp = np.zeros(-(-size//m)*m)
+        tmp[:size] = counts
+        tmp = tmp.reshape(-1, m).cumsum(axis=0)
+        counts[:] = tmp.ravel()[:size]
+
+
+def remove_states_harmonic(counts, freqs, grain):
+    """Remove harmonic oscillators from a state count.
+
+       This is the exact inverse of :func:`count_states_harmonic`. It is used
+       to take out the harmonic modes that are replaced by hindered rotors.
+
+       Arguments:
+        | ``counts`` -- an array with the number of states in each energy bin.
+                        This array is modified in-place.
+        | ``freqs`` -- an array with the frequencies of the oscillators
+        | ``grain`` -- the width of the energy bins
+    """
+    for freq in np.array(freqs, dtype=float, ndmin=1):
+        m = _mode_bins(freq, grain)
+        if m >= len(counts):
+            continue
+        counts[m:] = counts[m:] - counts[:-m]
+
+
+def convolve_counts(counts, other, fft_threshold=4096):
+    """Convolve two state counts on the same energy grid.
+
+       Arguments:
+        | ``counts`` -- an array with the number of states in each energy bin
+        | ``other`` -- an array with the number of states of another,
+                       independent degree of freedom
+
+       Optional argument:
+        | ``fft_threshold`` -- when the number of non-zero elements in other
+                               exceeds this value, the convolution is
+                               computed with FFTs. [default=4096]
+
+       Returns an array with the same length as counts. With FFTs, the absolute
+       error is of the order of the machine precision times the largest count.
+    """
+    size = len(counts)
+    other = np.asarray(other, dtype=float)[:size]
+    nonzero = other.nonzero()[0]
+    if len(nonzero) > fft_threshold:
+        # zero padding to avoid cyclic wrap around
+        fft_size = 2**int(np.ceil(np.log2(2*size)))
+        result = np.fft.irfft(
+            np.fft.rfft(counts, fft_size)*np.fft.rfft(other, fft_size),
+            fft_size
+        )[:size]
+    else:
+        # sparse direct convolution, one shifted copy per non-zero element
+        result = np.zeros(size)
+        for i in nonzero:
+            result[i:] += other[i]*counts[:size-i]
+    return result
+
+
+class DensityOfStates(object):
+    """The vibrational-rotational density and sum of states of a molecule."""
+
+    def __init__(self, pf, grain, energy_max, fft_threshold=4096):
+        """
+           Arguments:
+            | ``pf`` -- a PartFun object
+            | ``grain`` -- the width of the energy bins
+            | ``energy_max`` -- the highest energy of the grid, measured from
+                                the zero-point level
+
+           Optional argument:
+            | ``fft_threshold`` -- see :func:`convolve_counts`
+
+           All positive frequencies of the vibrational contribution are
+           treated as quantum harmonic oscillators. For each Rotor in the
+           partition function, the harmonic mode with the cancel frequency is
+           removed and the energy levels of the rotor, divided by the
+           rotational symmetry number, are convolved in. The result is
+           multiplied by the electronic spin multiplicity. External rotation
+           and translation are not included.
+
+           Useful attributes:
+            | ``energies`` -- the energies of the grid points
+            | ``counts`` -- the number of states in each energy bin
+            | ``density`` -- the density of states, counts/grain
+            | ``sum_of_states`` -- the number of states with an energy below or
+                                   equal to each grid point
+        """
+        if not isinstance(pf, PartFun):
+            raise TypeError("The first argument must be a PartFun object.")
+        if grain <= 0:
+            raise ValueError("The energy grain must be strictly positive.")
+        if energy_max < 0:
+            raise ValueError("The maximum energy must be positive.")
+        self.pf = pf
+        self.grain = grain
+        self.energy_max = energy_max
+        num_bins = int(np.round(energy_max/grain)) + 1
+        self.energies = np.arange(num_bins)*grain
+
+        vib = pf.vibrational
+        counts = np.zeros(num_bins)
+        counts[0] = 1.0
+        count_states_harmonic(counts, vib.positive_freqs*vib.freq_scaling, grain)
+        for term in pf.terms:
+            # duck typing to recognize hindered and free rotors
+            if not (hasattr(term, "energy_levels") and hasattr(term, "cancel_freq")):
+                continue
+            remove_states_harmonic(counts, term.cancel_freq*term.freq_scaling, grain)
+            levels = np.asarray(term.energy_levels)
+            indexes = np.round((levels - levels.min())/grain).astype(int)
+            indexes = indexes[indexes < num_bins]
+            rotor_counts = np.bincount(indexes, minlength=num_bins)/float(term.rotsym)
+            counts = convolve_counts(counts, rotor_counts, fft_threshold)
+        counts *= pf.electronic.multiplicity
+
+        self.counts = counts
+        self.density = counts/grain
+        self.sum_of_states = counts.cumsum()
+
+    def log_partition(self, temp):
+        """The logarithm of the partition function computed from the state count.
+
+           Argument:
+            | ``temp`` -- the temperature
+
+           The energy zero is the zero-point level. This is mainly useful to
+           check the convergence with respect to the grain and the maximum
+           energy.
+        """
+        return np.log(np.dot(self.counts, np.exp(-self.energies/(boltzmann*temp))))
@@ -80,16 +80,24 @@ The second argument is an instance of a class that derives from the
 
 
 from tamkin.data import Molecule
-from tamkin.geom import transrot_basis, rank_linearity
+from tamkin.geom import transrot_basis, rank_linearity, low_rank_project
 from tamkin.io.internal import load_chk, dump_chk
 
+from molmod.graphs import cached
+
+from collections import OrderedDict, namedtuple
+import copy
+import threading
+
 import numpy as np
 
 
 __all__ = [
-    "NMA", "AtomDivision", "Transform", "MassMatrix", "Treatment",
+    "NMA", "AtomDivision", "Transform", "Modes", "MassMatrix", "AnalysisContext",
+    "Treatment", "TreatmentResult",
     "Full", "ConstrainExt", "PHVA", "VSA", "VSANoMass", "MBH",
     "Blocks","PHVA_MBH", "Constrain", "MBHConstrainExt",
+    "compute_isotopologues",
 ]
 
 
@@ -102,7 +110,7 @@ class NMA(object):
        reduced coordinates is determined by the treatment argument.
     """
 
-    def __init__(self, molecule, treatment=None, do_modes=True):
+    def __init__(self, molecule, treatment=None, do_modes=True, num_modes=None, freq_window=None):
         """
            Arguments:
             | ``molecule`` -- a molecule object obtained from a routine in
@@ -114,6 +122,20 @@ class NMA(object):
             | ``do_modes`` -- When False, only the frequencies are computed.
                               When True, also the normal modes are computed.
                               [default=True]
+            | ``num_modes`` -- When given, only this number of modes with the
+                               lowest eigenvalues is computed, i.e. the
+                               imaginary modes, the zero modes and the lowest
+                               real frequencies.
+            | ``freq_window`` -- When given, only the modes whose frequencies
+                                 lie in the interval (freq_min, freq_max) are
+                                 computed. Imaginary frequencies are negative.
+
+           The options num_modes and freq_window are mutually exclusive. For
+           large systems, the partial spectrum is computed with a shift-invert
+           Lanczos method (scipy.sparse.linalg.eigsh), which avoids the full
+           diagonalization of the reduced Hessian. Such a partial NMA is fine
+           for the inspection of (collective) modes, but it can not be used to
+           construct a partition function.
 
            Referenced attributes of molecule:
               ``mass``, ``masses``, ``masses3``, ``numbers``, ``coordinates``,
@@ -122,29 +144,39 @@ class NMA(object):
 
            Extra attributes:
             | ``freqs`` -- array of frequencies
-            | ``modes`` -- array of mass-weighted Cartesian modes (if do_modes
-                           is True). Each column corresponds to one mode. One
-                           has to divide a column the square root of the masses3
+            | ``modes`` -- mass-weighted Cartesian modes (if do_modes is True),
+                           a :class:`Modes` object that behaves like a 2D
+                           array. Each column corresponds to one mode. The
+                           columns are only back-transformed to Cartesian
+                           coordinates when they are accessed. One has to
+                           divide a column the square root of the masses3
                            attribute to obtain the mode in non-mass-weighted
                            coordinates.
             | ``zeros`` -- list of indices of zero frequencies
+            | ``partial`` -- True when only a part of the spectrum is computed
 
         """
         if treatment == None:
             treatment = Full()
-
-        # the treatment object will store the results as attributes
-        treatment(molecule, do_modes)
-        # treatment.hessian_small:
+        if num_modes is not None and freq_window is not None:
+            raise ValueError("The options num_modes and freq_window can not be combined.")
+        if num_modes is not None and num_modes <= 0:
+            raise ValueError("The number of modes must be strictly positive.")
+        if freq_window is not None and freq_window[0] >= freq_window[1]:
+            raise ValueError("The frequency window must be an interval (freq_min, freq_max) with freq_min < freq_max.")
+        self.partial = num_modes is not None or freq_window is not None
+
+        # the treatment returns its results as a TreatmentResult object:
+        # result.hessian_small:
         #    the Hessian in reduced coordinates
-        # treatment.mass_matrix_small:
+        # result.mass_matrix_small:
         #    the mass matrix in reduced coordinates (see MassMatrix class)
-        # treatment.transform: (None if do_modes=False)
+        # result.transform: (None if do_modes=False)
         #    the transformation from small displacements in reduced coordinates
         #    to small displacements in Cartesian coordinates. (see Transform class)
-        # treatment.num_zeros:
+        # result.num_zeros:
         #    the number of zero eigenvalues to expect
-        # treatment.external_basis: (None if do_modes=False)
+        # result.external_basis: (None if do_modes=False)
         #    the basis of external degrees of freedom. number of basis vectors
         #    matches the number of zeros.
         #
@@ -152,63 +184,94 @@ class NMA(object):
         # a mass-weighted small Hessian immediately. In such cases, the
         # transform is also readily mass-weighted and mass_matrix_small is
         # None.
-
-        # the conventional frequency computation in the reduced coordinates
-        if treatment.mass_matrix_small is None:
-            hessian_small_mw = treatment.hessian_small
+        #
+        # The transform and the external basis are also requested when
+        # do_modes is False and the full spectrum is computed, because they are
+        # needed to identify the zero modes. Without modes, the zeros of a
+        # partial spectrum only follow from the frequencies.
+        result = treatment(molecule, do_modes or not self.partial)
+
+        get_modes = None
+        generalized = False
+        if self.partial:
+            hessian_small_mw = _get_hessian_small_mw(result)
+            # only keep a reference to the reduced Hessian in a local variable,
+            # such that it can be released early to save memory.
+            result = result._replace(hessian_small=None)
+            transform = _get_modes_transform(result)
+            small_basis = _get_small_external_basis(result, transform, molecule.masses3)
+            if np.product(hessian_small_mw.shape) == 0:
+                evals, modes_small = np.zeros(0), None
+            else:
+                evals, modes_small = _partial_eigh(
+                    hessian_small_mw, num_modes, freq_window, do_modes)
+            del hessian_small_mw
         else:
-            hessian_small_mw = treatment.mass_matrix_small.get_weighted_hessian(treatment.hessian_small)
-        del treatment.hessian_small # save memory
-
-        if hessian_small_mw.size == 0:
+            problem = _get_reduced_problem(result, molecule.masses3, do_modes)
+            del result
+            evals, modes_small, get_modes, small_basis = _solve_reduced_problem(problem, do_modes)
+            result, transform, generalized = problem.result, problem.transform, problem.generalized
+            del problem
+        self._init_spectrum(molecule, result, evals, modes_small, do_modes,
+                            freq_window, transform, small_basis, get_modes,
+                            generalized)
+        self._init_molecule_attributes(molecule)
+
+    def _init_spectrum(self, molecule, result, evals, modes_small_mw, do_modes, freq_window=None,
+                       transform=None, small_basis=None, get_modes=None, generalized=False):
+        """Derive the frequencies, modes and zeros from the eigenvalues and
+           eigenvectors of the mass-weighted reduced Hessian.
+
+           The argument result is the TreatmentResult of the treatment. It is
+           not modified. The optional arguments transform and small_basis are
+           the results of _get_modes_transform and _get_small_external_basis.
+           They are computed here when not given. The optional argument
+           get_modes is the function returned by _eigvalsh_selectable, which
+           is used to identify the zeros when do_modes is False. In that case,
+           small_basis must be the basis returned by _eigvalsh_selectable.
+
+           When generalized is True, the eigenvectors are the solutions of the
+           generalized eigenvalue problem in the reduced coordinates, i.e.
+           they are not mass-weighted.
+        """
+        if len(evals) == 0:
             self.freqs = np.array([])
             self.modes = np.array([])
             self.zeros = []
+            return
+
+        # frequencies
+        self.freqs = np.sqrt(abs(evals))/(2*np.pi)
+        # turn imaginary frequencies into negative frequencies
+        self.freqs *= (evals > 0)*2-1
+
+        if transform is None:
+            transform = _get_modes_transform(result, generalized)
+        if small_basis is None:
+            small_basis = _get_small_external_basis(result, transform, molecule.masses3)
+
+        if do_modes:
+            # the modes are transformed to weighted Cartesian coordinates when
+            # they are accessed.
+            self.modes = Modes(modes_small_mw, transform, molecule.masses3, generalized)
         else:
-            if do_modes:
-                evals, modes_small_mw = np.linalg.eigh(hessian_small_mw)
-            else:
-                evals = np.linalg.eigvalsh(hessian_small_mw)
-                modes_small_mw = None
-
-            # frequencies
-            self.freqs = np.sqrt(abs(evals))/(2*np.pi)
-            # turn imaginary frequencies into negative frequencies
-            self.freqs *= (evals > 0)*2-1
-
-            if do_modes:
-                # At this point the transform object transforms unweighted reduced
-                # coordinates into Cartesian coordinates. Now we will alter it, so that
-                # it transforms from weighted reduced coordinates to Cartesian
-                # coordinates.
-                if treatment.mass_matrix_small is not None:
-                    treatment.transform.make_weighted(treatment.mass_matrix_small)
-                # transform the modes to unweighted Cartesian coordinates.
-                self.modes = treatment.transform(modes_small_mw)
-                # transform the modes to weighted Cartesian coordinates.
-                self.modes *= molecule.masses3.reshape((-1,1))**0.5
-            else:
-                self.modes = None
+            self.modes = None
 
-            # guess which modes correspond to the zero frequencies
-            if treatment.num_zeros == 0:
-                # don't bother
-                self.zeros = []
-            else:
-                if do_modes:
-                    # take the 20 lowest modes and compute the overlap with the
-                    # external basis
-                    num_try = 20
-                    to_try = abs(self.freqs).argsort()[:num_try]   #indices of lowest 20 modes
-                    overlaps = np.zeros(num_try, float)
-                    for counter, i in enumerate(to_try):
-                        components = np.dot(treatment.external_basis, self.modes[:,i])
-                        overlaps[counter] = np.linalg.norm(components)
-                    self.zeros = to_try[overlaps.argsort()[-treatment.num_zeros:]]
-                else:
-                    self.zeros = abs(self.freqs).argsort()[:treatment.num_zeros]
-
-        # a few more attributes that are worth keeping
+        # identify the modes that correspond to the zero frequencies. This is
+        # done in the reduced coordinates, without Cartesian modes.
+        if result.num_zeros == 0 or len(self.freqs) == 0:
+            # don't bother
+            self.zeros = []
+        elif self.partial:
+            self.zeros = _find_partial_zeros(
+                self.freqs, modes_small_mw, small_basis, result.num_zeros,
+                freq_window)
+        else:
+            self.zeros = _find_zeros(
+                evals, small_basis, result.num_zeros, modes_small_mw, get_modes)
+
+    def _init_molecule_attributes(self, molecule):
+        """Copy a few attributes of the molecule that are worth keeping."""
         self.mass = molecule.mass
         self.masses = molecule.masses
         self.masses3 = molecule.masses3
@@ -247,6 +310,9 @@ class NMA(object):
                 "chemical_formula",
             ]
             data = dict((key, self.__dict__[key]) for key in keys)
+        if isinstance(data.get("modes"), Modes):
+            # checkpoint files contain plain arrays
+            data["modes"] = data["modes"].to_array()
         dump_chk(filename, data)
 
     @classmethod
@@ -270,6 +336,7 @@ class NMA(object):
             "freqs", "modes", "mass", "masses", "masses3", "numbers",
             "coordinates", "inertia_tensor", "multiplicity", "symmetry_number",
             "periodic", "energy", "zeros", "title", "chemical_formula",
+            "partial",
         ])
         if not set(data.iterkeys()).issubset(possible_fields):
             raise IOError("The Checkpoint file does not contain the correct fields.")
@@ -278,6 +345,692 @@ class NMA(object):
         return result
 
 
+def compute_isotopologues(molecule, isotopologues, treatment=None, do_modes=True, memory_budget=256*1024**2):
+    """Perform the normal mode analysis of a series of isotopologues.
+
+       Arguments:
+        | ``molecule`` -- a molecule object obtained from a routine in
+                          :mod:`tamkin.io`
+        | ``isotopologues`` -- a list of isotopic substitutions. Each item is
+                               either an array with the masses of all atoms or
+                               a dictionary {atom_index: mass} with only the
+                               masses that differ from those in molecule.
+
+       Optional arguments:
+        | ``treatment`` -- an instance of a Treatment subclass
+                           [default=Full()]
+        | ``do_modes`` -- When False, only the frequencies are computed.
+                          [default=True]
+        | ``memory_budget`` -- The maximum size (in bytes) of the stacked
+                               eigenvalue problems, including the eigenvectors
+                               and the temporary copies. [default=256MB]
+
+       Returns: a list of NMA objects, one for each isotopologue. These can be
+       used to construct partition functions as usual.
+
+       The analysis contexts of the isotopologues are linked to the context
+       of the given molecule. Parts of the treatments that do not depend on the
+       masses, e.g. the factorization of the environment in VSA or the block
+       Hessians in MBH, are therefore computed only once. The results that do
+       depend on the masses are not cached.
+
+       The mass-weighted eigenvalue problems of equal size are solved in
+       chunks with one stacked call to numpy.linalg.eigh (or eigvalsh). The
+       size of the chunks is limited by memory_budget, but a chunk always
+       contains at least one problem. Generalized eigenvalue problems, e.g.
+       MBH without free atoms, and problems whose zero modes are identified
+       without computing all eigenvectors are solved one at a time, as in
+       :class:`NMA`.
+
+       Usage::
+
+         >>> from molmod.isotopes import ame2003
+         >>> nmas = compute_isotopologues(molecule, [{20: ame2003.masses[7][15]}], ConstrainExt())
+    """
+    if treatment is None:
+        treatment = Full()
+    result = [None]*len(isotopologues)
+
+    def finish(index, iso_molecule, problem, evals, modes_small, get_modes, small_basis):
+        # bypass the default constructor
+        nma = NMA.__new__(NMA)
+        nma.partial = False
+        nma._init_spectrum(iso_molecule, problem.result, evals, modes_small,
+                           do_modes, transform=problem.transform,
+                           small_basis=small_basis, get_modes=get_modes,
+                           generalized=problem.generalized)
+        nma._init_molecule_attributes(iso_molecule)
+        result[index] = nma
+
+    # the problems of one shape that are waiting for a stacked solve
+    pending = {}
+
+    def solve_pending(shape):
+        items = pending.pop(shape)
+        stack = np.array([problem.hessian for index, iso_molecule, problem in items])
+        # release the separate Hessians
+        items = [(index, iso_molecule, problem._replace(hessian=None))
+                 for index, iso_molecule, problem in items]
+        if do_modes:
+            all_evals, all_modes_small = np.linalg.eigh(stack)
+        else:
+            all_evals = np.linalg.eigvalsh(stack)
+            all_modes_small = [None]*len(items)
+        del stack
+        for counter, (index, iso_molecule, problem) in enumerate(items):
+            finish(index, iso_molecule, problem, all_evals[counter],
+                   all_modes_small[counter], None, problem.small_basis)
+
+    for index, isotopologue in enumerate(isotopologues):
+        if isinstance(isotopologue, dict):
+            masses = molecule.masses.copy()
+            for atom, mass in isotopologue.iteritems():
+                masses[atom] = mass
+        else:
+            masses = np.array(isotopologue, float)
+            if masses.shape != molecule.masses.shape:
+                raise ValueError("Each array of isotopologue masses must have %i elements." % molecule.size)
+        iso_molecule = molecule.copy_with(masses=masses)
+        iso_molecule.analysis_context.parent = molecule.analysis_context
+        # only the mass-independent results, stored in the parent, are reused
+        iso_molecule.analysis_context.max_bytes = 0
+        # the transform and external basis are needed to identify the zeros
+        problem = _get_reduced_problem(treatment(iso_molecule, True), iso_molecule.masses3, do_modes)
+        shape = problem.hessian.shape
+        if problem.generalized or problem.select_zeros or np.product(shape) == 0:
+            finish(index, iso_molecule, problem, *_solve_reduced_problem(problem, do_modes))
+            continue
+        items = pending.setdefault(shape, [])
+        items.append((index, iso_molecule, problem))
+        # the separate Hessians, the stack and the eigenvectors
+        if 3*len(items)*problem.hessian.nbytes >= memory_budget:
+            solve_pending(shape)
+    for shape in pending.keys():
+        solve_pending(shape)
+    return result
+
+
+def _issparse(matrix):
+    """Return True when the matrix is a scipy.sparse matrix."""
+    return hasattr(matrix, "tocsr")
+
+
+def _submatrix(matrix, rows, cols):
+    """Return a submatrix of a dense array or a scipy.sparse matrix.
+
+       Sparse matrices remain sparse (CSR). Dense submatrices are extracted in
+       a single pass, without an intermediate copy of the selected rows. When
+       the rows and columns are the same contiguous range, a read-only view is
+       returned instead of a copy.
+    """
+    if _issparse(matrix):
+        return matrix.tocsr()[rows,:][:,cols]
+    rows = np.asarray(rows, int)
+    cols = np.asarray(cols, int)
+    if len(rows) > 0 and np.array_equal(rows, cols) and \
+       rows[-1] - rows[0] == len(rows) - 1 and (np.diff(rows) == 1).all():
+        result = matrix[rows[0]:rows[-1]+1, rows[0]:rows[-1]+1]
+        result.flags.writeable = False
+        return result
+    return matrix[np.ix_(rows, cols)]
+
+
+def _check_hessian_skipped(molecule, fixed=()):
+    """Raise a ValueError when Hessian blocks of non-fixed atoms were not loaded."""
+    if molecule.hessian_skipped is not None:
+        missing = np.setdiff1d(molecule.hessian_skipped, fixed)
+        if len(missing) > 0:
+            raise ValueError("The Hessian blocks of atoms %s were not loaded. "
+                "These atoms must be fixed in a PHVA." % missing.tolist())
+
+
+def _cartesian_indexes(atoms):
+    """Return the Cartesian indexes (x, y and z) of an array of atoms."""
+    return (3*np.asarray(atoms, int).reshape((-1,1)) + np.arange(3)).ravel()
+
+
+def _split_subsystem(size, subs):
+    """Return the environment atoms and the Cartesian indexes of the
+       subsystem and the environment.
+
+       Arguments:
+        | ``size`` -- the number of atoms
+        | ``subs`` -- an array with the subsystem atoms
+    """
+    mask = np.ones(size, bool)
+    mask[np.asarray(subs, int)] = False
+    envi = mask.nonzero()[0]
+    return envi, _cartesian_indexes(subs), _cartesian_indexes(envi)
+
+
+def _schur_complement(hessian, subs3, envi3, sparse=None):
+    """Eliminate the environment coordinates from the Hessian.
+
+       Arguments:
+        | ``hessian`` -- the full Hessian, dense or scipy.sparse
+        | ``subs3`` -- the Cartesian indexes of the subsystem
+        | ``envi3`` -- the Cartesian indexes of the environment
+
+       Optional argument:
+        | ``sparse`` -- when True, H_ee is factorized with a sparse LU
+                        decomposition. When False, a dense Cholesky
+                        decomposition is used, or an LDL^T decomposition when
+                        H_ee is not positive definite. The default (None)
+                        follows the storage of the Hessian.
+
+       Returns: ``H_ss - H_se (H_ee)**(-1) H_es`` and ``(H_ee)**(-1) H_es``.
+       The inverse of H_ee is never constructed.
+    """
+    import scipy.linalg
+    if sparse is None:
+        sparse = _issparse(hessian)
+    hessian_ss = _submatrix(hessian, subs3, subs3)
+    hessian_ee = _submatrix(hessian, envi3, envi3)
+    hessian_es = _submatrix(hessian, envi3, subs3)
+    if _issparse(hessian_ss):
+        hessian_ss = hessian_ss.toarray()
+        hessian_es = hessian_es.toarray()
+    if sparse:
+        from scipy.sparse import csc_matrix
+        from scipy.sparse.linalg import splu
+        lu = splu(
+            csc_matrix(hessian_ee), permc_spec="MMD_AT_PLUS_A",
+            options=dict(SymmetricMode=True)
+        )
+        hessian_e1_es = lu.solve(hessian_es)
+        return hessian_ss - np.dot(hessian_es.transpose(), hessian_e1_es), hessian_e1_es
+    if _issparse(hessian_ee):
+        hessian_ee = hessian_ee.toarray()
+    try:
+        # H_ee = L . L**T, such that H_se . H_ee**-1 . H_es = X**T . X with
+        # X = L**-1 . H_es.
+        L = scipy.linalg.cholesky(hessian_ee, lower=True, check_finite=False)
+    except np.linalg.LinAlgError:
+        # indefinite environment: symmetric (LDL^T) solver
+        hessian_e1_es = scipy.linalg.solve(
+            hessian_ee, hessian_es, assume_a="sym", check_finite=False)
+        return hessian_ss - np.dot(hessian_es.transpose(), hessian_e1_es), hessian_e1_es
+    X = scipy.linalg.solve_triangular(L, hessian_es, lower=True, check_finite=False)
+    hessian_e1_es = scipy.linalg.solve_triangular(
+        L, X, lower=True, trans="T", check_finite=False)
+    return hessian_ss - np.dot(X.transpose(), X), hessian_e1_es
+
+
+def _get_hessian_small_mw(result):
+    """Return the mass-weighted Hessian in the reduced coordinates of a
+       TreatmentResult."""
+    if result.mass_matrix_small is None:
+        return result.hessian_small
+    else:
+        return result.mass_matrix_small.get_weighted_hessian(result.hessian_small)
+
+
+def _has_dense_mass_block(result):
+    """Return True when the reduced problem of a TreatmentResult is best
+       solved as a generalized eigenvalue problem.
+
+       This is the case when the reduced mass matrix is a dense block without
+       a diagonal part, e.g. in MBH and VSA, and the reduced Hessian is dense.
+    """
+    mass_matrix = result.mass_matrix_small
+    if mass_matrix is None or len(mass_matrix.mass_diag) > 0 or len(mass_matrix.mass_block) == 0:
+        return False
+    if _issparse(result.hessian_small):
+        return False
+    transform = result.transform
+    if transform is not None and transform.atom_division is not None:
+        atom_division = transform.atom_division
+        if len(atom_division.free) > 0 or len(atom_division.fixed) > 0:
+            return False
+    return True
+
+
+_ReducedProblem = namedtuple("_ReducedProblem", [
+    "result", "hessian", "mass", "transform", "small_basis", "generalized",
+    "select_zeros"])
+
+
+def _get_reduced_problem(result, masses3, do_modes):
+    """Prepare the eigenvalue problem for the full spectrum of a TreatmentResult.
+
+       Arguments:
+        | ``result`` -- the TreatmentResult
+        | ``masses3`` -- the diagonal of the Cartesian mass matrix
+        | ``do_modes`` -- when False, only the eigenvalues will be computed
+
+       Returns: a _ReducedProblem with the following fields:
+
+       * ``result``: the TreatmentResult without the reduced Hessian (and
+         without the mass matrix of a generalized problem), such that these
+         are not kept alive by the result.
+       * ``hessian``: the dense mass-weighted reduced Hessian, or the reduced
+         Hessian of a generalized eigenvalue problem.
+       * ``mass``: the dense mass matrix of a generalized problem, or None.
+       * ``transform``, ``small_basis``: see _get_modes_transform and
+         _get_small_external_basis.
+       * ``generalized``: True for a generalized problem, H x = lambda M x.
+       * ``select_zeros``: True when the zeros are identified with a few
+         eigenvectors computed on demand, see _eigvalsh_selectable.
+    """
+    generalized = _has_dense_mass_block(result)
+    if generalized:
+        # Solve H x = lambda M x directly, without a mass-weighted copy of
+        # the reduced Hessian.
+        hessian = result.hessian_small
+        mass = result.mass_matrix_small.mass_block
+    else:
+        # the conventional frequency computation in the reduced coordinates
+        hessian = _get_hessian_small_mw(result)
+        if _issparse(hessian):
+            # the full spectrum requires a dense diagonalization
+            hessian = hessian.toarray()
+        mass = None
+    result = result._replace(hessian_small=None)
+    transform = _get_modes_transform(result, generalized)
+    small_basis = _get_small_external_basis(result, transform, masses3)
+    if generalized:
+        # the mass matrix may be overwritten by the eigensolver
+        result = result._replace(mass_matrix_small=None)
+    select_zeros = not do_modes and small_basis is not None and result.num_zeros > 0
+    return _ReducedProblem(result, hessian, mass, transform, small_basis, generalized, select_zeros)
+
+
+def _solve_reduced_problem(problem, do_modes):
+    """Compute the full spectrum of a _ReducedProblem.
+
+       Returns: the eigenvalues, the eigenvectors (None when do_modes is
+       False), the function get_modes of _eigvalsh_selectable (or None) and
+       the external basis in the coordinates of the eigenvectors.
+
+       The matrices in the problem may be overwritten.
+    """
+    small_basis = problem.small_basis
+    get_modes = None
+    modes_small = None
+    if np.product(problem.hessian.shape) == 0:
+        evals = np.zeros(0)
+    elif problem.select_zeros:
+        # Without modes, the zero modes are identified with a few eigenvectors
+        # that are computed on demand. The external basis is transformed
+        # together with the eigenvectors.
+        evals, get_modes, small_basis = _eigvalsh_selectable(
+            problem.hessian, problem.mass, small_basis)
+    elif problem.generalized:
+        evals, modes_small = _generalized_eigh(problem.hessian, problem.mass, do_modes)
+    elif do_modes:
+        evals, modes_small = np.linalg.eigh(problem.hessian)
+    else:
+        evals = np.linalg.eigvalsh(problem.hessian)
+    return evals, modes_small, get_modes, small_basis
+
+
+def _generalized_eigh(hessian, mass, do_modes=True):
+    """Solve the generalized eigenvalue problem H x = lambda M x.
+
+       Arguments:
+        | ``hessian`` -- the symmetric (reduced) Hessian, H
+        | ``mass`` -- the symmetric positive definite (reduced) mass matrix, M
+
+       Optional argument:
+        | ``do_modes`` -- when False, only the eigenvalues are computed
+
+       Returns: the eigenvalues and the eigenvectors (None when do_modes is
+       False). The eigenvectors are normalized such that x^T M x = 1.
+
+       The problem is reduced to a standard one with a Cholesky decomposition
+       of M in LAPACK. Both arguments are overwritten when they are writeable.
+       Their transposes are passed to LAPACK because these are Fortran-ordered
+       views of the same (symmetric) data, which can be overwritten without
+       making a copy first.
+    """
+    import scipy.linalg
+    result = scipy.linalg.eigh(
+        hessian.transpose(), mass.transpose(), eigvals_only=not do_modes,
+        overwrite_a=hessian.flags.writeable, overwrite_b=mass.flags.writeable,
+        check_finite=False,
+    )
+    if do_modes:
+        return result
+    else:
+        return result, None
+
+
+def _congruence(basis, matrix):
+    """Return basis^T . matrix . basis as a dense array.
+
+       Both arguments may be scipy.sparse matrices. The products are carried
+       out such that no dense intermediates with the size of a sparse argument
+       are formed.
+    """
+    if _issparse(basis):
+        if _issparse(matrix):
+            return (basis.transpose()*matrix*basis).toarray()
+        else:
+            return basis.transpose().dot(basis.transpose().dot(matrix).transpose()).transpose()
+    else:
+        return np.dot(basis.transpose(), matrix.dot(basis))
+
+
+def _nbytes(result):
+    """Estimate the memory used by the arrays in a cached result.
+
+       Dense arrays, scipy.sparse matrices and the arrays of a Molecule are
+       counted, also inside tuples and lists. Other objects are ignored.
+    """
+    if isinstance(result, np.ndarray):
+        return result.nbytes
+    elif _issparse(result):
+        return sum(
+            getattr(result, name).nbytes for name in ("data", "indices", "indptr", "row", "col")
+            if hasattr(result, name)
+        )
+    elif isinstance(result, (tuple, list)):
+        return sum(_nbytes(value) for value in result)
+    elif isinstance(result, Molecule):
+        return sum(
+            _nbytes(value) for value in result.__dict__.itervalues()
+            if isinstance(value, np.ndarray) or _issparse(value)
+        )
+    else:
+        return 0
+
+
+def _freqs_to_evals(freqs):
+    """Convert (negative imaginary) frequencies into eigenvalues of the
+       mass-weighted Hessian."""
+    freqs = np.asarray(freqs, dtype=float)
+    return np.sign(freqs)*(2*np.pi*freqs)**2
+
+
+def _partial_eigh(hessian_mw, num_modes=None, freq_window=None, do_modes=True):
+    """Compute a part of the spectrum of a mass-weighted Hessian.
+
+       Arguments:
+        | ``hessian_mw`` -- a symmetric mass-weighted Hessian (a dense array
+                            or a scipy.sparse matrix)
+
+       Optional arguments:
+        | ``num_modes`` -- the number of eigenpairs with the lowest eigenvalues
+        | ``freq_window`` -- the interval (freq_min, freq_max) of frequencies of
+                             the requested eigenpairs
+        | ``do_modes`` -- When False, the eigenvectors are not returned.
+                          [default=True]
+
+       Exactly one of num_modes and freq_window must be given. Returns the
+       eigenvalues in ascending order and the eigenvectors in columns, or None
+       when do_modes is False. Small problems are diagonalized with a dense
+       solver. Otherwise, the eigenpairs closest to a shift sigma are computed
+       iteratively with scipy.sparse.linalg.eigsh in shift-invert mode. For the
+       lowest eigenvalues, the shift is lowered until an inertia test confirms
+       that no eigenvalues are missing below the computed ones. For a window,
+       the shift is put in the middle of the window and the number of computed
+       eigenpairs is doubled until the window is covered.
+    """
+    if (num_modes is None) == (freq_window is None):
+        raise ValueError("Exactly one of num_modes and freq_window must be given.")
+    size = hessian_mw.shape[0]
+    if freq_window is not None:
+        evals_min, evals_max = _freqs_to_evals(freq_window)
+        num_try = 20
+    else:
+        num_try = min(num_modes, size)
+
+    if 3*num_try < size:
+        from scipy.sparse.linalg import eigsh
+        if freq_window is None:
+            # The eigenvalues closest to sigma are the lowest ones if there
+            # are no eigenvalues below the lowest one found. Otherwise sigma is
+            # lowered, starting from just below zero.
+            margin = 1e-8*abs(hessian_mw).max()
+            sigma = -margin
+            radius = margin
+            while True:
+                evals, evecs = eigsh(hessian_mw, num_try, sigma=sigma, which='LM')
+                lowest = evals.min()
+                if not _has_evals_below(hessian_mw, lowest - margin):
+                    break
+                radius = 2*max(radius, abs(evals - sigma).max())
+                sigma = lowest - radius
+        else:
+            # A center that is not exactly an eigenvalue, e.g. zero.
+            sigma = 0.5*(evals_min + evals_max) + 1e-7*(evals_max - evals_min)
+            while True:
+                evals, evecs = eigsh(hessian_mw, num_try, sigma=sigma, which='LM')
+                if abs(evals - sigma).max() > 0.5*(evals_max - evals_min):
+                    # all eigenvalues in the window are found
+                    break
+                num_try *= 2
+                if 3*num_try >= size:
+                    evals = None
+                    break
+    else:
+        evals = None
+
+    if evals is None:
+        # The dense solver is cheaper for small problems.
+        if hasattr(hessian_mw, "toarray"):
+            hessian_mw = hessian_mw.toarray()
+        evals, evecs = np.linalg.eigh(hessian_mw)
+
+    order = evals.argsort()
+    if freq_window is None:
+        order = order[:num_modes]
+    else:
+        evals_sorted = evals[order]
+        order = order[(evals_sorted > evals_min) & (evals_sorted < evals_max)]
+    evals = evals[order]
+    if do_modes:
+        return evals, evecs[:,order]
+    else:
+        return evals, None
+
+
+def _has_evals_below(matrix, bound):
+    """Return True when the symmetric matrix has eigenvalues below bound.
+
+       The test is based on the inertia of the shifted matrix. For dense
+       matrices, a Cholesky decomposition is attempted. For scipy.sparse
+       matrices, the signs of the pivots in a symmetric LU decomposition
+       without pivoting are counted.
+    """
+    size = matrix.shape[0]
+    if hasattr(matrix, "toarray"):
+        from scipy.sparse import identity
+        from scipy.sparse.linalg import splu
+        shifted = (matrix - bound*identity(size)).tocsc()
+        lu = splu(shifted, permc_spec="MMD_AT_PLUS_A", diag_pivot_thresh=0.0,
+                  options=dict(SymmetricMode=True))
+        return (lu.U.diagonal() < 0).any()
+    else:
+        try:
+            np.linalg.cholesky(matrix - bound*np.identity(size))
+            return False
+        except np.linalg.LinAlgError:
+            return True
+
+
+def _get_modes_transform(result, generalized=False):
+    """Return the transform that maps the eigenvectors of the reduced problem
+       to Cartesian displacements.
+
+       For the conventional eigenvalue problem, this is a mass-weighted copy
+       of the transform of the TreatmentResult (if needed). The eigenvectors of
+       the generalized eigenvalue problem are not mass-weighted and the
+       transform is returned as such.
+    """
+    transform = result.transform
+    if transform is not None and not generalized and result.mass_matrix_small is not None:
+        transform = copy.copy(transform)
+        transform.make_weighted(result.mass_matrix_small)
+    return transform
+
+
+def _get_small_external_basis(result, transform, masses3):
+    """Return the external basis in the coordinates of the reduced eigenvectors
+
+       Arguments:
+        | ``result`` -- the TreatmentResult
+        | ``transform`` -- the transform of the eigenvectors, see
+                           _get_modes_transform
+        | ``masses3`` -- the diagonal of the Cartesian mass matrix
+
+       The returned matrix, B, has one row per external basis vector, such
+       that ``B.x`` is the projection of the mass-weighted Cartesian mode,
+       which corresponds to the reduced eigenvector x, on the (orthonormal)
+       external basis. Returns None when the TreatmentResult has no transform
+       or external basis.
+    """
+    if transform is None or result.external_basis is None or len(result.external_basis) == 0:
+        return None
+    weighted = (result.external_basis*np.sqrt(masses3)).transpose()
+    return transform.apply_transpose(weighted).transpose()
+
+
+def _eigvalsh_selectable(hessian, mass=None, basis=None):
+    """Compute all eigenvalues and, on demand, a few eigenvectors.
+
+       Arguments:
+        | ``hessian`` -- the dense symmetric (reduced) Hessian
+
+       Optional arguments:
+        | ``mass`` -- the reduced mass matrix of a generalized eigenvalue
+                      problem. It is overwritten.
+        | ``basis`` -- vectors (rows) whose overlap with the eigenvectors is
+                       needed, e.g. the result of _get_small_external_basis
+
+       Returns: the eigenvalues (in ascending order), a function
+       ``get_modes(lo, hi)`` that returns the eigenvectors lo to hi (inclusive)
+       as columns of a 2D array, and the basis transformed to the coordinates
+       of these eigenvectors (or None).
+
+       For a generalized eigenvalue problem, H x = lambda M x, the problem is
+       first reduced to a standard one with the Cholesky factor, M = L L^T. The
+       function get_modes then returns the orthonormal eigenvectors y = L^T x
+       of L^-1 H L^-T and the basis B is transformed into B L^-T, such that the
+       overlaps are preserved. The eigenvectors are always orthonormal.
+
+       The matrix is reduced to tridiagonal form only once. The eigenvalues of
+       the tridiagonal matrix cost about as much as numpy.linalg.eigvalsh.
+       Selected eigenvectors are computed afterwards by inverse iteration on
+       the tridiagonal matrix and a back-transformation with the Householder
+       reflectors, at a cost of O(n^2) per eigenvector.
+    """
+    import scipy.linalg
+    from scipy.linalg.lapack import get_lapack_funcs
+    if mass is not None:
+        # reduce to a standard eigenvalue problem: L^-1 H L^-T with M = L L^T
+        factor = scipy.linalg.cholesky(mass, lower=True, overwrite_a=True, check_finite=False)
+        hessian = scipy.linalg.solve_triangular(factor, hessian, lower=True, check_finite=False)
+        hessian = scipy.linalg.solve_triangular(factor, hessian.transpose(), lower=True, check_finite=False)
+        if basis is not None:
+            basis = scipy.linalg.solve_triangular(factor, basis.transpose(), lower=True, check_finite=False).transpose()
+    size = len(hessian)
+    sytrd, sytrd_lwork = get_lapack_funcs(("sytrd", "sytrd_lwork"), (hessian,))
+    lwork, info = sytrd_lwork(size, lower=1)
+    reflectors, diagonal, offdiagonal, tau, info = sytrd(hessian, lower=1, lwork=int(lwork))
+    if info != 0:
+        raise ValueError("Reduction to tridiagonal form failed (info=%i)." % info)
+    evals = scipy.linalg.eigh_tridiagonal(diagonal, offdiagonal, eigvals_only=True)
+
+    def get_modes(lo, hi):
+        vecs = scipy.linalg.eigh_tridiagonal(
+            diagonal, offdiagonal, select="i", select_range=(lo, hi))[1]
+        if size > 1:
+            # Q = H(0) H(1) ... H(n-2) only acts on the last n-1 components.
+            # Its reflectors are stored as in a QR factorization of
+            # reflectors[1:,:-1], see the LAPACK routine ormtr.
+            ormqr, = get_lapack_funcs(("ormqr",), (reflectors,))
+            cq, work, info = ormqr("L", "N", reflectors[1:,:-1], tau, vecs[1:], max(1, 64*vecs.shape[1]))
+            if info != 0:
+                raise ValueError("Back-transformation of the eigenvectors failed (info=%i)." % info)
+            vecs[1:] = cq
+        return vecs
+
+    return evals, get_modes, basis
+
+
+def _find_zeros(evals, small_basis, num_zeros, modes_small=None, get_modes=None):
+    """Identify the zero modes in a full spectrum.
+
+       Arguments:
+        | ``evals`` -- the eigenvalues of the reduced problem (ascending)
+        | ``small_basis`` -- the external basis in reduced coordinates (see
+                             _get_small_external_basis), or None
+        | ``num_zeros`` -- the number of zero modes
+
+       Optional arguments:
+        | ``modes_small`` -- all eigenvectors of the reduced problem
+        | ``get_modes`` -- a function that returns the orthonormal
+                           eigenvectors lo to hi, see _eigvalsh_selectable.
+                           small_basis must be expressed in the coordinates
+                           of these eigenvectors.
+
+       The zero modes are the ones with the largest overlap with the external
+       basis. When all eigenvectors are available, all overlaps are computed
+       with a single matrix product in the reduced coordinates. Otherwise, the
+       eigenvectors are computed for a growing window of eigenvalues around
+       zero. Because these eigenvectors are orthonormal, the sum of the squared
+       overlaps of all modes equals the squared norm of small_basis, such that the search can stop as soon as the
+       overlap that is not yet accounted for is smaller than the overlaps of
+       the selected modes. Without the external basis, the modes with the
+       smallest absolute eigenvalues are taken.
+    """
+    if small_basis is None or (modes_small is None and get_modes is None):
+        return abs(evals).argsort()[:num_zeros]
+    if modes_small is not None:
+        overlaps = (np.dot(small_basis, modes_small)**2).sum(axis=0)
+        return overlaps.argsort()[-num_zeros:]
+    # The eigenvalues with the smallest absolute values form a contiguous
+    # window in the sorted spectrum, which is doubled until the criterion holds.
+    order = abs(evals).argsort()
+    total = (small_basis**2).sum()
+    overlaps = np.zeros(len(evals))
+    size = min(2*num_zeros, len(evals))
+    lo, hi = order[0], order[0] - 1
+    while True:
+        new_lo, new_hi = order[:size].min(), order[:size].max()
+        # only compute the eigenvectors that are new in the window
+        for begin, end in (new_lo, lo - 1), (hi + 1, new_hi):
+            if begin <= end:
+                overlaps[begin:end+1] = (np.dot(small_basis, get_modes(begin, end))**2).sum(axis=0)
+        lo, hi = new_lo, new_hi
+        window = overlaps[lo:hi+1]
+        selected = window.argsort()[-num_zeros:]
+        if size == len(evals) or total - window.sum() < window[selected].min():
+            return lo + selected
+        size = min(2*size, len(evals))
+
+
+def _find_partial_zeros(freqs, modes_small, small_basis, num_zeros, freq_window):
+    """Identify the zero modes in a partial spectrum.
+
+       Arguments:
+        | ``freqs`` -- the computed frequencies
+        | ``modes_small`` -- the computed eigenvectors in reduced coordinates,
+                             or None
+        | ``small_basis`` -- the external basis in reduced coordinates (see
+                             _get_small_external_basis), or None
+        | ``num_zeros`` -- the number of zero modes in the full spectrum
+        | ``freq_window`` -- the frequency window of the partial spectrum, or
+                             None when the lowest modes are computed
+
+       When the eigenvectors are available, the zero modes are the ones (at
+       most num_zeros) with the largest overlap with the space of the external
+       degrees of freedom, provided that they lie mainly in that space.
+       Otherwise, the modes with the smallest absolute frequencies are
+       selected if the partial spectrum contains the zero frequency.
+    """
+    if modes_small is not None and small_basis is not None:
+        overlaps = np.sqrt((np.dot(small_basis, modes_small)**2).sum(axis=0))
+        selected = overlaps.argsort()[::-1][:num_zeros]
+        return selected[overlaps[selected] > 0.5]
+    candidates = abs(freqs).argsort()[:num_zeros]
+    if freq_window is None or (freq_window[0] < 0 and freq_window[1] > 0):
+        return candidates
+    else:
+        return np.array([], int)
+
+
 class AtomDivision(object):
     """A division of atoms into transformed, free and fixed."""
 
@@ -332,7 +1085,8 @@ class Transform(object):
         """
            Arguments:
              | ``matrix`` -- the linear transformation from the transformed
-                             displacements to Cartesian coordinates.
+                             displacements to Cartesian coordinates. This may
+                             be a scipy.sparse matrix.
 
            Optional argument
              | ``atom_division`` -- an AtomDivision instance, when not given all
@@ -398,14 +1152,14 @@ class Transform(object):
             raise ValueError("The modes argument must be an array with %i rows, got %i." %
                 (self._num_reduced, modes.shape[0])
             )
-        # Computation
+        # Computation, the matrix may be a scipy.sparse matrix
         if self.atom_division is None:
-            return np.dot(self.matrix, modes)
+            return self.matrix.dot(modes)
         else:
             result = np.zeros((self.atom_division.num_cartesian, modes.shape[1]), float)  # 3NxM
             i1 = 3*len(self.atom_division.transformed)
             i2 = i1 + 3*len(self.atom_division.free)
-            result[:i1] = np.dot(self.matrix, modes[:self.matrix.shape[1]])
+            result[:i1] = self.matrix.dot(modes[:self.matrix.shape[1]])
             if self.weighted:
                 result[i1:i2] = modes[self.matrix.shape[1]:]*self.scalars
             else:
@@ -415,6 +1169,56 @@ class Transform(object):
             tmp = result[self.atom_division.to_cartesian_order]
             return tmp
 
+    def apply_transpose(self, vectors):
+        """Apply the transpose of the transformation to Cartesian vectors.
+
+           Argument:
+            | ``vectors`` -- Cartesian vectors (float numpy array with shape
+                             3NxM)
+
+           Returns: a float numpy array with shape KxM, where K is the number
+           of reduced coordinates. The components of the fixed atoms do not
+           contribute.
+        """
+        if self.atom_division is None:
+            return np.asarray(self.matrix.transpose().dot(vectors))
+        # Reorder the atoms, i.e. the inverse of the reordering in __call__
+        vectors = vectors[self.atom_division.to_reduced_order]
+        result = np.zeros((self._num_reduced, vectors.shape[1]), float)
+        i1 = 3*len(self.atom_division.transformed)
+        i2 = i1 + 3*len(self.atom_division.free)
+        result[:self.matrix.shape[1]] = self.matrix.transpose().dot(vectors[:i1])
+        if self.weighted:
+            result[self.matrix.shape[1]:] = vectors[i1:i2]*self.scalars
+        else:
+            result[self.matrix.shape[1]:] = vectors[i1:i2]
+        return result
+
+    def to_weighted_cartesian(self, modes, masses3):
+        """Transform displacements in (non-mass-weighted) reduced coordinates
+           to mass-weighted Cartesian coordinates.
+
+           Arguments:
+            | ``modes`` -- Small displacements (or modes) in reduced
+                           coordinates (float numpy array with shape KxM)
+            | ``masses3`` -- The diagonal of the Cartesian mass matrix
+
+           The result is computed with a single matrix product, followed by an
+           in-place scaling. Free or fixed atoms are not supported because the
+           are not treated with the transformation matrix.
+        """
+        if self.weighted:
+            raise Exception("The transformation is already weighted.")
+        matrix = self.matrix
+        if self.atom_division is not None:
+            if len(self.atom_division.free) > 0 or len(self.atom_division.fixed) > 0:
+                raise ValueError("Free or fixed atoms are not supported.")
+            # reorder the rows of the matrix instead of those of the result
+            matrix = matrix[self.atom_division.to_cartesian_order]
+        result = matrix.dot(modes)
+        result *= np.sqrt(masses3).reshape((-1,1))
+        return result
+
     def make_weighted(self, mass_matrix):
         """Include mass-weighting into the transformation.
 
@@ -430,11 +1234,135 @@ class Transform(object):
         # the transformation matrix always transforms to non-mass-weighted Cartesian coords
         if self.weighted:
             raise Exception("The transformation is already weighted.")
-        self.matrix = np.dot(self.matrix, mass_matrix.mass_block_inv_sqrt)
+        self.matrix = self.matrix.dot(mass_matrix.mass_block_inv_sqrt)
         self.scalars = mass_matrix.mass_diag_inv_sqrt.reshape((-1,1))
         self._weighted = True
 
 
+class Modes(object):
+    """Lazy mass-weighted Cartesian modes.
+
+       This object keeps the eigenvectors in the reduced coordinates together
+       with the Transform object of the treatment. Columns are only transformed
+       to mass-weighted Cartesian coordinates when they are accessed. It
+       behaves like a read-only 2D array with one mode per column::
+
+         >>> nma.modes[:,6]          # one mode, a 1D array
+         >>> nma.modes[:,[6,7]]      # two modes, a 2D array
+         >>> nma.modes.to_array()    # all modes, a 2D array
+         >>> for chunk in nma.modes.iter_chunks(100):
+         ...     # at most 100 modes at a time
+         ...     pass
+
+       Other array operations, e.g. arithmetic or numpy functions, work on the
+       result of :meth:`to_array`, i.e. all modes are computed.
+    """
+
+    def __init__(self, modes_small, transform, masses3, generalized=False):
+        """
+           Arguments:
+            | ``modes_small`` -- the eigenvectors in reduced coordinates, one
+                                 per column
+            | ``transform`` -- the Transform object that maps displacements in
+                               the reduced coordinates to Cartesian
+                               displacements
+            | ``masses3`` -- the diagonal of the Cartesian mass matrix
+
+           Optional argument:
+            | ``generalized`` -- When True, modes_small are solutions of the
+                                 generalized eigenvalue problem, i.e. they are
+                                 not mass-weighted and the transform is not
+                                 weighted either. When False, modes_small are
+                                 mass-weighted and the transform is weighted
+                                 (or readily mass-weighted).
+        """
+        self.modes_small = modes_small
+        self.transform = transform
+        self.masses3 = masses3
+        self.generalized = generalized
+
+    shape = property(lambda self: (len(self.masses3), self.modes_small.shape[1]))
+    ndim = 2
+    dtype = np.dtype(float)
+
+    def __len__(self):
+        return len(self.masses3)
+
+    def get_columns(self, indexes):
+        """Return the selected modes as a 2D array.
+
+           Argument:
+            | ``indexes`` -- an integer array with mode indexes
+        """
+        modes_small = self.modes_small[:,indexes]
+        if self.generalized:
+            return self.transform.to_weighted_cartesian(modes_small, self.masses3)
+        else:
+            result = self.transform(modes_small)
+            result *= np.sqrt(self.masses3).reshape((-1,1))
+            return result
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple) and len(index) == 2:
+            rows, cols = index
+            cols = np.arange(self.shape[1])[cols]
+            if isinstance(cols, np.ndarray):
+                return self.get_columns(cols)[rows]
+            else:
+                return self.get_columns([cols])[rows,0]
+        else:
+            return self.to_array()[index]
+
+    def iter_chunks(self, size=100):
+        """Iterate over all modes in chunks.
+
+           Optional argument:
+            | ``size`` -- the maximum number of modes (columns) in one chunk
+
+           Each iteration yields a 2D array with a chunk of consecutive modes.
+        """
+        for begin in xrange(0, self.shape[1], size):
+            yield self.get_columns(np.arange(begin, min(begin + size, self.shape[1])))
+
+    def to_array(self):
+        """Return all modes as a 2D array."""
+        return self.get_columns(np.arange(self.shape[1]))
+
+    def __array__(self, dtype=None):
+        result = self.to_array()
+        if dtype is not None:
+            result = result.astype(dtype)
+        return result
+
+    def copy(self):
+        """Return all modes as a 2D array."""
+        return self.to_array()
+
+    def tolist(self):
+        return self.to_array().tolist()
+
+    def transpose(self):
+        return self.to_array().transpose()
+
+    T = property(transpose)
+
+    def __abs__(self):
+        return abs(self.to_array())
+
+    def __neg__(self):
+        return -self.to_array()
+
+    # arithmetic works on the plain array
+    __add__ = lambda self, other: self.to_array() + other
+    __radd__ = lambda self, other: other + self.to_array()
+    __sub__ = lambda self, other: self.to_array() - other
+    __rsub__ = lambda self, other: other - self.to_array()
+    __mul__ = lambda self, other: self.to_array()*other
+    __rmul__ = lambda self, other: other*self.to_array()
+    __div__ = lambda self, other: self.to_array()/other
+    __truediv__ = __div__
+
+
 class MassMatrix(object):
     """A clever mass matrix object. It is sparse when atom coordinates remain
        Cartesian in the reduced coordinates.
@@ -473,15 +1401,29 @@ class MassMatrix(object):
         else:
             raise TypeError("MassMatrix.__init__ takes one or two arguments, %i given." % len(args))
 
-        # the square root of the inverse
+        self.mass_diag_inv_sqrt = 1/np.sqrt(self.mass_diag)
+
+    @cached
+    def mass_block_inv_sqrt(self):
+        """The square root of the inverse of mass_block
+
+           This is only computed when needed, i.e. not when the frequencies are
+           obtained from the generalized eigenvalue problem.
+        """
         if len(self.mass_block) == 0:
-            self.mass_block_inv_sqrt = np.zeros((0,0), float)
+            return np.zeros((0,0), float)
         else:
             evals, evecs = np.linalg.eigh(self.mass_block)
-            self.mass_block_inv_sqrt = np.dot(evecs/np.sqrt(evals), evecs.transpose())
-        self.mass_diag_inv_sqrt = 1/np.sqrt(self.mass_diag)
+            return np.dot(evecs/np.sqrt(evals), evecs.transpose())
 
     def get_weighted_hessian(self, hessian):
+        if _issparse(hessian):
+            if len(self.mass_block) == 0:
+                # only a diagonal mass matrix, the result remains sparse.
+                from scipy.sparse import diags
+                scale = diags(self.mass_diag_inv_sqrt)
+                return (scale*hessian*scale).tocsr()
+            hessian = hessian.toarray()
         hessian_mw = np.zeros(hessian.shape,float)
         n = len(self.mass_block)
         # transform block by block:
@@ -492,20 +1434,181 @@ class MassMatrix(object):
         return hessian_mw
 
 
+class AnalysisContext(object):
+    """A cache of reusable intermediate results for normal mode analyses.
+
+       Each Molecule has one analysis context, ``molecule.analysis_context``.
+       The treatments store results in it that are likely to be needed again
+       when the same molecule is analyzed with a related treatment: the SVD
+       of the external basis, factorizations of the environment block (VSA,
+       VSANoMass) and block Hessian products (MBH). A Molecule is read-only,
+       so these results never become outdated. Results with the size of the
+       full Hessian that are cheap to recompute, e.g. the mass-weighted
+       Hessian, are not cached.
+
+       The cached arrays take at most ``max_bytes`` bytes of memory. The
+       least recently used results are discarded first and a result that
+       does not fit at all is not cached. Set ``max_bytes`` to zero to
+       disable the cache, or call :meth:`clear` to release all memory.
+
+       The context of an isotopologue can be linked to the context of the
+       original molecule with the ``parent`` attribute. Results that do not
+       depend on the masses are then taken from (and stored in) the parent.
+    """
+
+    def __init__(self, molecule, max_bytes=64*1024**2):
+        """
+           Argument:
+            | ``molecule`` -- the Molecule instance to which the cached results
+                              belong
+
+           Optional argument:
+            | ``max_bytes`` -- the maximum memory used by the cached arrays
+                               [default=64MB]
+        """
+        self.molecule = molecule
+        self.max_bytes = max_bytes
+        self.parent = None
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._results)
+
+    def get(self, key, compute, mass_independent=False):
+        """Return a cached result, compute it first if needed.
+
+           Arguments:
+            | ``key`` -- a hashable object that identifies the result
+            | ``compute`` -- a function without arguments that computes the
+                             result, only called when the result is not
+                             present yet
+
+           Optional argument:
+            | ``mass_independent`` -- when True, the result does not depend on
+                                      the atomic masses and it is shared with
+                                      the parent context (if any)
+
+           Arrays in the result are made read-only before they are cached
+           because they are shared by all subsequent analyses.
+        """
+        if mass_independent and self.parent is not None:
+            return self.parent.get(key, compute, True)
+        with self._lock:
+            if key in self._results:
+                # move to the end, i.e. mark as most recently used
+                result, size = self._results.pop(key)
+                self._results[key] = result, size
+                self.hits += 1
+                return result
+            self.misses += 1
+        result = compute()
+        for value in (result if isinstance(result, tuple) else (result,)):
+            if isinstance(value, np.ndarray):
+                value.setflags(write=False)
+        size = _nbytes(result)
+        with self._lock:
+            if size <= self.max_bytes and key not in self._results:
+                self._results[key] = result, size
+                self.nbytes += size
+                while self.nbytes > self.max_bytes:
+                    self.nbytes -= self._results.popitem(last=False)[1][1]
+        return result
+
+    def clear(self):
+        """Discard all cached results."""
+        with self._lock:
+            self._results.clear()
+            self.nbytes = 0
+
+    def get_external_basis_svd(self):
+        """Return the reduced SVD (U, W, Vt) of ``molecule.external_basis``."""
+        return self.get(
+            ("external_basis_svd",),
+            lambda: tuple(np.linalg.svd(self.molecule.external_basis, full_matrices=False))
+        )
+
+    def get_schur_complement(self, subs3, envi3, sparse=None):
+        """Return ``H_ss - H_se (H_ee)**(-1) H_es`` and ``(H_ee)**(-1) H_es``
+
+           Arguments:
+            | ``subs3`` -- the Cartesian indexes of the subsystem
+            | ``envi3`` -- the Cartesian indexes of the environment
+
+           Optional argument:
+            | ``sparse`` -- selects the factorization of H_ee, see
+                            :class:`VSA`
+        """
+        if sparse is None:
+            sparse = _issparse(self.molecule.hessian)
+        return self.get(
+            ("schur_complement", tuple(subs3), tuple(envi3), bool(sparse)),
+            lambda: _schur_complement(self.molecule.hessian, subs3, envi3, sparse),
+            mass_independent=True
+        )
+
+    def get_derived_molecule(self, key, compute):
+        """Return a cached molecule derived from this one.
+
+           Arguments:
+            | ``key`` -- a hashable object that identifies the result
+            | ``compute`` -- a function that derives a new Molecule from the
+                             Molecule given as argument, e.g. a submolecule or
+                             a molecule with a projected Hessian
+
+           When this context has a parent, the context of the derived molecule
+           gets the context of the corresponding derived molecule of the parent
+           as its own parent.
+        """
+        def compute_linked():
+            result = compute(self.molecule)
+            if self.parent is not None:
+                parent_result = self.parent.get_derived_molecule(key, compute)
+                result.analysis_context.parent = parent_result.analysis_context
+            return result
+        return self.get(key, compute_linked)
+
+
+class TreatmentResult(namedtuple("TreatmentResult", [
+        "hessian_small", "mass_matrix_small", "transform", "num_zeros",
+        "external_basis"])):
+    """The outcome of a treatment applied to one molecule.
+
+       This is an immutable (named) tuple with the following fields:
+
+       * ``hessian_small``: the Hessian in reduced coordinates
+       * ``mass_matrix_small``: the mass matrix in reduced coordinates (see
+         MassMatrix class), or None when the Hessian is already mass-weighted
+       * ``transform``: (None if ``do_modes==False``) the transformation from
+         small displacements in reduced coordinates to small displacements in
+         Cartesian coordinates. (see Transform class)
+       * ``num_zeros``: the number of zero eigenvalues to expect
+       * ``external_basis``: (None if ``do_modes==False``) the mass-weighted
+         basis of external degrees of freedom.
+
+       The arrays and objects in the fields are not copied. A new result with
+       some fields replaced is obtained with the ``_replace`` method.
+    """
+    __slots__ = ()
+
+
 class Treatment(object):
     """An abstract base class for the NMA treatments. Derived classes must
        override the __call__ function, or they have to override the individual
        compute_zeros and compute_hessian methods. Parameters specific for the
        treatment are passed to the constructor, see for example the PHVA
        implementation.
+
+       A treatment object only holds these parameters. Applying it to a
+       molecule does not modify it, such that the same treatment can be used
+       for several molecules, also concurrently in different threads.
     """
 
     def __init__(self):
-        self.hessian_small = None
-        self.mass_matrix_small = None
-        self.transform = None
-        self.num_zeros = None
-        self.external_basis = None
+        pass
 
     def __call__(self, molecule, do_modes):
         """Calls compute_hessian and compute_zeros (in order) with same arguments
@@ -514,9 +1617,31 @@ class Treatment(object):
             | ``molecule`` -- a Molecule instance
             | ``do_modes`` -- a boolean indicates whether the modes have to be
                               computed
+
+           Returns: a TreatmentResult instance.
+
+           The compute methods store their results as attributes. They are
+           called on a private shallow copy of the treatment, such that the
+           treatment itself does not carry any per-molecule state.
         """
-        self.compute_hessian(molecule, do_modes)
-        self.compute_zeros(molecule, do_modes)
+        self.check_molecule(molecule)
+        work = copy.copy(self)
+        work.compute_hessian(molecule, do_modes)
+        work.compute_zeros(molecule, do_modes)
+        return TreatmentResult(*(
+            getattr(work, field, None) for field in TreatmentResult._fields
+        ))
+
+    def check_molecule(self, molecule):
+        """Raise a ValueError when the treatment can not be applied to the molecule
+
+           Argument:
+            | ``molecule`` -- a Molecule instance
+
+           By default, the Hessian of the molecule must be complete, i.e. the
+           attribute ``molecule.hessian_skipped`` must be None.
+        """
+        _check_hessian_skipped(molecule)
 
     def compute_hessian(self, molecule, do_modes):
         """To be computed in derived classes
@@ -607,13 +1732,14 @@ class Full(Treatment):
         The Hessian is the full 3Nx3N Hessian matrix ``H``.
         The mass matrix is the full 3Nx3N mass matrix ``M``.
         It is assumed that the coordinates are Cartesian coordinates, so the
-        mass matrix is diagonal.
+        mass matrix is diagonal. The mass-weighted Hessian is returned, such
+        that no mass matrix is needed.
         """
-        self.hessian_small = molecule.hessian
-        self.mass_matrix_small = MassMatrix(molecule.masses3)
+        self.hessian_small = MassMatrix(molecule.masses3).get_weighted_hessian(molecule.hessian)
         if do_modes:
             atom_division = AtomDivision([], np.arange(molecule.size), [])
             self.transform = Transform(None, atom_division)
+            self.transform.make_weighted(MassMatrix(molecule.masses3))
 
 
 class ConstrainExt(Treatment):
@@ -677,7 +1803,7 @@ class ConstrainExt(Treatment):
         rank = external_basis.shape[0]
         internal_basis_mw = (Vt[rank:]/np.sqrt(molecule.masses3)).transpose()
         # the following hessian is already mass-weighted;
-        self.hessian_small = np.dot(internal_basis_mw.transpose(), np.dot(molecule.hessian, internal_basis_mw))
+        self.hessian_small = np.dot(internal_basis_mw.transpose(), molecule.hessian.dot(internal_basis_mw))
         # we do not define mass_matrix_small since it is useless when the hessian
         # is already mass-weighted
         if do_modes:
@@ -718,6 +1844,14 @@ class PHVA(Treatment):
         self.svd_threshold = svd_threshold
         Treatment.__init__(self)
 
+    def check_molecule(self, molecule):
+        """See :meth:`Treatment.check_molecule`.
+
+           The Hessian blocks of the fixed atoms are not used, so they may be
+           missing.
+        """
+        _check_hessian_skipped(molecule, self.fixed)
+
     def compute_zeros(self, molecule, do_modes):
         """See :meth:`Treatment.compute_zeros`.
 
@@ -732,16 +1866,12 @@ class PHVA(Treatment):
         # TODO: this will fail if the molecule is displaced far from the origin
         # TODO: make it complicated and analyze the inertia tensor
         # TODO: make ext_dof a molecule property
-        U, W, Vt = np.linalg.svd(molecule.external_basis, full_matrices=False)
+        U, W, Vt = molecule.analysis_context.get_external_basis_svd()
         rank = (abs(W) > abs(W[0])*self.svd_threshold).sum()
         external_basis = Vt[:rank]
         # then project this basis on a subspace of the fixed atoms and try to
         # find linear combinations that do not move the fixed atoms.
-        fixed3 = []
-        for i in self.fixed:
-            fixed3.append(3*i)
-            fixed3.append(3*i+1)
-            fixed3.append(3*i+2)
+        fixed3 = _cartesian_indexes(self.fixed)
         system = external_basis[:,fixed3].transpose()
         # The homogenuous solutions of the system corresponds to remaining
         # degrees of freedom. The number of homogenuous solutions is equal to
@@ -749,9 +1879,10 @@ class PHVA(Treatment):
         U, W, Vt = np.linalg.svd(system, full_matrices=False)
         self.num_zeros = (abs(W) < abs(W[0])*self.svd_threshold).sum()
         if do_modes and self.num_zeros > 0:
-            # TODO: fix this
-            #self.exernal_basis = ...
-            raise NotImplementedError
+            # the homogeneous solutions combine the external basis vectors
+            # into motions that leave the fixed atoms in place.
+            self.external_basis = np.dot(Vt[-self.num_zeros:], external_basis)
+            self.external_basis[:,fixed3] = 0.0
 
     def compute_hessian(self, molecule, do_modes):
         """See :meth:`Treatment.compute_hessian`.
@@ -764,21 +1895,10 @@ class PHVA(Treatment):
         So it is a diagonal matrix with the masses of the non-fixed atoms on
         the diagonal.
         """
-        free = np.zeros(molecule.size - len(self.fixed), int)
-        free3 = np.zeros(len(free)*3, int)
-        counter_fixed = 0
-        counter_free = 0
-        for i in xrange(molecule.size):
-            if counter_fixed < len(self.fixed) and self.fixed[counter_fixed] == i:
-                counter_fixed += 1
-            else:
-                free[counter_free] = i
-                free3[counter_free*3] = i*3
-                free3[counter_free*3+1] = i*3+1
-                free3[counter_free*3+2] = i*3+2
-                counter_free += 1
-
-        self.hessian_small = molecule.hessian[free3][:,free3]
+        # Only the rows and columns of the free atoms are read. When the free
+        # atoms are contiguous, the reduced Hessian is a view on the full one.
+        free, fixed3, free3 = _split_subsystem(molecule.size, self.fixed)
+        self.hessian_small = _submatrix(molecule.hessian, free3, free3)
         masses3_small = molecule.masses3[free3]
         self.mass_matrix_small = MassMatrix(masses3_small)
         if do_modes:
@@ -801,15 +1921,20 @@ class VSA(Treatment):
     atoms are allowed to vibrate, while the environment atoms follow the motions
     of the subsystem atoms. The environment atoms are force free.
     """
-    def __init__(self, subs, svd_threshold=1e-5):
+    def __init__(self, subs, svd_threshold=1e-5, sparse=None):
         """
            One argument:
             | ``subs`` -- a list with the subsystem atoms, counting starts from
                           zero.
 
-           Optional argument:
+           Optional arguments:
             | ``svd_threshold`` -- threshold for detection of deviations for
                                    linearity
+            | ``sparse`` -- when True, the environment block of the Hessian is
+                            factorized with a sparse LU decomposition, when
+                            False with a dense Cholesky (or LDL^T)
+                            decomposition. The default (None) follows the
+                            storage of the Hessian of the molecule.
         """
         # QA:
         if len(subs) == 0:
@@ -818,6 +1943,7 @@ class VSA(Treatment):
         self.subs = np.array(subs)
         #self.subs.sort()
         self.svd_threshold = svd_threshold
+        self.sparse = sparse
         Treatment.__init__(self)
 
     def compute_zeros(self, molecule, do_modes):
@@ -831,7 +1957,7 @@ class VSA(Treatment):
         - 3 in periodic calculations
         """
         # determine nb of zeros
-        subs3 = sum([[3*at, 3*at+1, 3*at+2] for at in self.subs],[])
+        subs3 = (3*self.subs.reshape((-1,1)) + np.arange(3)).ravel()
         U, W, Vt = np.linalg.svd(np.take(molecule.external_basis,subs3,1), full_matrices=False)
         rank = (abs(W) > abs(W[0])*self.svd_threshold).sum()
         self.num_zeros = rank
@@ -875,28 +2001,19 @@ class VSA(Treatment):
         where the indices ``s`` and ``e`` refer to the subsystem and environment
         atoms respectively.
         """
-        # fill lists with subsystem/environment atoms/coordinates
-        subs = self.subs.tolist()
-        envi = sum([[at] for at in xrange(molecule.size) if at not in subs],[])
-        subs3 = sum([[3*at, 3*at+1, 3*at+2] for at in subs],[])
-        envi3 = sum([[3*at, 3*at+1, 3*at+2] for at in xrange(molecule.size) if at not in subs],[])
+        # fill arrays with subsystem/environment atoms/coordinates
+        envi, subs3, envi3 = _split_subsystem(molecule.size, self.subs)
 
         # 1. Construct Hessian (small: 3Nsubs x 3Nsubs)
-        # construct H_ss, H_ee, H_es
-        hessian_ss = np.take(np.take(molecule.hessian,subs3,0), subs3,1)
-        hessian_ee = np.take(np.take(molecule.hessian,envi3,0), envi3,1)
-        hessian_es = np.take(np.take(molecule.hessian,envi3,0), subs3,1)
-        # construct H_ee**-1 and H_ee**-1 . H_es
-        hessian_e1 = np.linalg.inv(hessian_ee)
-        hessian_e1_es = np.dot(hessian_e1,hessian_es)
-        # construct H_ss - H_se . H_ee**-1 . H_es
-        self.hessian_small = hessian_ss - np.dot( hessian_es.transpose(), hessian_e1_es)
+        # construct H_ss - H_se . H_ee**-1 . H_es and H_ee**-1 . H_es with
+        # a single factorization of H_ee
+        self.hessian_small, hessian_e1_es = molecule.analysis_context.get_schur_complement(
+            subs3, envi3, self.sparse)
 
         # 2. Construct mass matrix (small: 3Nsubs x 3Nsubs)
         # with corrected mass matrix
         masses3_subs = molecule.masses3[subs3]               # masses subsystem
         masses3_envi = molecule.masses3[envi3]               # masses environment
-        tempmat = np.zeros((len(envi3),len(subs3)),float) # temporary matrix
 
         # construct   M_e . H_ee**-1 . H_es
         tempmat = masses3_envi.reshape((-1,1))*hessian_e1_es
@@ -908,7 +2025,7 @@ class VSA(Treatment):
         self.mass_matrix_small = MassMatrix( massmatrixsmall )
 
         if do_modes:
-            atom_division = AtomDivision(envi+subs,[],[])
+            atom_division = AtomDivision(np.concatenate((envi, self.subs)),[],[])
             self.transform = Transform( np.concatenate( (- hessian_e1_es, np.identity(len(subs3))),0), atom_division)
 
 
@@ -932,15 +2049,20 @@ class VSANoMass(Treatment):
     This version of VSA corresponds to the approximation
     of zero mass for all environment atoms.
     """
-    def __init__(self, subs, svd_threshold=1e-5):
+    def __init__(self, subs, svd_threshold=1e-5, sparse=None):
         """
            One argument:
             | ``subs`` -- a list with the subsystem atoms, counting starts from
                           zero.
 
-           Optional argument:
+           Optional arguments:
             | ``svd_threshold`` -- threshold for detection of deviations for
                                    linearity
+            | ``sparse`` -- when True, the environment block of the Hessian is
+                            factorized with a sparse LU decomposition, when
+                            False with a dense Cholesky (or LDL^T)
+                            decomposition. The default (None) follows the
+                            storage of the Hessian of the molecule.
         """
         # QA:
         if len(subs) == 0:
@@ -949,6 +2071,7 @@ class VSANoMass(Treatment):
         self.subs = np.array(subs)
         #self.subs.sort()
         self.svd_threshold = svd_threshold
+        self.sparse = sparse
         Treatment.__init__(self)
 
     def compute_zeros(self, molecule, do_modes):
@@ -963,7 +2086,7 @@ class VSANoMass(Treatment):
         - 3 in periodic calculations
         """
         # determine nb of zeros
-        subs3 = sum([[3*at, 3*at+1, 3*at+2] for at in self.subs],[])
+        subs3 = (3*self.subs.reshape((-1,1)) + np.arange(3)).ravel()
         U, W, Vt = np.linalg.svd(np.take(molecule.external_basis,subs3,1), full_matrices=False)
         rank = (abs(W) > abs(W[0])*self.svd_threshold).sum()
         self.num_zeros = rank
@@ -1007,29 +2130,21 @@ class VSANoMass(Treatment):
         where the indices ``s`` and ``e`` refer to the subsystem and environment
         atoms respectively.
         """
-        # fill lists with subsystem/environment atoms/coordinates
-        subs = self.subs.tolist()
-        envi = sum([[at] for at in xrange(molecule.size) if at not in subs],[])
-        subs3 = sum([[3*at, 3*at+1, 3*at+2] for at in subs],[])
-        envi3 = sum([[3*at, 3*at+1, 3*at+2] for at in xrange(molecule.size) if at not in subs],[])
+        # fill arrays with subsystem/environment atoms/coordinates
+        envi, subs3, envi3 = _split_subsystem(molecule.size, self.subs)
 
         # 1. Construct Hessian (small: 3Nsubs x 3Nsubs)
-        # construct H_ss, H_ee, H_es
-        hessian_ss = np.take(np.take(molecule.hessian,subs3,0), subs3,1)
-        hessian_ee = np.take(np.take(molecule.hessian,envi3,0), envi3,1)
-        hessian_es = np.take(np.take(molecule.hessian,envi3,0), subs3,1)
-        # construct H_ee**-1 and H_ee**-1 . H_es
-        hessian_e1 = np.linalg.inv(hessian_ee)
-        hessian_e1_es = np.dot(hessian_e1,hessian_es)
-        # construct H_ss - H_se . H_ee**-1 . H_es
-        self.hessian_small = hessian_ss - np.dot( hessian_es.transpose(), hessian_e1_es)
+        # construct H_ss - H_se . H_ee**-1 . H_es and H_ee**-1 . H_es with
+        # a single factorization of H_ee
+        self.hessian_small, hessian_e1_es = molecule.analysis_context.get_schur_complement(
+            subs3, envi3, self.sparse)
 
         # 2. Construct mass matrix (small: 3Nsubs x 3Nsubs)
         # with plain submatrix M_s
         self.mass_matrix_small = MassMatrix( np.diag(np.take(molecule.masses3,subs3)) )
 
         if do_modes:
-            atom_division = AtomDivision(envi+subs,[],[])
+            atom_division = AtomDivision(np.concatenate((envi, self.subs)),[],[])
             self.transform = Transform( np.concatenate( (- hessian_e1_es, np.identity(len(subs3))),0), atom_division)
 
 
@@ -1151,7 +2266,7 @@ class MBH(Treatment):
         #    self.external_basis = Vt[:rank]
 
 
-    def compute_hessian(self, molecule, do_modes):
+    def compute_hessian(self, molecule, do_modes, blocks=None):
         """See :meth:`Treatment.compute_hessian`.
 
         Gather all information about the block choice in the
@@ -1170,20 +2285,42 @@ class MBH(Treatment):
         reads: ``Hy = nullspace^T Hp nullspace + Gp:Cp``. The term ``Gp:Cp``
         is the gradient correction. The Mobile Block mass matrix is equal to:
         ``My = nullspace^T Mp nullspace``.
+
+        The optional argument blocks replaces the blocks given to the
+        constructor. It is used by PHVA_MBH, where the atoms in the blocks are
+        renumbered for a submolecule.
         """
+        if blocks is None:
+            blocks = self.blocks
         # Notation: b,b0,b1   --  a block index
         #           block  --  a list of atoms, e.g. [at1,at4,at6]
         #           alphas  --  the 6 block parameter indices (or 5 for linear block)
 
-        # Block information
-        blkinfo = Blocks(self.blocks, molecule, self.svd_threshold)
-        mbhdim1 = 6*blkinfo.nb_nlin + 5*blkinfo.nb_lin + 3*len(blkinfo.free)
-
-        # TRANSFORM from CARTESIAN to BLOCK PARAMETERS
-        U = self._construct_U(molecule,mbhdim1,blkinfo)
+        # The block information, the transformation U and the block products
+        # U**T . H . U and U**T . M . U only depend on the block choice. They
+        # are shared by all analyses of the same molecule with the same blocks.
+        # None of these depend on the masses.
+        def compute():
+            # Block information
+            blkinfo = Blocks(blocks, molecule, self.svd_threshold)
+            mbhdim1 = 6*blkinfo.nb_nlin + 5*blkinfo.nb_lin + 3*len(blkinfo.free)
+            # TRANSFORM from CARTESIAN to BLOCK PARAMETERS
+            U = self._construct_U(molecule,mbhdim1,blkinfo)
+            # U is sparse, such that only the nonzero atom blocks of H contribute.
+            UHU = _congruence(U, molecule.hessian)
+            if blkinfo.is_linked:
+                # SECOND TRANSFORM: from BLOCK PARAMETERS to Y VARIABLES
+                # Necessary if blocks are linked to each other.
+                nullspace = self._construct_nullspace_K(molecule,mbhdim1,blkinfo)
+            else:
+                nullspace = None
+            return blkinfo, mbhdim1, U, UHU, nullspace
+        key = ("mbh", tuple(tuple(block) for block in blocks), self.svd_threshold)
+        blkinfo, mbhdim1, U, UHU, nullspace = molecule.analysis_context.get(
+            key, compute, mass_independent=True)
 
         # Construct Hessian in block parameters: Hp = U**T . H . U + correction
-        Hp = np.dot(np.dot( U.transpose(), molecule.hessian) , U)
+        Hp = UHU.copy()
 
         # gradient correction
         if self.do_gradient_correction:
@@ -1222,15 +2359,13 @@ class MBH(Treatment):
                 Hp[col:(col+dim),col:(col+dim)] += np.take(np.take(corr,alphas,0),alphas,1)
 
         # Construct mass matrix in block parameters: Mp = U**T . M . U
-        Mp = np.dot(U.transpose(),  U * molecule.masses3.reshape((-1,1)))
+        from scipy.sparse import diags
+        Mp = _congruence(U, diags(molecule.masses3))
 
         if blkinfo.is_linked:
             # SECOND TRANSFORM: from BLOCK PARAMETERS to Y VARIABLES
-            # Necessary if blocks are linked to each other.
-            nullspace = self._construct_nullspace_K(molecule,mbhdim1,blkinfo)
-
-            My = np.dot(nullspace.transpose(), np.dot( Mp,nullspace) )
-            Hy = np.dot(nullspace.transpose(), np.dot( Hp,nullspace) )
+            My = _congruence(nullspace, Mp)
+            Hy = _congruence(nullspace, Hp)
 
             # TODO
             # gradient correction of the second transform...
@@ -1244,7 +2379,7 @@ class MBH(Treatment):
             else:
                 self.hessian_small = Hy
                 self.mass_matrix_small = MassMatrix(My)
-                self.transform = Transform(np.dot(U, nullspace))
+                self.transform = Transform(U.dot(nullspace))
         else:
             if not blkinfo.is_linked:
                 self.hessian_small = Hp
@@ -1254,84 +2389,214 @@ class MBH(Treatment):
                 self.mass_matrix_small = MassMatrix(My)
 
     def _construct_U(self,molecule,mbhdim1,blkinfo):
-        # Construct first transformation matrix
-        D = transrot_basis(molecule.coordinates)   # is NOT mass-weighted
-
-        U = np.zeros((3*molecule.size, mbhdim1),float)
-
-        for b,block in enumerate(blkinfo.blocks_nlin_strict):
-            for at in block:
-                for alpha in range(6):
-                    U[3*at:3*(at+1), 6*b+alpha] = D[alpha,3*at:3*(at+1)]
-
-        for b,block in enumerate(blkinfo.blocks_lin_strict):
-            for at in block:
-                alphas = [index for index in range(6) if index != blkinfo.skip_axis_lin[b]]
-                for i,alpha in enumerate(alphas):
-                    col = 6*blkinfo.nb_nlin + 5*b + i
-                    U[3*at:3*(at+1), col] = D[alpha,3*at:3*(at+1)]
+        """Construct the transformation from block parameters to Cartesian
+           coordinates.
 
-        for i,at in enumerate(blkinfo.free):
-            for mu in range(3):
-                U[3*at+mu, 6*blkinfo.nb_nlin+5*blkinfo.nb_lin+3*i +mu] = 1.0
-        return U
+           In the strict partitioning, each atom only moves with the parameters
+           of its own block. U is therefore a sparse (CSR) matrix with one
+           3 x dim block per atom, where dim is 6 (nonlinear block), 5 (linear
+           block) or 3 (free atom).
+        """
+        from scipy.sparse import coo_matrix
+        # is NOT mass-weighted, D[alpha, atom, mu]
+        D = transrot_basis(molecule.coordinates).reshape((6, molecule.size, 3))
+        rows = []
+        cols = []
+        vals = []
+
+        def add_blocks(blocks, first_col, alphas):
+            # alphas[b] are the block parameters of block b
+            if len(blocks) == 0:
+                return
+            atoms = np.concatenate([np.array(block, int) for block in blocks])
+            b = np.repeat(np.arange(len(blocks)), [len(block) for block in blocks])
+            dim = alphas.shape[1]
+            mu = np.arange(3)
+            rows.append(np.repeat(3*atoms[:,None] + mu, dim, axis=1).reshape(-1, 3, dim))
+            cols.append(np.repeat((first_col + dim*b[:,None] + np.arange(dim))[:,None,:], 3, axis=1))
+            vals.append(D[alphas[b][:,None,:], atoms[:,None,None], mu[None,:,None]])
+
+        add_blocks(blkinfo.blocks_nlin_strict, 0,
+                   np.tile(np.arange(6), (blkinfo.nb_nlin, 1)))
+        alphas_lin = np.array([
+            [alpha for alpha in range(6) if alpha != skip]
+            for skip in blkinfo.skip_axis_lin
+        ], int).reshape((-1, 5))
+        add_blocks(blkinfo.blocks_lin_strict, 6*blkinfo.nb_nlin, alphas_lin)
+
+        if len(blkinfo.free) > 0:
+            free = np.array(blkinfo.free, int)
+            offset = 6*blkinfo.nb_nlin + 5*blkinfo.nb_lin
+            rows.append(3*free[:,None] + np.arange(3))
+            cols.append(offset + 3*np.arange(len(free))[:,None] + np.arange(3))
+            vals.append(np.ones((len(free), 3), float))
+
+        if len(rows) == 0:
+            rows = cols = np.zeros(0, int)
+            vals = np.zeros(0, float)
+        else:
+            rows = np.concatenate([r.ravel() for r in rows])
+            cols = np.concatenate([c.ravel() for c in cols])
+            vals = np.concatenate([v.ravel() for v in vals])
+        return coo_matrix((vals, (rows, cols)), shape=(3*molecule.size, mbhdim1)).tocsr()
 
     def _construct_nullspace_K(self,molecule,mbhdim1,blkinfo):
+        """Construct a basis for the nullspace of the linkage constraints.
+
+           Each atom that is shared by two blocks imposes three constraints:
+           the displacement of the atom must be the same in both blocks. The
+           constraints are eliminated locally along a spanning tree of the
+           graph of linked blocks. The root of each tree keeps its block
+           parameters as variables. For each tree link, the first shared atom
+           fixes the translation of the child block, because the translation
+           rows of D are the identity. The rotations of the child become new
+           variables, unless they are constrained by other shared atoms, which
+           only requires a small dense step. Finally, the links that close a
+           cycle are imposed with an SVD restricted to the variables they
+           involve.
+
+           The basis is not orthonormal, which is not needed because it only
+           enters congruence transformations. The result is a sparse (CSR)
+           matrix, including an identity block for the free atoms.
+        """
+        from scipy.sparse import coo_matrix, identity
+        from collections import deque
         # SECOND TRANSFORM: from BLOCK PARAMETERS to Y VARIABLES
         # Necessary if blocks are linked to each other.
-        # Construct K matrix, with constraints
-        D = transrot_basis(molecule.coordinates)   # is NOT mass-weighted
-        nbrows = (np.sum(blkinfo.sharenbs)-molecule.size)*3
-        K = np.zeros(( nbrows, mbhdim1-3*len(blkinfo.free)), float)
-        row = 0
-        for (at,apps) in blkinfo.appearances.iteritems():
-            if len(apps) >= 2:
-                # the first block
-                b0 = apps[0]
-                D0 = D[:,3*at:3*(at+1)]
-
-                if b0 < blkinfo.nb_nlin:  # if b0 is nonlinear block
-                    sta0 = 6*b0
-                    end0 = 6*(b0+1)
-                    D0 = D[:,3*at:3*(at+1)]
-
-                else:   # if b0 is a linear block
-                    b0 = b0 - blkinfo.nb_nlin     # reset
-                    sta0 = 6*blkinfo.nb_nlin + 5*b0       # offset
-                    end0 = 6*blkinfo.nb_nlin + 5*(b0+1)
-                    alphas = [index for index in range(6) if index != blkinfo.skip_axis_lin[b0]]
-                    D0 = np.take(D[:,3*at:3*(at+1)],alphas,0)
-
-                for b1 in apps[1:]:
-                    # add 3 rows to K, for each block connected to b0
-                    K[row:row+3, sta0:end0] = D0.transpose()
-
-                    if b1 < blkinfo.nb_nlin:  # if b1 is nonlinear block
-                        sta1 = 6*b1
-                        end1 = 6*(b1+1)
-                        D1 = D[:,3*at:3*(at+1)]
-
-                    else:   # if b1 is a linear block
-                        b1 = b1 - blkinfo.nb_nlin     # reset
-                        sta1 = 6*blkinfo.nb_nlin + 5*b1       # offset
-                        end1 = 6*blkinfo.nb_nlin + 5*(b1+1)
-                        alphas = [index for index in range(6) if index != blkinfo.skip_axis_lin[b1]]
-                        D1 = np.take(D[:,3*at:3*(at+1)],alphas,0)
-
-                    K[row:row+3,sta1:end1] = -D1.transpose()
-                    row += 3
-
-        # Do SVD of matrix K
-        u,s,vh = np.linalg.svd(K)
-
-        # construct nullspace of K
-        rank = sum(s>max(s)*self.svd_threshold)
-        nullspace = vh[rank:,:].transpose()
-        [r_null,c_null] = nullspace.shape
-        n = np.zeros((mbhdim1,c_null+3*len(blkinfo.free)),float)
-        n[:r_null,:c_null] = nullspace
-        n[r_null:,c_null:] = np.identity(3*len(blkinfo.free),float)
-        return n
+        D = transrot_basis(molecule.coordinates).reshape((6, molecule.size, 3))   # is NOT mass-weighted
+        nblocks = blkinfo.nb_nlin + blkinfo.nb_lin
+        ncols = mbhdim1-3*len(blkinfo.free)
+
+        # the block parameters (alphas) and their first column
+        alphas = []
+        first_cols = []
+        for b in xrange(nblocks):
+            if b < blkinfo.nb_nlin:
+                alphas.append(np.arange(6))
+                first_cols.append(6*b)
+            else:
+                skip = blkinfo.skip_axis_lin[b-blkinfo.nb_nlin]
+                alphas.append(np.array([index for index in range(6) if index != skip]))
+                first_cols.append(6*blkinfo.nb_nlin + 5*(b-blkinfo.nb_nlin))
+
+        def motion(b, atoms):
+            # the displacements of the atoms due to the parameters of block b,
+            # a (3*len(atoms) x dim) matrix
+            return D[alphas[b]][:,atoms].reshape((len(alphas[b]), -1)).transpose()
+
+        def nullspace_svd(M, rhs=None):
+            # particular solution of M.x = rhs and a basis for the nullspace of M
+            u, s, vh = np.linalg.svd(M)
+            rank = 0 if len(s) == 0 else sum(s>max(s)*self.svd_threshold)
+            if rhs is None:
+                return vh[rank:].transpose()
+            x = np.dot(vh[:rank].transpose(), np.dot(u[:,:rank].transpose(), rhs)/s[:rank,None])
+            return x, vh[rank:].transpose()
+
+        # the shared atoms of each pair of linked blocks
+        shared = {}
+        for at, apps in sorted(blkinfo.appearances.iteritems()):
+            for b1 in apps[1:]:
+                shared.setdefault((apps[0], b1), []).append(at)
+        neighbors = [[] for b in xrange(nblocks)]
+        for b0, b1 in sorted(shared):
+            neighbors[b0].append(b1)
+            neighbors[b1].append(b0)
+
+        # params[b] = (variables, matrix): the parameters of block b are
+        # matrix . y[variables], where y are the new variables.
+        params = [None]*nblocks
+        done = set([])
+        cycles = []
+        counter = 0
+        for root in xrange(nblocks):
+            if params[root] is not None:
+                continue
+            dim = len(alphas[root])
+            params[root] = (counter + np.arange(dim), np.identity(dim))
+            counter += dim
+            queue = deque([root])
+            while len(queue) > 0:
+                parent = queue.popleft()
+                for child in neighbors[parent]:
+                    key = (min(parent, child), max(parent, child))
+                    if key in done:
+                        continue
+                    done.add(key)
+                    if params[child] is not None:
+                        cycles.append(key)
+                        continue
+                    atoms = shared[key]
+                    pvars, pmat = params[parent]
+                    target = np.dot(motion(parent, atoms), pmat)
+                    # The first shared atom fixes the translation of the child,
+                    # the rotations of the child are the new variables w:
+                    # translation = target - R.w
+                    dim = len(alphas[child])
+                    rot = motion(child, atoms)[:,3:]
+                    B = np.zeros((dim, len(pvars)), float)
+                    B[:3] = target[:3]
+                    G = np.zeros((dim, dim-3), float)
+                    G[:3] = -rot[:3]
+                    G[3:] = np.identity(dim-3)
+                    if len(atoms) > 1:
+                        # the other shared atoms constrain the rotations
+                        rest = motion(child, atoms[1:])
+                        x, Z = nullspace_svd(np.dot(rest, G), target[3:] - np.dot(rest, B))
+                        B += np.dot(G, x)
+                        G = np.dot(G, Z)
+                    params[child] = (
+                        np.concatenate([pvars, counter + np.arange(G.shape[1])]),
+                        np.concatenate([B, G], axis=1),
+                    )
+                    counter += G.shape[1]
+                    queue.append(child)
+
+        # The block parameters in terms of the variables.
+        n_rows = []
+        n_cols = []
+        n_vals = []
+        for b in xrange(nblocks):
+            variables, matrix = params[b]
+            n_rows.append(np.repeat(first_cols[b] + np.arange(len(alphas[b])), len(variables)))
+            n_cols.append(np.tile(variables, len(alphas[b])))
+            n_vals.append(matrix.ravel())
+        nullspace = coo_matrix(
+            (np.concatenate(n_vals), (np.concatenate(n_rows), np.concatenate(n_cols))),
+            shape=(ncols, counter)
+        ).tocsr()
+
+        if len(cycles) > 0:
+            # Impose the links that close a cycle, only for the variables they
+            # involve.
+            rows = []
+            for b0, b1 in cycles:
+                atoms = shared[(b0, b1)]
+                row = np.zeros((3*len(atoms), counter), float)
+                row[:,params[b0][0]] += np.dot(motion(b0, atoms), params[b0][1])
+                row[:,params[b1][0]] -= np.dot(motion(b1, atoms), params[b1][1])
+                rows.append(row)
+            K = np.concatenate(rows)
+            involved = (abs(K).max(axis=0) > 0).nonzero()[0]
+            others = (abs(K).max(axis=0) == 0).nonzero()[0]
+            Z = nullspace_svd(K[:,involved])
+            z_rows = np.concatenate([others, np.repeat(involved, Z.shape[1])])
+            z_cols = np.concatenate([
+                np.arange(len(others)),
+                np.tile(len(others) + np.arange(Z.shape[1]), len(involved)),
+            ])
+            z_vals = np.concatenate([np.ones(len(others)), Z.ravel()])
+            nullspace = nullspace*coo_matrix(
+                (z_vals, (z_rows, z_cols)), shape=(counter, len(others)+Z.shape[1])
+            ).tocsr()
+
+        # the free atoms are not affected
+        nfree3 = 3*len(blkinfo.free)
+        if nfree3 > 0:
+            from scipy.sparse import block_diag
+            nullspace = block_diag([nullspace, identity(nfree3)], format="csr")
+        nullspace.eliminate_zeros()
+        return nullspace.tocsr()
 
 
 class MBHConstrainExt(MBH):
@@ -1351,16 +2616,22 @@ class MBHConstrainExt(MBH):
 
     def compute_hessian(self, molecule, do_modes):
         # perform projection of Hessian and gradient
-        D = transrot_basis(molecule.coordinates, rot=molecule.periodic).transpose()
-        for i in range(D.shape[1]):
-            D[:,i] /= np.sqrt(np.sum(D[:,i]**2))
-        proj = np.identity(D.shape[0]) - np.dot(D,D.transpose())
-        hessian = np.dot(proj,molecule.hessian)
-        gradient = (np.dot(proj,molecule.gradient.reshape(3*molecule.size,-1))).reshape(molecule.size,3)
-        # construct a new Molecule instance
-        mol = Molecule(molecule.numbers, molecule.coordinates, molecule.masses,
-                       molecule.energy, gradient, hessian, molecule.multiplicity,
-                       periodic=molecule.periodic)
+        def compute(molecule):
+            D = transrot_basis(molecule.coordinates, rot=molecule.periodic).transpose()
+            for i in range(D.shape[1]):
+                D[:,i] /= np.sqrt(np.sum(D[:,i]**2))
+            # apply proj = I - D.D^T from the left as a rank-k update, without
+            # forming the dense 3Nx3N projector
+            hessian = low_rank_project(molecule.hessian, D, D, right=False)
+            gradient = molecule.gradient.ravel()
+            gradient = (gradient - np.dot(D, np.dot(D.transpose(), gradient))).reshape(molecule.size,3)
+            # construct a new Molecule instance
+            return Molecule(molecule.numbers, molecule.coordinates, molecule.masses,
+                            molecule.energy, gradient, hessian, molecule.multiplicity,
+                            periodic=molecule.periodic)
+        # the projected molecule is cached, such that also its own analysis
+        # context is reused.
+        mol = molecule.analysis_context.get_derived_molecule(("mbh_constrain_ext_molecule",), compute)
         # do the usual MBH
         MBH.compute_hessian(self,mol,do_modes)
 
@@ -1378,6 +2649,8 @@ class Blocks(object):
          | ``svd_trheshold`` -- threshold for zero singular values in svd
         """
         N = molecule.size
+        # work on a copy, the blocks of the treatment are not modified
+        blocks = [list(block) for block in blocks]
         # check for empty blocks and single-atom-blocks
         to_remove = []
         for b,block in enumerate(blocks):
@@ -1536,24 +2809,29 @@ class PHVA_MBH(MBH):
         self.fixed = np.array(fixed)
         MBH.__init__(self, blocks, do_gradient_correction=do_gradient_correction, svd_threshold=svd_threshold)
 
+    def check_molecule(self, molecule):
+        """See :meth:`Treatment.check_molecule`.
+
+           The Hessian blocks of the fixed atoms are not used, so they may be
+           missing.
+        """
+        _check_hessian_skipped(molecule, self.fixed)
+
     def compute_zeros(self, molecule, do_modes):
         """See :meth:`Treatment.compute_zeros`"""
         # [ See explanation PHVA ]
-        U, W, Vt = np.linalg.svd(molecule.external_basis, full_matrices=False)
+        U, W, Vt = molecule.analysis_context.get_external_basis_svd()
         rank = (abs(W) > abs(W[0])*self.svd_threshold).sum()
         external_basis = Vt[:rank]
-        fixed3 = []
-        for i in self.fixed:
-            fixed3.append(3*i)
-            fixed3.append(3*i+1)
-            fixed3.append(3*i+2)
+        fixed3 = _cartesian_indexes(self.fixed)
         system = external_basis[:,fixed3].transpose()
         U, W, Vt = np.linalg.svd(system, full_matrices=False)
         self.num_zeros = (abs(W) < abs(W[0])*self.svd_threshold).sum()
         if do_modes and self.num_zeros > 0:
-            # TODO: fix this
-            #self.exernal_basis = ...
-            raise NotImplementedError
+            # the homogeneous solutions combine the external basis vectors
+            # into motions that leave the fixed atoms in place.
+            self.external_basis = np.dot(Vt[-self.num_zeros:], external_basis)
+            self.external_basis[:,fixed3] = 0.0
 
     def compute_hessian(self, molecule,do_modes):
         """See :meth:`Treatment.compute_hessian`.
@@ -1565,35 +2843,45 @@ class PHVA_MBH(MBH):
         """
 
         # Make submolecule
-        selectedatoms = [at for at in xrange(molecule.size) if at not in self.fixed]
-        selectedcoords = sum([[3*at,3*at+1,3*at+2] for at in selectedatoms],[])
-
-        from tamkin.data import Molecule
-        submolecule = Molecule(
-            np.take(molecule.numbers, selectedatoms),
-            np.take(molecule.coordinates, selectedatoms, 0),
-            np.take(molecule.masses, selectedatoms),
-            molecule.energy,
-            np.take(molecule.gradient,selectedatoms,0),
-            np.take(np.take(molecule.hessian,selectedcoords,0),selectedcoords,1),
-            molecule.multiplicity,
-            0, # undefined molecule.symmetry_number
-            molecule.periodic
+        selectedatoms, fixedcoords, selectedcoords = _split_subsystem(molecule.size, self.fixed)
+
+        # the submolecule is cached, such that also its own analysis context
+        # is reused.
+        submolecule = molecule.analysis_context.get_derived_molecule(
+            ("phva_mbh_submolecule", tuple(self.fixed)),
+            lambda molecule: Molecule(
+                np.take(molecule.numbers, selectedatoms),
+                np.take(molecule.coordinates, selectedatoms, 0),
+                np.take(molecule.masses, selectedatoms),
+                molecule.energy,
+                np.take(molecule.gradient,selectedatoms,0),
+                _submatrix(molecule.hessian, selectedcoords, selectedcoords),
+                molecule.multiplicity,
+                0, # undefined molecule.symmetry_number
+                molecule.periodic
+            )
         )
 
-        # adapt numbering in blocks
+        # adapt numbering in blocks, without modifying self.blocks
         shifts = np.zeros((molecule.size),int)
         for fixat in self.fixed:
             shifts[fixat:] = shifts[fixat:]+1
-        for bl,block in enumerate(self.blocks):
-            for at,atom in enumerate(block):
-                self.blocks[bl][at] = atom - shifts[atom]
+        blocks = [[atom - shifts[atom] for atom in block] for block in self.blocks]
 
-        MBH.compute_hessian(self, submolecule, do_modes)
+        MBH.compute_hessian(self, submolecule, do_modes, blocks)
 
         if do_modes:   # adapt self.transform to include the fixed atom rows/cols
-            transf = np.zeros((3*molecule.size, self.transform.matrix.shape[1]),float)
-            transf[selectedcoords,:] = self.transform.matrix
+            matrix = self.transform.matrix
+            if _issparse(matrix):
+                from scipy.sparse import coo_matrix
+                matrix = matrix.tocoo()
+                transf = coo_matrix(
+                    (matrix.data, (np.array(selectedcoords)[matrix.row], matrix.col)),
+                    shape=(3*molecule.size, matrix.shape[1])
+                ).tocsr()
+            else:
+                transf = np.zeros((3*molecule.size, matrix.shape[1]),float)
+                transf[selectedcoords,:] = matrix
             self.transform = Transform(transf)
 
 
@@ -1601,9 +2889,8 @@ class Constrain(Treatment):
     """Perform a normal mode analysis where part of the internal coordinates are
        constrained to a fixed value.
 
-       The gradient corrections are taken into account correctly. At present, only
-       distance constraints are implemented. In principle, the routine can be
-       adapted to angle and dihedral angle constraints.
+       The gradient corrections are taken into account correctly. Distances,
+       bending angles and dihedral angles can be constrained.
     """
     def __init__(self, constraints, do_gradient_correction=True, svd_threshold=1e-5):
         """
@@ -1621,6 +2908,10 @@ class Constrain(Treatment):
         # QA:
         if len(constraints) == 0:
             raise ValueError("At least one constraint is required.")
+        for constraint in constraints:
+            if len(constraint) not in (2, 3, 4):
+                raise ValueError("A constraint must consist of two, three or "
+                    "four atoms, got %s." % (constraint,))
         # Rest of init:
         self.constraints = constraints
         self.do_gradient_correction = do_gradient_correction
@@ -1652,23 +2943,19 @@ class Constrain(Treatment):
         if do_modes:
             self.external_basis = Vt[:rank]
 
-
     def compute_hessian(self, molecule, do_modes):
         """See :meth:`Treatment.compute_hessian`"""
 
-        # make constraint matrix
-        constrmat = np.zeros((3*molecule.size,len(self.constraints)))
-        count = 0
-        for i,constraint in enumerate(self.constraints):
-            # constrain a distance
-            if len(constraint) == 2:
-                at1 = constraint[0]
-                at2 = constraint[1]
-                dist = np.sqrt(np.sum((molecule.coordinates[at1] - molecule.coordinates[at2])**2))
-                dist = 1.0
-                constrmat[3*at1:3*at1+3, count] = (molecule.coordinates[at1] - molecule.coordinates[at2])/dist
-                constrmat[3*at2:3*at2+3, count] = (molecule.coordinates[at2] - molecule.coordinates[at1])/dist
-                count += 1
+        # make constraint matrix, each column is the Cartesian gradient of one
+        # constraint.
+        derivatives = [
+            _constraint_derivatives(molecule.coordinates, constraint)
+            for constraint in self.constraints
+        ]
+        constrmat = np.zeros((molecule.size, 3, len(self.constraints)))
+        for count, (atoms, gradient, hessian) in enumerate(derivatives):
+            constrmat[atoms, :, count] += gradient
+        constrmat = constrmat.reshape((3*molecule.size, -1))
         # determine the orthogonal complement of the basis of small
         # displacements determined by the constraints.
         U, W, Vt = np.linalg.svd(constrmat.transpose(), full_matrices=True)
@@ -1678,58 +2965,77 @@ class Constrain(Treatment):
         # mass matrix small = nullspace^T . M . nullspace
         # hessian     small = nullspace^T . H . nullspace + gradient correction
         self.mass_matrix_small = MassMatrix(np.dot(nullspace.transpose(),nullspace * molecule.masses3.reshape((-1,1))) )
-        self.hessian_small     = np.dot(nullspace.transpose(), np.dot(molecule.hessian, nullspace))
+        self.hessian_small     = np.dot(nullspace.transpose(), molecule.hessian.dot(nullspace))
 
         # check if gradient is small enough in this complement: overlap with nullspace should be small enough
         # print  np.sum(np.dot(nullspace.transpose(), np.ravel(molecule.gradient))**2)
 
         if self.do_gradient_correction:
-            self._do_the_gradient_correction(constrmat.transpose(), U,W,Vt, rank, nullspace, molecule.gradient)
+            self._do_the_gradient_correction(derivatives, U, W, Vt, rank, nullspace, molecule.gradient)
 
         if do_modes:
             self.transform = Transform(nullspace)
 
+    def _do_the_gradient_correction(self, derivatives, u, s, vh, rank, nullspace, gradient):
+        """Add the curvature of the constraints to the small Hessian
+
+           The gradient is written as a linear combination of the constraint
+           gradients, ``g = K^T.mu``, in the least-squares sense. The
+           corrected Hessian is ``N^T.(H - sum_k mu_k Q_k).N``, where ``Q_k`` is
+           the Cartesian Hessian of constraint k and N is the nullspace.
 
-    def _do_the_gradient_correction(self, K,u,s,vh, rank, nullspace, gradient):
-
-        # GRADIENT CORRECTION
-        # construct generalized inverse L of K
-        # zero rows for free atoms not included in L
-
-        # construct generalized inverse
-        L = np.zeros((K.shape[1],K.shape[0]),float)
-        for i,sigma in enumerate(s[:rank]):
-           L[i,:] = 1/sigma*u[:,i]
-        L = np.dot(vh.transpose(),L)
-
-        # construct right hand side of the equation
-        Y = np.zeros((K.shape[0],len(self.hessian_small)**2))
-        y = np.zeros((K.shape[0],1))
-        count = 0
-        for i in xrange(len(self.hessian_small)):
-            for j in xrange(len(self.hessian_small)):
-                for k,constraint in enumerate(self.constraints):
-                    if len(constraint) == 2:
-                        at1 = constraint[0]
-                        at2 = constraint[1]
-                        dist = 1.0
-                        for a in range(3*at1,3*at1+3):
-                            y[k] += 2 * nullspace[a,i]*nullspace[a,j]/dist
-                        for b in range(3*at2,3*at2+3):
-                            y[k] += 2 * nullspace[b,i]*nullspace[b,j]/dist
-                        for (a,b) in zip(range(3*at1,3*at1+3),range(3*at2,3*at2+3)):
-                            y[k] -= 2 * nullspace[a,i]*nullspace[b,j]/dist
-
-                Y[:,count] = y[:,0]
-                count += 1
-
-        # solve equation
-        X = -np.dot(L, Y)
-
-        # apply correction
-        count = 0
-        for i in xrange(len(self.hessian_small)):
-            for j in xrange(len(self.hessian_small)):
-
-                self.hessian_small[i,j] += np.sum( np.ravel(gradient)*X[:,count] )
-                count += 1
+           Each ``Q_k`` only couples the two to four atoms of its constraint,
+           so only the corresponding rows of the nullspace enter the
+           correction. Constraints with the same number of atoms are stacked
+           and the sum over k is carried out as a single matrix product.
+        """
+        # least-squares multipliers through the generalized inverse of K
+        mu = np.dot(u[:,:rank], np.dot(vh[:rank], np.ravel(gradient))/s[:rank])
+
+        by_size = {}
+        for k, (atoms, grad, hessian) in enumerate(derivatives):
+            by_size.setdefault(len(atoms), []).append(k)
+        for size, ks in by_size.items():
+            # rows of the nullspace that belong to the atoms of each constraint
+            rows = 3*np.array([derivatives[k][0] for k in ks]).reshape((len(ks), size, 1)) + np.arange(3)
+            nrows = nullspace[rows.reshape((len(ks), 3*size))]
+            # mu-weighted constraint Hessians
+            weighted = np.array([derivatives[k][2].reshape((3*size, 3*size)) for k in ks])
+            weighted *= mu[ks].reshape((-1, 1, 1))
+            # sum_k nrows_k^T . weighted_k . nrows_k as one matrix product
+            tmp = np.einsum("kab,kbj->kaj", weighted, nrows)
+            self.hessian_small -= np.dot(
+                nrows.reshape((-1, nullspace.shape[1])).transpose(),
+                tmp.reshape((-1, nullspace.shape[1]))
+            )
+
+
+def _constraint_derivatives(coordinates, constraint):
+    """Return the atoms, Cartesian gradient and Hessian of a constraint
+
+       Arguments:
+        | ``coordinates`` -- the Cartesian coordinates of the molecule
+        | ``constraint`` -- a list of two, three or four atom indexes for a
+                            distance, a bending angle or a dihedral angle
+
+       The returned gradient has shape (n,3) and the Hessian has shape
+       (n,3,n,3), where n is the number of atoms in the constraint. A distance
+       constraint is expressed as half the squared distance.
+    """
+    atoms = np.array(constraint)
+    if len(atoms) == 2:
+        delta = coordinates[atoms[0]] - coordinates[atoms[1]]
+        gradient = np.array([delta, -delta])
+        hessian = np.zeros((2, 3, 2, 3), float)
+        hessian[0,:,0] = hessian[1,:,1] = np.identity(3)
+        hessian[0,:,1] = hessian[1,:,0] = -np.identity(3)
+    elif len(atoms) == 3:
+        from molmod.ic import bend_angle
+        value, gradient, hessian = bend_angle(coordinates[atoms], deriv=2)
+    elif len(atoms) == 4:
+        from molmod.ic import dihed_angle
+        value, gradient, hessian = dihed_angle(coordinates[atoms], deriv=2)
+    else:
+        raise ValueError("A constraint must consist of two, three or four "
+            "atoms, got %s." % (constraint,))
+    return atoms, gradient, hessian
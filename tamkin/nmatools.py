@@ -35,7 +35,7 @@
 """Tools for further investigation of a normal mode analysis"""
 
 from tamkin.data import Molecule
-from tamkin.nma import NMA
+from tamkin.nma import NMA, Modes
 from tamkin.io.charmm import load_peptide_info_charmm
 
 from molmod import lightspeed, angstrom, amu, centimeter
@@ -72,14 +72,20 @@ def compute_overlap(nma1, nma2, filename=None, unit="au"):
 
        1) an NMA object
        2) a tuple or list with two elements: modes and frequencies
-       3) a numpy array with the mass-weighted modes
+       3) a numpy array (or Modes object) with the mass-weighted modes
        4) a numpy array with one mass-weighted mode
+
+       Lazy modes (Modes objects) are never transformed all at once, the
+       overlap is computed in chunks of modes.
     """
 
     def parse_nma(nma):
         if isinstance(nma, NMA):
             # NMA object
             return nma.modes, nma.freqs
+        elif isinstance(nma, Modes):
+            # lazy modes only
+            return nma, np.zeros(nma.shape[1], float)
         elif hasattr(nma, "__len__") and len(nma) == 2 and not isinstance(nma, np.ndarray):
             # [modes,freqs] or (modes,freqs)
             return nma
@@ -99,7 +105,17 @@ def compute_overlap(nma1, nma2, filename=None, unit="au"):
     if modes1.shape[0] != modes2.shape[0] :
         raise ValueError("Length of columns in modes1 and modes2 should be equal, but found %i and %i." % (modes1.shape[0], modes2.shape[0]))
     # compute overlap
-    overlap = np.dot(np.transpose(modes1), modes2)
+    if isinstance(modes1, Modes):
+        modes2 = np.asarray(modes2)
+        overlap = np.concatenate([
+            np.dot(chunk.transpose(), modes2) for chunk in modes1.iter_chunks()
+        ])
+    elif isinstance(modes2, Modes):
+        overlap = np.concatenate([
+            np.dot(np.transpose(modes1), chunk) for chunk in modes2.iter_chunks()
+        ], axis=1)
+    else:
+        overlap = np.dot(np.transpose(modes1), modes2)
     if filename is not None:
         write_overlap(freqs1, freqs2, overlap, filename=filename, unit=unit)
     return overlap
@@ -530,7 +546,7 @@ def plot_spectrum_dos(filename, all_freqs, low=None, high=None, imax=None,
 
 
 def create_enm_molecule(molecule, selected=None, numbers=None, masses=None,
-                        rcut=8.0*angstrom, K=1.0, periodic=None):
+                        rcut=8.0*angstrom, K=1.0, periodic=None, sparse=False):
     """Create a molecule according to the Elastic Network Model
 
        Argument:
@@ -554,6 +570,10 @@ def create_enm_molecule(molecule, selected=None, numbers=None, masses=None,
          | rcut  --  cutoff distance between interacting pairs in atomic units
          | K  --  strength of the interaction in atomic units (Hartree/Bohr**2).
                   The interaction strength is the same for all interacting pairs.
+         | sparse  --  When True, the Hessian is a scipy.sparse BSR matrix with
+                       3x3 blocks instead of a dense array. This is recommended
+                       for large models because the number of interacting pairs
+                       only grows linearly with the number of atoms.
     """
     if isinstance(molecule, Molecule):
         coordinates = molecule.coordinates
@@ -579,19 +599,30 @@ def create_enm_molecule(molecule, selected=None, numbers=None, masses=None,
         numbers = numbers[selected]
         masses = masses[selected]
 
-    rcut2 = rcut**2
+    from scipy.spatial import cKDTree
     N = len(coordinates)
-    hessian = np.zeros((3*N,3*N),float)
-    for i in range(N):
-        for j in range(i+1,N):
-            x = np.reshape( (coordinates[i,:]-coordinates[j,:]), (3,1))
-            dist2 = np.sum(x**2)
-            if dist2 < rcut2:
-                corr = K * np.dot( x, x.transpose() ) / dist2
-                hessian[3*i:3*(i+1), 3*i:3*(i+1)] += corr
-                hessian[3*i:3*(i+1), 3*j:3*(j+1)] -= corr
-                hessian[3*j:3*(j+1), 3*i:3*(i+1)] -= corr
-                hessian[3*j:3*(j+1), 3*j:3*(j+1)] += corr
+    # all interacting pairs i < j
+    pairs = cKDTree(coordinates).query_pairs(rcut, output_type='ndarray')
+    i, j = pairs.transpose()
+    x = coordinates[i] - coordinates[j]
+    corr = K*x[:,:,None]*x[:,None,:]/(x**2).sum(axis=1)[:,None,None]
+    # the 3x3 blocks (ii, jj, ij, ji) of all pairs
+    block_rows = np.concatenate([i, j, i, j])
+    block_cols = np.concatenate([i, j, j, i])
+    block_data = np.concatenate([corr, corr, -corr, -corr])
+    if sparse:
+        from scipy.sparse import coo_matrix
+        rows = 3*block_rows[:,None,None] + np.arange(3)[None,:,None]
+        cols = 3*block_cols[:,None,None] + np.arange(3)[None,None,:]
+        rows, cols = np.broadcast_arrays(rows, cols)
+        # duplicate entries are summed
+        hessian = coo_matrix(
+            (block_data.ravel(), (rows.ravel(), cols.ravel())), shape=(3*N,3*N)
+        ).tobsr(blocksize=(3,3))
+    else:
+        hessian = np.zeros((N,3,N,3), float)
+        np.add.at(hessian, (block_rows, slice(None), block_cols, slice(None)), block_data)
+        hessian = hessian.reshape((3*N,3*N))
 
     return Molecule(
         numbers,
@@ -51,9 +51,17 @@
        * ExtRot
        * Vibrations
        * Rotor (see rotor.py)
+   * **Compiled partition functions:**
+       * CompiledPartFun (see PartFun.compile)
+       * SplinePartFun
+   * **Energy levels:**
+       * LevelSet
    * **Helper functions:**
-       * helper_levels, helpert_levels, helpertt_levels,
-       * helper_vibrations, helpert_vibrations, helpertt_vibrations
+       * helper_levels, helpert_levels, helpertt_levels, helpers_levels
+       * helper_vibrations, helpert_vibrations, helpertt_vibrations,
+         helpers_vibrations, sensitivities_vibrations
+   * **Sensitivity analysis:**
+       * Sensitivity (see PartFun.sensitivity)
 
    **Important**: Partition functions can be constructed for NpT gases, NVT
    gases and many other systems. The return values of methods such as
@@ -87,15 +95,20 @@ from molmod import boltzmann, lightspeed, atm, bar, amu, centimeter, kjmol, \
     planck, mol, meter, newton
 
 import numpy as np
+import json
+import zlib
+from collections import OrderedDict
 
 
 __all__ = [
     "Info", "StatFys", "StatFysTerms",
-    "helper_levels", "helpert_levels", "helpertt_levels",
+    "LevelSet",
+    "helper_levels", "helpert_levels", "helpertt_levels", "helpers_levels",
     "Electronic", "ExtTrans", "ExtRot", "PCMCorrection",
     "Vibrations",
     "helper_vibrations", "helpert_vibrations", "helpertt_vibrations",
-    "PartFun",
+    "helpers_vibrations", "sensitivities_vibrations",
+    "PartFun", "CompiledPartFun", "SplinePartFun", "Sensitivity",
 ]
 
 
@@ -144,8 +157,27 @@ class StatFys(object):
     """Abstract class for (contributions to) the parition function.
 
        The constructor (__init__) and four methods (init_part_fun, helper,
-       helpert, helpertt) must be implemented in derived classes.
+       helpert, helpertt) must be implemented in derived classes. The method
+       helpers may be overridden to compute the three helpers at once.
+
+       The attribute ``revision`` is incremented each time an attribute of the
+       contribution is assigned or deleted, such that results cached by the
+       PartFun object can be invalidated. In-place modifications of array
+       values are not detected.
     """
+    __slots__ = ()
+    revision = 0
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name != "revision" and not name.startswith("_cache"):
+            object.__setattr__(self, "revision", self.revision + 1)
+
+    def __delattr__(self, name):
+        object.__delattr__(self, name)
+        if not name.startswith("_cache"):
+            object.__setattr__(self, "revision", self.revision + 1)
+
     def init_part_fun(self, nma, partf):
         """Compute parameters that depend on nma and partition function.
 
@@ -160,6 +192,43 @@ class StatFys(object):
         """
         pass
 
+    def compile_part_fun(self, compiler):
+        """Add the (initialized) parameters of this contribution to a compiler.
+
+           Argument:
+            | ``compiler`` -- A _PartFunCompiler object
+
+           This method is called by :meth:`PartFun.compile` and should not be
+           called by the user. Contributions that can be compiled describe
+           themselves in terms of the building blocks of the compiler, i.e.
+           analytic terms, harmonic oscillators and sets of energy levels.
+        """
+        raise TypeError("The contribution '%s' can not be compiled." % getattr(self, "name", self.__class__.__name__))
+
+    def get_state(self):
+        """Return the parameters of the (initialized) contribution as a dict.
+
+           This method is called by :meth:`PartFun.save_checkpoint` and should
+           not be called by the user. The values must be arrays, numbers,
+           strings, None or tuples and lists of these. Memoized results of
+           methods decorated with ``cached`` are left out.
+        """
+        return dict(
+            (key, value) for key, value in self.__dict__.iteritems()
+            if not key.startswith("_cache")
+        )
+
+    def set_state(self, state):
+        """Restore the parameters returned by :meth:`get_state`.
+
+           Argument:
+            | ``state`` -- a dict with the parameters of the contribution
+
+           This method is called by :meth:`PartFun.load_checkpoint` on an
+           object whose constructor was not called.
+        """
+        self.__dict__.update(state)
+
     def helper(self, temp, n):
         r"""Helper function.
 
@@ -177,7 +246,7 @@ class StatFys(object):
            partition function.
 
            Arguments:
-            | ``temp`` -- the temperature
+            | ``temp`` -- the temperature or an array of temperatures
             | ``n`` -- the power for the temperature factor
         """
         raise NotImplementedError
@@ -199,7 +268,7 @@ class StatFys(object):
            partition function.
 
            Arguments:
-            | ``temp`` -- the temperature
+            | ``temp`` -- the temperature or an array of temperatures
             | ``n`` -- the power for the temperature factor
         """
         raise NotImplementedError
@@ -221,7 +290,7 @@ class StatFys(object):
            partition function.
 
            Arguments:
-            | ``temp`` -- the temperature
+            | ``temp`` -- the temperature or an array of temperatures
             | ``n`` -- the power for the temperature factor
         """
         raise NotImplementedError
@@ -240,7 +309,7 @@ class StatFys(object):
            contribution, this comes down to the method ``helper``.
 
            Arguments:
-            | ``temp`` -- the temperature
+            | ``temp`` -- the temperature or an array of temperatures
             | ``n`` -- the power for the temperature factor
         """
         # By default return helper
@@ -259,12 +328,50 @@ class StatFys(object):
            constants.
 
            Arguments:
-            | ``temp`` -- temperature
+            | ``temp`` -- temperature or an array of temperatures
             | ``n`` -- the power for the temperature factor
         """
         # By default return helper
         return self.helper(temp, n)
 
+    def helpers(self, temp, n):
+        r"""Fused helper functions.
+
+           Returns a tuple with three results:
+
+           .. math:: \left(T^n \frac{\ln(Z_N)}{N},
+                     T^{n+1} \frac{d \left(\frac{\ln(Z_N)}{N}\right)}{dT},
+                     T^{n+2} \frac{d^2 \left(\frac{\ln(Z_N)}{N}\right)}{dT^2}\right)
+
+           i.e. the results of ``helper(temp, n)``, ``helpert(temp, n+1)`` and
+           ``helpertt(temp, n+2)``. This default implementation just calls the
+           three helper functions. Derived classes may override it to share
+           intermediate results, e.g. Boltzmann factors, between the three.
+
+           Arguments:
+            | ``temp`` -- the temperature or an array of temperatures
+            | ``n`` -- the power for the temperature factor
+        """
+        return self.helper(temp, n), self.helpert(temp, n+1), self.helpertt(temp, n+2)
+
+    def helpers_sensitivity(self, temp):
+        """Derivatives of the fused helpers with respect to the parameters.
+
+           Argument:
+            | ``temp`` -- the temperature or an array of temperatures, all
+                          strictly positive
+
+           Returns a list of keys and an array with the derivatives of the
+           results of ``helpers(temp, 0)`` with respect to the parameters
+           identified by the keys. The shape of the array is
+           (3, len(keys)) + temp.shape. Each key is a tuple whose first
+           element is the kind of parameter, e.g. ``("freq", 3)`` or
+           ``("energy",)``. See :class:`Sensitivity` for the supported kinds.
+
+           This default implementation returns no parameters.
+        """
+        return [], np.zeros((3, 0) + np.shape(temp))
+
     def log(self, temp, helper=None):
         r"""Log function
 
@@ -279,7 +386,7 @@ class StatFys(object):
            .. math:: \ln(Z_1)
 
            Argument:
-            | ``temp`` -- the temperature
+            | ``temp`` -- the temperature or an array of temperatures
 
            Optional argument:
             | ``helper`` -- an alternative implementation of helper
@@ -303,7 +410,7 @@ class StatFys(object):
            .. math:: \frac{\partial \ln(Z_1)}{\partial T}
 
            Argument:
-            | ``temp`` -- the temperature
+            | ``temp`` -- the temperature or an array of temperatures
 
            Optional arguments:
             | ``helpert`` -- an alternative implementation of helpert
@@ -327,7 +434,7 @@ class StatFys(object):
            .. math:: \frac{\partial^2 \ln(Z_1)}{\partial T^2}
 
            Argument:
-            | ``temp`` -- the temperature
+            | ``temp`` -- the temperature or an array of temperatures
 
            Optional arguments:
             | ``helpertt`` -- an alternative implementation of helpertt
@@ -352,7 +459,7 @@ class StatFys(object):
            function.
 
            Argument:
-            | ``temp`` -- the temperature
+            | ``temp`` -- the temperature or an array of temperatures
 
            Optional argument:
             | ``helpern`` -- an alternative implementation of helpern
@@ -375,7 +482,7 @@ class StatFys(object):
            constants.
 
            Argument:
-            | ``temp`` -- the temperature
+            | ``temp`` -- the temperature or an array of temperatures
 
            Optional argument:
             | ``helperv`` -- an alternative implementation of helperv
@@ -389,7 +496,7 @@ class StatFys(object):
         """Computes the internal heat per molecule.
 
            Argument:
-            | ``temp`` -- the temperature
+            | ``temp`` -- the temperature or an array of temperatures
 
            Optional argument:
             | ``helpert`` -- an alternative implementation of helpert
@@ -399,36 +506,56 @@ class StatFys(object):
             helpert = self.helpert
         return boltzmann*helpert(temp, 2)
 
-    def heat_capacity(self, temp, helpert=None, helpertt=None):
+    def heat_capacity(self, temp, helpert=None, helpertt=None, helpers=None):
         """Computes the heat capacity per molecule.
 
            Argument:
-            | ``temp`` -- the temperature
+            | ``temp`` -- the temperature or an array of temperatures
 
            Optional arguments:
             | ``helpert`` -- an alternative implementation of helpert
                              [default=self.helpert]
             | ``helpertt`` -- an alternative implementation of helpertt
                               [default=self.helpertt]
+            | ``helpers`` -- an alternative implementation of helpers
+                             [default=self.helpers]
+
+           When neither helpert nor helpertt are given, the fused helpers are
+           used.
         """
+        if helpert is None and helpertt is None:
+            if helpers is None:
+                helpers = self.helpers
+            h, ht, htt = helpers(temp, 0)
+            return boltzmann*(2*ht + htt)
         if helpert is None:
             helpert = self.helpert
         if helpertt is None:
             helpertt = self.helpertt
         return boltzmann*(2*helpert(temp, 1) + helpertt(temp, 2))
 
-    def entropy(self, temp, helper=None, helpert=None):
+    def entropy(self, temp, helper=None, helpert=None, helpers=None):
         """Computes the entropy contribution per molecule.
 
            Argument:
-            | ``temp`` -- the temperature
+            | ``temp`` -- the temperature or an array of temperatures
 
            Optional arguments:
             | ``helper`` -- an alternative implementation of helper
                             [default=self.helper]
             | ``helpert`` -- an alternative implementation of helpert
                              [default=self.helpert]
+            | ``helpers`` -- an alternative implementation of helpers
+                             [default=self.helpers]
+
+           When neither helper nor helpert are given, the fused helpers are
+           used.
         """
+        if helper is None and helpert is None:
+            if helpers is None:
+                helpers = self.helpers
+            h, ht, htt = helpers(temp, 0)
+            return boltzmann*(h + ht)
         if helper is None:
             helper = self.helper
         if helpert is None:
@@ -439,7 +566,7 @@ class StatFys(object):
         """Computes the free energy per molecule.
 
            Argument:
-            | ``temp`` -- the temperature
+            | ``temp`` -- the temperature or an array of temperatures
 
            Optional argument:
             | ``helper`` -- an alternative implementation of helper
@@ -465,7 +592,7 @@ class StatFys(object):
         """Computes the chemical potential.
 
            Argument:
-            | ``temp`` -- the temperature
+            | ``temp`` -- the temperature or an array of temperatures
 
            Optional argument:
             | ``helper`` -- an alternative implementation of helpern
@@ -485,7 +612,21 @@ class StatFysTerms(StatFys):
        The constructor (__init__) and the four methods (init_part_fun,
        helper_terms, helpert_terms, helpertt_terms) must be implemented in
        derived classes.
+
+       The sums over all terms can be computed in blocks of terms and blocks of
+       temperatures, such that the size of the intermediate arrays is bounded
+       by the attribute ``memory_budget`` (in bytes). The default (None) means
+       that all terms and temperatures are processed at once. Derived classes
+       can override the method helper_terms_block to compute the results for a
+       block of terms without computing all the other terms, and set the
+       attribute ``split_terms`` to True. The attribute ``workspace`` is an
+       estimate of the number of temporary arrays created by the helper
+       functions for one block.
     """
+    memory_budget = None
+    split_terms = False
+    workspace = 8
+
     def __init__(self, num_terms):
         """
            Arguments:
@@ -495,28 +636,95 @@ class StatFysTerms(StatFys):
 
     def helper(self, temp, n):
         """See :meth:`StatFys.helper`."""
-        return self.helper_terms(temp, n).sum()
+        return self._sum_terms("helper_terms", temp, n)
 
     def helpert(self, temp, n):
         """See :meth:`StatFys.helpert`."""
-        return self.helpert_terms(temp, n).sum()
+        return self._sum_terms("helpert_terms", temp, n)
 
     def helpertt(self, temp, n):
         """See :meth:`StatFys.helpertt`."""
-        return self.helpertt_terms(temp, n).sum()
+        return self._sum_terms("helpertt_terms", temp, n)
 
     def helpern(self, temp, n):
         """See :meth:`StatFys.helpern`."""
-        return self.helpern_terms(temp, n).sum()
+        return self._sum_terms("helpern_terms", temp, n)
 
     def helperv(self, temp, n):
         """See :meth:`StatFys.helperv`."""
-        return self.helperv_terms(temp, n).sum()
+        return self._sum_terms("helperv_terms", temp, n)
+
+    def helpers(self, temp, n):
+        """See :meth:`StatFys.helpers`."""
+        return self._sum_terms("helpers_terms", temp, n)
+
+    def _get_block_sizes(self, num_temps):
+        """Return the number of terms and temperatures in one block."""
+        size = max(1, self.memory_budget//(8*self.workspace))
+        if self.split_terms:
+            terms_block = max(1, min(self.num_terms, size))
+        else:
+            terms_block = self.num_terms
+        temps_block = max(1, min(num_temps, size//terms_block))
+        return terms_block, temps_block
+
+    def _sum_terms(self, name, temp, n):
+        """Sum the results of one of the *_terms helpers over all terms.
+
+           Arguments:
+            | ``name`` -- the name of the helper, e.g. ``"helper_terms"``
+            | ``temp`` -- the temperature or an array of temperatures
+            | ``n`` -- the power for the temperature factor
+
+           When a memory budget is set, the sum is accumulated in blocks.
+        """
+        fused = (name == "helpers_terms")
+        if self.memory_budget is None or self.num_terms == 0:
+            result = getattr(self, name)(temp, n)
+            if fused:
+                return tuple(values.sum(axis=0) for values in result)
+            return result.sum(axis=0)
+        temp, shape = _flatten_temp(temp)
+        terms_block, temps_block = self._get_block_sizes(len(temp))
+        totals = [np.zeros(len(temp)) for i in xrange(3 if fused else 1)]
+        for tbegin in xrange(0, len(temp), temps_block):
+            tslice = slice(tbegin, tbegin + temps_block)
+            for begin in xrange(0, self.num_terms, terms_block):
+                end = min(begin + terms_block, self.num_terms)
+                block = self.helper_terms_block(name, temp[tslice], n, begin, end)
+                if not fused:
+                    block = (block,)
+                for total, values in zip(totals, block):
+                    total[tslice] += values.sum(axis=0)
+        totals = tuple(_unflatten(total, shape) for total in totals)
+        if fused:
+            return totals
+        return totals[0]
+
+    def helper_terms_block(self, name, temp, n, begin, end):
+        """Compute the results of one of the *_terms helpers for a block of terms.
+
+           Arguments:
+            | ``name`` -- the name of the helper, e.g. ``"helper_terms"``
+            | ``temp`` -- a flat array of temperatures
+            | ``n`` -- the power for the temperature factor
+            | ``begin``, ``end`` -- the range of terms to consider
+
+           The default implementation computes all terms and returns a slice.
+           It is only called with all terms at once, unless ``split_terms`` is
+           True.
+        """
+        result = getattr(self, name)(temp, n)
+        if name == "helpers_terms":
+            return tuple(values[begin:end] for values in result)
+        return result[begin:end]
 
     def helper_terms(self, temp, n):
         """Returns an array with all the helper results for the distinct terms.
 
-           This is just an array version of :meth:`StatFys.helper`.
+           This is just an array version of :meth:`StatFys.helper`. The first
+           axis of the result runs over the terms, the remaining axes
+           correspond to the axes of temp.
         """
         raise NotImplementedError
 
@@ -550,6 +758,15 @@ class StatFysTerms(StatFys):
         # by default, this is the same as helper_terms
         return self.helper_terms(temp, n)
 
+    def helpers_terms(self, temp, n):
+        """Returns a tuple of arrays with the fused helper results for the distinct terms.
+
+           This is just an array version of :meth:`StatFys.helpers`. The
+           default implementation calls the three helper functions.
+        """
+        return self.helper_terms(temp, n), self.helpert_terms(temp, n+1), \
+               self.helpertt_terms(temp, n+2)
+
     def log_terms(self, temp):
         """Returns an array with log results for the distinct terms.
 
@@ -597,14 +814,14 @@ class StatFysTerms(StatFys):
 
            This is just an array version of :meth:`StatFys.heat_capacity`.
         """
-        return self.heat_capacity(temp, self.helpert_terms, self.helpertt_terms)
+        return self.heat_capacity(temp, helpers=self.helpers_terms)
 
     def entropy_terms(self, temp):
         """Returns an array with entropy results for the distinct terms.
 
            This is just an array version of :meth:`StatFys.entropy`.
         """
-        return self.entropy(temp, self.helper_terms, self.helpert_terms)
+        return self.entropy(temp, helpers=self.helpers_terms)
 
     def free_energy_terms(self, temp):
         """Returns an array with free_energy results for the distinct terms.
@@ -628,9 +845,155 @@ class StatFysTerms(StatFys):
         return self.chemical_potential(temp, self.helpern_terms)
 
 
-def _check_levels(temp, bfs, Z):
-    if bfs[bfs.argmin()]/Z > 0.01:
-        raise ValueError('The highest energy level is occupied by more than 1%.')
+def _flatten_temp(temp):
+    """Return a flat float array with temperatures and the original shape."""
+    temp = np.asarray(temp, dtype=float)
+    return temp.ravel(), temp.shape
+
+
+def _unflatten(result, shape):
+    """Restore the temperature axes of a result, the inverse of _flatten_temp.
+
+       The last axis of ``result`` corresponds to the flattened temperatures.
+       Scalars are returned when the temperature was a scalar and the result
+       has no other axes.
+    """
+    result = result.reshape(result.shape[:-1] + shape)
+    if result.ndim == 0:
+        return result[()]
+    return result
+
+
+def _temp_power(temp, n):
+    """Compute T^n for an array of temperatures, including the limit T -> 0.
+
+       A NotImplementedError is raised when the limit does not exist, i.e. when
+       n is negative and a zero temperature is present.
+    """
+    zero = (temp == 0)
+    if not zero.any():
+        return temp**n
+    if n < 0:
+        raise NotImplementedError
+    result = np.zeros(temp.shape)
+    result[~zero] = temp[~zero]**n
+    if n == 0:
+        result[zero] = 1.0
+    return result
+
+
+def _safe_temp(temp):
+    """Replace zero temperatures by one to avoid divisions by zero.
+
+       The results at the replaced temperatures must be discarded or multiplied
+       by a vanishing power of the temperature afterwards.
+    """
+    return np.where(temp == 0, 1.0, temp)
+
+
+class LevelSet(object):
+    """A sorted set of energy levels with a numerically stable evaluation.
+
+       The partition function and the moments of the energy are computed with
+       the log-sum-exp trick, i.e. all Boltzmann factors are taken relative to
+       the ground level, such that nothing overflows or underflows at low
+       temperatures. Levels whose Boltzmann factor (relative to the ground
+       level) is negligible at the highest requested temperature are left out.
+
+       The functions helper_levels, helpert_levels, helpertt_levels and
+       helpers_levels accept either an array with energy levels or a LevelSet
+       object. The latter avoids sorting the levels at each call.
+    """
+    # Levels with an excitation energy above this number times the thermal
+    # energy (at the highest temperature) are neglected: exp(-40) ~ 4e-18
+    cutoff = 40.0
+
+    def __init__(self, energy_levels):
+        """
+           Argument:
+            | ``energy_levels`` -- an array with energy levels, not necessarily
+                                   sorted
+        """
+        levels = np.sort(np.asarray(energy_levels, dtype=float).ravel())
+        if len(levels) == 0:
+            raise ValueError("At least one energy level is required.")
+        self.levels = levels
+        self.ground = levels[0]
+        self.excitations = levels - levels[0]
+        self.degeneracy = (self.excitations == 0).sum()
+
+    def __len__(self):
+        return len(self.levels)
+
+    def get_num_relevant(self, temp):
+        """Return the number of levels that matter up to the given temperature.
+
+           Argument:
+            | ``temp`` -- the (highest) temperature, strictly positive
+        """
+        return self.excitations.searchsorted(self.cutoff*boltzmann*temp, side="right")
+
+    def top_occupation(self, temp):
+        """The occupation of the highest energy level.
+
+           Argument:
+            | ``temp`` -- the temperature or an array of temperatures, all
+                          strictly positive
+        """
+        temp = np.asarray(temp, dtype=float)
+        beta = 1.0/(boltzmann*temp)
+        Z = np.exp(-np.multiply.outer(self.excitations[:self.get_num_relevant(temp.max())], beta)).sum(axis=0)
+        return np.exp(-self.excitations[-1]*beta)/Z
+
+    def evaluate(self, temp, order, check=False):
+        """Compute ln(Z) and the first moments of the energy.
+
+           Arguments:
+            | ``temp`` -- a flat array with strictly positive temperatures
+            | ``order`` -- the number of moments (0, 1 or 2)
+
+           Optional argument:
+            | ``check`` -- see :func:`helper_levels`
+
+           Returns a list with ln(Z), followed by the average energy (when order
+           > 0) and the variance of the energy (when order > 1).
+        """
+        beta = 1.0/(boltzmann*temp)
+        excitations = self.excitations[:self.get_num_relevant(temp.max())]
+        bfs = np.exp(-np.outer(excitations, beta))
+        Z = bfs.sum(axis=0)
+        if check and (np.exp(-self.excitations[-1]*beta)/Z > 0.01).any():
+            raise ValueError('The highest energy level is occupied by more than 1%.')
+        results = [np.log(Z) - self.ground*beta]
+        if order > 0:
+            # moments of the excitation energies
+            e1 = np.dot(excitations, bfs)/Z
+            results.append(self.ground + e1)
+        if order > 1:
+            results.append(np.dot(excitations**2, bfs)/Z - e1**2)
+        return results
+
+    def ground_limits(self, temp, n):
+        """The limits of the fused helpers for T -> 0.
+
+           Arguments:
+            | ``temp`` -- a flat array with zeros
+            | ``n`` -- the power for the temperature factor
+        """
+        factor = _temp_power(temp, n-1)
+        h = _temp_power(temp, n)*np.log(self.degeneracy) - factor*self.ground/boltzmann
+        # The average energy goes to the lowest level and the variance of the
+        # energy vanishes exponentially.
+        ht = factor*self.ground/boltzmann
+        htt = -2*factor*self.ground/boltzmann
+        return h, ht, htt
+
+
+def _as_level_set(energy_levels):
+    """Return a LevelSet object, constructing one from an array if needed."""
+    if isinstance(energy_levels, LevelSet):
+        return energy_levels
+    return LevelSet(energy_levels)
 
 
 def helper_levels(temp, n, energy_levels, check=False):
@@ -639,9 +1002,9 @@ def helper_levels(temp, n, energy_levels, check=False):
        Returns T^n ln(Z), where Z is the partition function
 
        Arguments:
-        | ``temp`` -- the temperature
+        | ``temp`` -- the temperature or an array of temperatures
         | ``n`` -- the power for the temperature factor
-        | ``energy_levels`` -- an array with energy levels
+        | ``energy_levels`` -- an array with energy levels or a LevelSet object
 
        Optional argument:
         | ``check`` -- when set to True, an error is raise when the highest
@@ -649,18 +1012,17 @@ def helper_levels(temp, n, energy_levels, check=False):
                        temperature.
     """
     # this is defined as a function because multiple classes need it
-    if temp == 0:
-        energy = energy_levels[0]
-        degeneracy = 1
-        while (degeneracy<len(energy_levels) and energy_levels[0]==energy_levels[degeneracy]):
-            degeneracy += 1
-        return float(temp)**n*np.log(degeneracy) - float(temp)**(n-1)*energy
-    else:
-        bfs = np.exp(-energy_levels/(boltzmann*temp))
-        Z = bfs.sum()
-        if check:
-            _check_levels(temp, bfs, Z)
-        return float(temp)**n*np.log(Z)
+    temp, shape = _flatten_temp(temp)
+    level_set = _as_level_set(energy_levels)
+    zero = (temp == 0)
+    result = np.zeros(temp.shape)
+    if zero.any():
+        result[zero] = level_set.ground_limits(temp[zero], n)[0]
+    if not zero.all():
+        pos = temp[~zero]
+        log, = level_set.evaluate(pos, 0, check)
+        result[~zero] = pos**n*log
+    return _unflatten(result, shape)
 
 def helpert_levels(temp, n, energy_levels, check=False):
     """Helper 1 function for a system with the given energy levels.
@@ -668,9 +1030,9 @@ def helpert_levels(temp, n, energy_levels, check=False):
        Returns T^n (d ln(Z) / dT), where Z is the partition function
 
        Arguments:
-        | ``temp`` -- the temperature
+        | ``temp`` -- the temperature or an array of temperatures
         | ``n`` -- the power for the temperature factor
-        | ``energy_levels`` -- an array with energy levels
+        | ``energy_levels`` -- an array with energy levels or a LevelSet object
 
        Optional argument:
         | ``check`` -- when set to True, an error is raise when the highest
@@ -678,14 +1040,17 @@ def helpert_levels(temp, n, energy_levels, check=False):
                        temperature.
     """
     # this is defined as a function because multiple classes need it
-    if temp == 0:
-        raise NotImplementedError
-    else:
-        bfs = np.exp(-energy_levels/(boltzmann*temp))
-        Z = bfs.sum()
-        if check:
-            _check_levels(temp, bfs, Z)
-        return float(temp)**(n-2)*(bfs*energy_levels).sum()/Z/boltzmann
+    temp, shape = _flatten_temp(temp)
+    level_set = _as_level_set(energy_levels)
+    zero = (temp == 0)
+    result = np.zeros(temp.shape)
+    if zero.any():
+        result[zero] = level_set.ground_limits(temp[zero], n-1)[1]
+    if not zero.all():
+        pos = temp[~zero]
+        log, e1 = level_set.evaluate(pos, 1, check)
+        result[~zero] = pos**(n-2)*e1/boltzmann
+    return _unflatten(result, shape)
 
 def helpertt_levels(temp, n, energy_levels, check=False):
     """Helper 2 function for a system with the given energy levels.
@@ -693,9 +1058,9 @@ def helpertt_levels(temp, n, energy_levels, check=False):
        Returns T^n (d^2 ln(Z) / dT^2), where Z is the partition function
 
        Arguments:
-        | ``temp`` -- the temperature
+        | ``temp`` -- the temperature or an array of temperatures
         | ``n`` -- the power for the temperature factor
-        | ``energy_levels`` -- an array with energy levels
+        | ``energy_levels`` -- an array with energy levels or a LevelSet object
 
        Optional argument:
         | ``check`` -- when set to True, an error is raise when the highest
@@ -703,16 +1068,53 @@ def helpertt_levels(temp, n, energy_levels, check=False):
                        temperature.
     """
     # this is defined as a function because multiple classes need it
-    if temp == 0:
-        raise NotImplementedError
-    else:
-        bfs = np.exp(-energy_levels/(boltzmann*temp))
-        Z = bfs.sum()
-        if check:
-            _check_levels(temp, bfs, Z)
-        return float(temp)**(n-4)/boltzmann**2*((bfs*energy_levels**2).sum()/Z) \
-               -2*float(temp)**(n-3)/boltzmann*((bfs*energy_levels).sum()/Z) \
-               -float(temp)**(n-4)/boltzmann**2*((bfs*energy_levels).sum()/Z)**2
+    temp, shape = _flatten_temp(temp)
+    level_set = _as_level_set(energy_levels)
+    zero = (temp == 0)
+    result = np.zeros(temp.shape)
+    if zero.any():
+        result[zero] = level_set.ground_limits(temp[zero], n-2)[2]
+    if not zero.all():
+        pos = temp[~zero]
+        log, e1, var = level_set.evaluate(pos, 2, check)
+        result[~zero] = pos**(n-4)/boltzmann**2*var \
+                        -2*pos**(n-3)/boltzmann*e1
+    return _unflatten(result, shape)
+
+
+def helpers_levels(temp, n, energy_levels, check=False):
+    """Fused helper functions for a system with the given energy levels.
+
+       Returns a tuple with the results of helper_levels(temp, n, ...),
+       helpert_levels(temp, n+1, ...) and helpertt_levels(temp, n+2, ...). The
+       Boltzmann factors are only computed once.
+
+       Arguments:
+        | ``temp`` -- the temperature or an array of temperatures
+        | ``n`` -- the power for the temperature factor
+        | ``energy_levels`` -- an array with energy levels or a LevelSet object
+
+       Optional argument:
+        | ``check`` -- when set to True, an error is raise when the highest
+                       energy level is occupied by more than 1% the the current
+                       temperature.
+    """
+    # this is defined as a function because multiple classes need it
+    temp, shape = _flatten_temp(temp)
+    level_set = _as_level_set(energy_levels)
+    zero = (temp == 0)
+    h = np.zeros(temp.shape)
+    ht = np.zeros(temp.shape)
+    htt = np.zeros(temp.shape)
+    if zero.any():
+        h[zero], ht[zero], htt[zero] = level_set.ground_limits(temp[zero], n)
+    if not zero.all():
+        pos = temp[~zero]
+        log, e1, var = level_set.evaluate(pos, 2, check)
+        h[~zero] = pos**n*log
+        ht[~zero] = pos**(n-1)*e1/boltzmann
+        htt[~zero] = pos**(n-2)/boltzmann**2*var - 2*pos**(n-1)/boltzmann*e1
+    return _unflatten(h, shape), _unflatten(ht, shape), _unflatten(htt, shape)
 
 
 class Electronic(Info, StatFys):
@@ -739,6 +1141,10 @@ class Electronic(Info, StatFys):
                 raise ValueError("Spin multiplicity is not defined.")
         self.energy = nma.energy
 
+    def compile_part_fun(self, compiler):
+        """See :meth:`StatFys.compile_part_fun`."""
+        compiler.add_analytic(np.log(self.multiplicity), inv_coeff=-self.energy/boltzmann)
+
     def dump(self, f):
         """See :meth:`Info.dump`."""
         Info.dump(self, f)
@@ -747,35 +1153,29 @@ class Electronic(Info, StatFys):
 
     def helper(self, temp, n):
         """See :meth:`StatFys.helper`."""
-        result = float(temp)**n*np.log(self.multiplicity)
-        if temp == 0.0:
-            if n < 1:
-                raise NotImplementedError
-            else:
-                result -= self.energy/boltzmann
-        else:
-            result -= float(temp)**(n-1)*self.energy/boltzmann
-        return result
+        temp, shape = _flatten_temp(temp)
+        result = _temp_power(temp, n)*np.log(self.multiplicity) \
+                 - _temp_power(temp, n-1)*self.energy/boltzmann
+        return _unflatten(result, shape)
 
     def helpert(self, temp, n):
         """See :meth:`StatFys.helpert`."""
-        if temp == 0.0:
-            if n < 2:
-                raise NotImplementedError
-            else:
-                return self.energy/boltzmann
-        else:
-            return float(temp)**(n-2)*self.energy/boltzmann
+        temp, shape = _flatten_temp(temp)
+        result = _temp_power(temp, n-2)*self.energy/boltzmann
+        return _unflatten(result, shape)
 
     def helpertt(self, temp, n):
         """See :meth:`StatFys.helpertt`."""
-        if temp == 0.0:
-            if n < 3:
-                raise NotImplementedError
-            else:
-                return -2.0*self.energy/boltzmann
-        else:
-            return -2.0*float(temp)**(n-3)*self.energy/boltzmann
+        temp, shape = _flatten_temp(temp)
+        result = -2.0*_temp_power(temp, n-3)*self.energy/boltzmann
+        return _unflatten(result, shape)
+
+    def helpers_sensitivity(self, temp):
+        """See :meth:`StatFys.helpers_sensitivity`."""
+        temp, shape = _flatten_temp(temp)
+        beta = 1.0/(boltzmann*temp)
+        derivs = np.array([[-beta], [beta], [-2*beta]])
+        return [("energy",)], _unflatten(derivs, shape)
 
 
 class ExtTrans(Info, StatFys):
@@ -894,6 +1294,24 @@ class ExtTrans(Info, StatFys):
         else:
             self.mass = nma.masses[self.mobile].sum()
 
+    def compile_part_fun(self, compiler):
+        """See :meth:`StatFys.compile_part_fun`."""
+        # constant and coefficient of ln(T) in _z1
+        const_v = self._z1(1.0)
+        log_coeff_v = 0.5*self.dim
+        if self.cp:
+            const = const_v + np.log(boltzmann/self._pressure)
+            compiler.add_analytic(
+                const, log_coeff_v + 1, const_n=const,
+                const_v=const_v, log_coeff_v=log_coeff_v
+            )
+        else:
+            compiler.add_analytic(
+                const_v + 1.0 - np.log(self._density), log_coeff_v,
+                const_n=const_v - np.log(self._density),
+                const_v=const_v, log_coeff_v=log_coeff_v
+            )
+
     def dump(self, f):
         """See :meth:`Info.dump`."""
         Info.dump(self, f)
@@ -920,65 +1338,61 @@ class ExtTrans(Info, StatFys):
     def _z1(self, temp):
         return 0.5*self.dim*np.log(2*np.pi*self.mass*boltzmann*temp/planck**2)
 
+    def _helper_log(self, temp, n, extra):
+        """Common part of helper, helpern and helperv.
+
+           Arguments:
+            | ``temp`` -- the temperature or an array of temperatures
+            | ``n`` -- the power for the temperature factor
+            | ``extra`` -- a function that computes the terms to be added to
+                           the single-particle contribution, or None
+        """
+        temp, shape = _flatten_temp(temp)
+        if n <= 0 and (temp == 0).any():
+            raise NotImplementedError
+        # T^n ln(T) goes to zero for T -> 0 and n > 0.
+        safe = _safe_temp(temp)
+        result = self._z1(safe)
+        if extra is not None:
+            result += extra(safe)
+        result *= _temp_power(temp, n)
+        return _unflatten(result, shape)
+
     def helper(self, temp, n):
         """See :meth:`StatFys.helper`."""
-        if temp == 0:
-            if n > 0:
-                return 0.0
-            else:
-                raise NotImplementedError
+        if self.cp:
+            extra = lambda temp: np.log(boltzmann*temp/self._pressure)
         else:
-            result = self._z1(temp)
-            if self.cp:
-                result += np.log(boltzmann*temp/self._pressure)
-            else:
-                result += 1.0 - np.log(self.density)
-            return result*float(temp)**n
+            extra = lambda temp: 1.0 - np.log(self.density)
+        return self._helper_log(temp, n, extra)
 
     def helpert(self, temp, n):
         """See :meth:`StatFys.helpert`."""
-        if temp == 0:
-            raise NotImplementedError
-        else:
-            result = 0.5*self.dim
-            if self.cp:
-                result += 1
-            return result*float(temp)**(n-1)
+        temp, shape = _flatten_temp(temp)
+        result = 0.5*self.dim
+        if self.cp:
+            result += 1
+        return _unflatten(result*_temp_power(temp, n-1), shape)
 
     def helpertt(self, temp, n):
         """See :meth:`StatFys.helpertt`."""
-        if temp == 0:
-            raise NotImplementedError
-        else:
-            result = -0.5*self.dim
-            if self.cp:
-                result -= 1
-            return result*float(temp)**(n-2)
+        temp, shape = _flatten_temp(temp)
+        result = -0.5*self.dim
+        if self.cp:
+            result -= 1
+        return _unflatten(result*_temp_power(temp, n-2), shape)
 
     def helpern(self, temp, n):
         """See :meth:`StatFys.helpern`."""
-        if temp == 0:
-            if n > 0:
-                return 0.0
-            else:
-                raise NotImplementedError
+        if self.cp:
+            extra = lambda temp: np.log(boltzmann*temp/self._pressure)
         else:
-            result = self._z1(temp)
-            if self.cp:
-                result += np.log(boltzmann*temp/self._pressure)
-            else:
-                result += -np.log(self._density)
-            return result*float(temp)**n
+            extra = lambda temp: -np.log(self._density)
+        return self._helper_log(temp, n, extra)
 
     def helperv(self, temp, n):
         r"""See :meth:`StatFys.helperv`."""
-        if temp == 0:
-            if n > 0:
-                return 0.0
-            else:
-                raise NotImplementedError
-        else:
-            return self._z1(temp)*float(temp)**n
+        return self._helper_log(temp, n, None)
 
 
 class ExtRot(Info, StatFys):
@@ -1022,6 +1436,10 @@ class ExtRot(Info, StatFys):
         ]))/self.symmetry_number/np.pi
         self.count = (self.moments > self.im_threshold).sum()
 
+    def compile_part_fun(self, compiler):
+        """See :meth:`StatFys.compile_part_fun`."""
+        compiler.add_analytic(np.log(self.factor), 0.5*self.count)
+
     def dump(self, f):
         """See :meth:`Info.dump`."""
         Info.dump(self, f)
@@ -1032,21 +1450,22 @@ class ExtRot(Info, StatFys):
 
     def helper(self, temp, n):
         """See :meth:`StatFys.helper`."""
-        if temp == 0:
-            if n > 0:
-                return 0.0
-            else:
-                raise NotImplementedError
-        else:
-            return float(temp)**n*(np.log(temp)*0.5*self.count + np.log(self.factor))
+        temp, shape = _flatten_temp(temp)
+        if n <= 0 and (temp == 0).any():
+            raise NotImplementedError
+        # T^n ln(T) goes to zero for T -> 0 and n > 0.
+        result = _temp_power(temp, n)*(np.log(_safe_temp(temp))*0.5*self.count + np.log(self.factor))
+        return _unflatten(result, shape)
 
     def helpert(self, temp, n):
         """See :meth:`StatFys.helpert`."""
-        return float(temp)**(n-1)*0.5*self.count
+        temp, shape = _flatten_temp(temp)
+        return _unflatten(_temp_power(temp, n-1)*0.5*self.count, shape)
 
     def helpertt(self, temp, n):
         """See :meth:`StatFys.helpertt`."""
-        return -float(temp)**(n-2)*0.5*self.count
+        temp, shape = _flatten_temp(temp)
+        return _unflatten(-_temp_power(temp, n-2)*0.5*self.count, shape)
 
 
 class PCMCorrection(Info, StatFys):
@@ -1091,6 +1510,12 @@ class PCMCorrection(Info, StatFys):
             print >> f, "       Not Defined!! Only rely on computations on temperature of point 1!!"
         print >> f, "    Zero-point contribution [kJ/mol]: %.7f" % (self.zero_point_energy()/kjmol)
 
+    def compile_part_fun(self, compiler):
+        """See :meth:`StatFys.compile_part_fun`."""
+        # F(T) = F0 + slope*T, hence ln(Z) = -F0/(k*T) - slope/k
+        F0, slope, dummy = self._eval_free(0.0)
+        compiler.add_analytic(-slope/boltzmann, inv_coeff=-F0/boltzmann)
+
     def _eval_free(self, temp):
         if self.point2 is None:
             return self.point1[0], 0.0, 0.0
@@ -1104,18 +1529,45 @@ class PCMCorrection(Info, StatFys):
 
     def helper(self, temp, n):
         """See :meth:`StatFys.helper`."""
+        temp, shape = _flatten_temp(temp)
         F, Fp, Fpp = self._eval_free(temp)
-        return -F*float(temp)**(n-1)/boltzmann
+        result = -F*_temp_power(temp, n-1)/boltzmann
+        return _unflatten(result, shape)
 
     def helpert(self, temp, n):
         """See :meth:`StatFys.helpert`."""
+        temp, shape = _flatten_temp(temp)
         F, Fp, Fpp = self._eval_free(temp)
-        return (F*float(temp)**(n-2) - Fp*float(temp)**(n-1))/boltzmann
+        result = (F*_temp_power(temp, n-2) - Fp*_temp_power(temp, n-1))/boltzmann
+        return _unflatten(result, shape)
 
     def helpertt(self, temp, n):
         """See :meth:`StatFys.helpertt`."""
+        temp, shape = _flatten_temp(temp)
         F, Fp, Fpp = self._eval_free(temp)
-        return (-Fpp*float(temp)**(n-1) + 2*(Fp*float(temp)**(n-2) - F*float(temp)**(n-3)))/boltzmann
+        result = (-Fpp*_temp_power(temp, n-1) + 2*(Fp*_temp_power(temp, n-2) - F*_temp_power(temp, n-3)))/boltzmann
+        return _unflatten(result, shape)
+
+
+def _prepare_vibrations(temp, freqs):
+    """Flatten the temperatures and add a temperature axis to the frequencies."""
+    temp, shape = _flatten_temp(temp)
+    freqs = np.asarray(freqs, dtype=float)[..., np.newaxis]
+    return temp, shape, freqs
+
+
+def _bose_factors(temp, freqs, freq_scaling):
+    """Compute Af, B=exp(-Af) and C=B/(1-B) for quantum oscillators.
+
+       The results at zero temperature correspond to the limit T -> 0, i.e. B
+       and C are set to zero. (Af is finite but meaningless in that case.)
+    """
+    zero = (temp == 0)
+    Af = freqs*(freq_scaling*planck/boltzmann)/_safe_temp(temp)
+    B = np.exp(-Af)
+    B[..., zero] = 0.0
+    C = B/(1 - B)
+    return Af, B, C
 
 
 def helper_vibrations(temp, n, freqs, classical=False, freq_scaling=1, zp_scaling=1):
@@ -1124,7 +1576,7 @@ def helper_vibrations(temp, n, freqs, classical=False, freq_scaling=1, zp_scalin
        Returns T^n ln(Z), where Z is the partition function.
 
        Arguments:
-        | ``temp`` -- the temperature
+        | ``temp`` -- the temperature or an array of temperatures
         | ``n`` -- the power for the temperature factor
         | ``freqs`` -- an array with frequencies
 
@@ -1133,32 +1585,26 @@ def helper_vibrations(temp, n, freqs, classical=False, freq_scaling=1, zp_scalin
                            [default=False]
         | ``freq_scaling`` -- Scale the frequencies with the given factor.
                               [default=1]
-        | ``freq_zp`` -- Scale the zero-point energy correction with the given.
-                         factor [default=1]
+        | ``freq_zp`` -- Scale the zero-point energy correction with the given
+                         factor. [default=1]
+
+       The shape of the result is the shape of freqs followed by the shape of
+       temp.
     """
     # this is defined as a function because multiple classes need it
+    temp, shape, freqs = _prepare_vibrations(temp, freqs)
     if classical:
-        if temp == 0:
-            if n >= 1:
-                return np.zeros(len(freqs))
-            else:
-                raise NotImplementedError
-        else:
-            Af = planck*freqs*freq_scaling/(boltzmann*temp)
-            return -float(temp)**n*np.log(Af)
+        if n < 1 and (temp == 0).any():
+            raise NotImplementedError
+        Af = planck*freqs*freq_scaling/(boltzmann*_safe_temp(temp))
+        result = -_temp_power(temp, n)*np.log(Af)
     else:
         # The zero point correction is included in the vibrational partition
         # function.
-        if temp == 0:
-            Abis = freqs*(0.5*planck*zp_scaling/boltzmann)
-            if n >= 1:
-                return -Abis*float(temp)**(n-1)
-            else:
-                raise NotImplementedError
-        else:
-            A = freqs*(planck/(boltzmann*temp))
-            B = np.exp(-freq_scaling*A)
-            return -((0.5*zp_scaling)*A + np.log(1 - B))*float(temp)**n
+        Af, B, C = _bose_factors(temp, freqs, freq_scaling)
+        Abis = freqs*(0.5*planck*zp_scaling/boltzmann)
+        result = -Abis*_temp_power(temp, n-1) - np.log(1 - B)*_temp_power(temp, n)
+    return _unflatten(result, shape)
 
 def helpert_vibrations(temp, n, freqs, classical=False, freq_scaling=1, zp_scaling=1):
     """Helper 1 function for a set of harmonic oscillators.
@@ -1166,35 +1612,30 @@ def helpert_vibrations(temp, n, freqs, classical=False, freq_scaling=1, zp_scali
        Returns T^n (d ln(Z) / dT), where Z is the partition function.
 
        Arguments:
-        | ``temp`` -- the temperature
+        | ``temp`` -- the temperature or an array of temperatures
         | ``n`` -- the power for the temperature factor
-        | ``energy_levels`` -- an array with energy levels
+        | ``freqs`` -- an array with frequencies
 
        Optional arguments:
-        | ``classical`` -- When True, the classical partition function is used
+        | ``classical`` -- When True, the classical partition function is used.
                            [default=False]
-        | ``freq_scaling`` -- Scale the frequencies with the given factor
+        | ``freq_scaling`` -- Scale the frequencies with the given factor.
                               [default=1]
         | ``freq_zp`` -- Scale the zero-point energy correction with the given
-                         factor [default=1]
+                         factor. [default=1]
+
+       The shape of the result is the shape of freqs followed by the shape of
+       temp.
     """
     # this is defined as a function because multiple classes need it
+    temp, shape, freqs = _prepare_vibrations(temp, freqs)
     if classical:
-        if temp == 0:
-            raise NotImplementedError
-        else:
-            result = float(temp)**(n-1)
-            if hasattr(freqs, "__len__"):
-                result *= np.ones(len(freqs))
-            return result
+        result = _temp_power(temp, n-1)*np.ones(freqs.shape)
     else:
-        if temp == 0:
-            raise NotImplementedError
-        else:
-            A = freqs*(planck/(boltzmann*temp))
-            B = np.exp(-freq_scaling*A)
-            C = B/(1 - B)
-            return A*float(temp)**(n-1)*(0.5*zp_scaling + freq_scaling*C)
+        Af, B, C = _bose_factors(temp, freqs, freq_scaling)
+        A = freqs*(planck/boltzmann)
+        result = A*_temp_power(temp, n-2)*(0.5*zp_scaling + freq_scaling*C)
+    return _unflatten(result, shape)
 
 def helpertt_vibrations(temp, n, freqs, classical=False, freq_scaling=1, zp_scaling=1):
     """Helper 2 function for a set of harmonic oscillators.
@@ -1202,41 +1643,128 @@ def helpertt_vibrations(temp, n, freqs, classical=False, freq_scaling=1, zp_scal
        Returns T^n (d^2 ln(Z) / dT^2), where Z is the partition function.
 
        Arguments:
-        | ``temp`` -- the temperature
+        | ``temp`` -- the temperature or an array of temperatures
         | ``n`` -- the power for the temperature factor
-        | ``energy_levels`` -- an array with energy levels
+        | ``freqs`` -- an array with frequencies
 
        Optional arguments:
-        | ``classical`` -- When True, the classical partition function is used
+        | ``classical`` -- When True, the classical partition function is used.
                            [default=False]
-        | ``freq_scaling`` -- Scale the frequencies with the given factor
+        | ``freq_scaling`` -- Scale the frequencies with the given factor.
                               [default=1]
         | ``freq_zp`` -- Scale the zero-point energy correction with the given
-                         factor [default=1]
+                         factor. [default=1]
+
+       The shape of the result is the shape of freqs followed by the shape of
+       temp.
     """
     # this is defined as a function because multiple classes need it
+    temp, shape, freqs = _prepare_vibrations(temp, freqs)
     if classical:
-        if temp == 0:
-            raise NotImplementedError
-        else:
-            result = -float(temp)**(n-2)
-            if hasattr(freqs, "__len__"):
-                result *= np.ones(len(freqs))
-            return result
+        result = -_temp_power(temp, n-2)*np.ones(freqs.shape)
     else:
-        if temp == 0:
+        Af, B, C = _bose_factors(temp, freqs, freq_scaling)
+        A = freqs*(planck/boltzmann)
+        result = -A*_temp_power(temp, n-3)*(zp_scaling + freq_scaling*C*(2 - Af/(1-B)))
+    return _unflatten(result, shape)
+
+def helpers_vibrations(temp, n, freqs, classical=False, freq_scaling=1, zp_scaling=1):
+    """Fused helper functions for a set of harmonic oscillators.
+
+       Returns a tuple with the results of helper_vibrations(temp, n, ...),
+       helpert_vibrations(temp, n+1, ...) and helpertt_vibrations(temp, n+2,
+       ...). The Boltzmann factors are only computed once.
+
+       Arguments:
+        | ``temp`` -- the temperature or an array of temperatures
+        | ``n`` -- the power for the temperature factor
+        | ``freqs`` -- an array with frequencies
+
+       Optional arguments:
+        | ``classical`` -- When True, the classical partition function is used.
+                           [default=False]
+        | ``freq_scaling`` -- Scale the frequencies with the given factor.
+                              [default=1]
+        | ``freq_zp`` -- Scale the zero-point energy correction with the given
+                         factor. [default=1]
+
+       The shape of each result is the shape of freqs followed by the shape of
+       temp.
+    """
+    # this is defined as a function because multiple classes need it
+    temp, shape, freqs = _prepare_vibrations(temp, freqs)
+    if classical:
+        if n < 1 and (temp == 0).any():
             raise NotImplementedError
-        else:
-            A = freqs*(planck/(boltzmann*temp))
-            Af = freq_scaling*A
-            B = np.exp(-Af)
-            C = B/(1.0 - B)
-            return -A*float(temp)**(n-2)*(zp_scaling + freq_scaling*C*(2 - Af/(1-B)))
+        Af = planck*freqs*freq_scaling/(boltzmann*_safe_temp(temp))
+        factor = _temp_power(temp, n)
+        h = -factor*np.log(Af)
+        ht = factor*np.ones(freqs.shape)
+        htt = -ht
+    else:
+        Af, B, C = _bose_factors(temp, freqs, freq_scaling)
+        # all three results have the same power of the temperature in common
+        Afactor = freqs*(planck/boltzmann)*_temp_power(temp, n-1)
+        h = -0.5*zp_scaling*Afactor - np.log(1 - B)*_temp_power(temp, n)
+        ht = Afactor*(0.5*zp_scaling + freq_scaling*C)
+        htt = -Afactor*(zp_scaling + freq_scaling*C*(2 - Af/(1-B)))
+    return _unflatten(h, shape), _unflatten(ht, shape), _unflatten(htt, shape)
+
+def sensitivities_vibrations(temp, freqs, classical=False, freq_scaling=1, zp_scaling=1):
+    """Derivatives of the fused helpers of harmonic oscillators.
+
+       Returns a tuple with three arrays. They contain the derivatives of the
+       results of helpers_vibrations(temp, 0, ...), i.e. ln(Z),
+       T (d ln(Z) / dT) and T^2 (d^2 ln(Z) / dT^2), with respect to (i) the
+       frequency of each oscillator, (ii) the frequency scaling factor and (iii)
+       the zero-point scaling factor. The shape of each array is (3,) +
+       freqs.shape + temp.shape. The last two arrays contain the contributions
+       of the individual oscillators. They must be summed over all oscillators
+       to obtain the derivative with respect to the scaling factors.
+
+       Arguments:
+        | ``temp`` -- the temperature or an array of temperatures, all strictly
+                      positive
+        | ``freqs`` -- an array with (positive) frequencies
+
+       Optional arguments:
+        | ``classical`` -- When True, the classical partition function is used.
+                           [default=False]
+        | ``freq_scaling`` -- Scale the frequencies with the given factor.
+                              [default=1]
+        | ``freq_zp`` -- Scale the zero-point energy correction with the given
+                         factor. [default=1]
+    """
+    temp, shape, freqs = _prepare_vibrations(temp, freqs)
+    if (temp <= 0).any():
+        raise NotImplementedError
+    if classical:
+        ones = np.ones(np.broadcast(freqs, temp).shape)
+        zeros = np.zeros(ones.shape)
+        d_freqs = np.array([-ones/freqs, zeros, zeros])
+        d_freq_scaling = np.array([-ones/freq_scaling, zeros, zeros])
+        d_zp_scaling = np.array([zeros, zeros, zeros])
+    else:
+        Af, B, C = _bose_factors(temp, freqs, freq_scaling)
+        # derivatives of the thermal part with respect to the logarithm of Af
+        C1 = C*(1 + C)
+        D0 = -Af*C
+        D1 = Af*(C - Af*C1)
+        D2 = Af*(-2*C + Af*C1*(4 - Af*(1 + 2*C)))
+        # derivatives with respect to the zero-point scaling factor
+        E = freqs*(0.5*planck/boltzmann)/temp
+        d_zp_scaling = np.array([-E, E, -2*E])
+        d_freq_scaling = np.array([D0, D1, D2])/freq_scaling
+        d_freqs = (d_zp_scaling*zp_scaling + np.array([D0, D1, D2]))/freqs
+    return _unflatten(d_freqs, shape), _unflatten(d_freq_scaling, shape), \
+        _unflatten(d_zp_scaling, shape)
 
 
 class Vibrations(Info, StatFysTerms):
     """The vibrational contribution to the partition function."""
-    def __init__(self, classical=False, freq_scaling=1, zp_scaling=1, freq_threshold=None):
+    split_terms = True
+
+    def __init__(self, classical=False, freq_scaling=1, zp_scaling=1, freq_threshold=None, memory_budget=None):
         """
            Optional arguments:
             | ``classical`` -- When True, the vibrations are treated classically
@@ -1250,15 +1778,23 @@ class Vibrations(Info, StatFysTerms):
                                     already indicated as 'almost' zero by the
                                     NMA. This option is only needed to fix some
                                     pathological cases.
+            | ``memory_budget`` -- The maximum size (in bytes) of the
+                                   intermediate arrays when the sum over all
+                                   modes is computed. This is useful for very
+                                   large numbers of modes and temperatures.
+                                   [default=None, i.e. no limit]
         """
         self.classical = classical
         self.freq_scaling = freq_scaling
         self.zp_scaling = zp_scaling
         self.freq_threshold = freq_threshold
+        self.memory_budget = memory_budget
         Info.__init__(self, "vibrational")
 
     def init_part_fun(self, nma, partf):
         """See :meth:`StatFys.init_part_fun`."""
+        if getattr(nma, "partial", False):
+            raise ValueError("The partition function requires all frequencies, not a partial spectrum.")
         zero_indexes = nma.zeros
         nonzero_mask = np.ones(len(nma.freqs), dtype=bool)
         nonzero_mask[zero_indexes] = False
@@ -1272,6 +1808,13 @@ class Vibrations(Info, StatFysTerms):
 
         StatFysTerms.__init__(self, len(self.positive_freqs))
 
+    def compile_part_fun(self, compiler):
+        """See :meth:`StatFys.compile_part_fun`."""
+        compiler.add_oscillators(
+            self.positive_freqs, self.classical, self.freq_scaling,
+            self.zp_scaling
+        )
+
     def dump(self, f):
         """See :meth:`Info.dump`."""
         Info.dump(self, f)
@@ -1306,6 +1849,47 @@ class Vibrations(Info, StatFysTerms):
             self.zp_scaling
         )
 
+    def helpers_terms(self, temp, n):
+        """See :meth:`StatFysTerms.helpers_terms`."""
+        return helpers_vibrations(
+            temp, n, self.positive_freqs, self.classical, self.freq_scaling,
+            self.zp_scaling
+        )
+
+    def helper_terms_block(self, name, temp, n, begin, end):
+        """See :meth:`StatFysTerms.helper_terms_block`."""
+        function = {
+            "helper_terms": helper_vibrations,
+            "helpert_terms": helpert_vibrations,
+            "helpertt_terms": helpertt_vibrations,
+            "helpern_terms": helper_vibrations,
+            "helperv_terms": helper_vibrations,
+            "helpers_terms": helpers_vibrations,
+        }[name]
+        return function(
+            temp, n, self.positive_freqs[begin:end], self.classical,
+            self.freq_scaling, self.zp_scaling
+        )
+
+    def helpers_sensitivity(self, temp):
+        """See :meth:`StatFys.helpers_sensitivity`.
+
+           The keys are ``("freq", i)`` for each positive frequency, followed
+           by ``("freq_scaling",)`` and ``("zp_scaling",)``.
+        """
+        d_freqs, d_freq_scaling, d_zp_scaling = sensitivities_vibrations(
+            temp, self.positive_freqs, self.classical, self.freq_scaling,
+            self.zp_scaling
+        )
+        keys = [("freq", i) for i in xrange(len(self.positive_freqs))]
+        keys.extend([("freq_scaling",), ("zp_scaling",)])
+        derivs = np.concatenate([
+            d_freqs,
+            d_freq_scaling.sum(axis=1)[:,np.newaxis],
+            d_zp_scaling.sum(axis=1)[:,np.newaxis],
+        ], axis=1)
+        return keys, derivs
+
 
 class PartFun(Info, StatFys):
     """The partition function.
@@ -1314,6 +1898,9 @@ class PartFun(Info, StatFys):
        self.terms and makes sure they are properly initialized. It also
        implements all the methods defined in StatFys, e.g. it can compute
        the entropy, the free energy and so on.
+
+       The results of the helper functions can be memoized, see
+       :meth:`enable_cache`.
     """
     __reserved_names__ = set(["terms"])
 
@@ -1360,26 +1947,154 @@ class PartFun(Info, StatFys):
         self.title = nma.title
         self.chemical_formula = nma.chemical_formula
         Info.__init__(self, "total")
+        self._cache = None
+
+    def enable_cache(self, maxsize=128):
+        """Memoize the results of the helper functions.
+
+           Optional argument:
+            | ``maxsize`` -- the maximum number of results kept in the cache.
+                             When the cache is full, the least recently used
+                             result is discarded. [default=128]
+
+           The results are stored per helper function, temperature (or array of
+           temperatures) and power n. All derived quantities (log, entropy,
+           free_energy, ...) go through the helper functions and benefit from
+           the cache.
+
+           The cache is cleared automatically when a parameter of one of the
+           contributions is reassigned, e.g. the frequencies or the energy by
+           the methods :meth:`tamkin.chemmod.BaseModel.alter_freqs` and
+           :meth:`tamkin.chemmod.BaseModel.restore_freqs`. In-place
+           modifications of the arrays of the contributions are detected with
+           a checksum of these arrays.
+        """
+        if maxsize <= 0:
+            raise ValueError("The maximum size of the cache must be strictly positive.")
+        self._cache = OrderedDict()
+        self._cache_maxsize = maxsize
+        self._cache_revision = self._get_revision()
+
+    def disable_cache(self):
+        """Stop memoizing the results of the helper functions."""
+        self._cache = None
+
+    def clear_cache(self):
+        """Discard all memoized results of the helper functions."""
+        if self._cache is not None:
+            self._cache.clear()
+
+    def _get_revision(self):
+        """Return a key that changes when any contribution is modified.
+
+           The key consists of the sum of the revisions of the contributions
+           and a checksum of their arrays, which covers in-place modifications.
+        """
+        checksum = 1
+        for term in self.terms:
+            for key, value in sorted(term.__dict__.iteritems()):
+                if isinstance(value, np.ndarray) and value.dtype != object and \
+                   not key.startswith("_cache"):
+                    checksum = zlib.adler32(np.ascontiguousarray(value), checksum)
+        return sum(term.revision for term in self.terms), checksum
+
+    def _evaluate(self, name, temp, n):
+        """Sum the results of the helper function ``name`` over all terms."""
+        if name == "helpers":
+            return tuple(sum(values) for values in zip(*[
+                term.helpers(temp, n) for term in self.terms
+            ]))
+        else:
+            return sum(getattr(term, name)(temp, n) for term in self.terms)
+
+    def _cached(self, name, temp, n):
+        """Evaluate the helper function ``name``, using the cache if enabled."""
+        if self._cache is None:
+            return self._evaluate(name, temp, n)
+        revision = self._get_revision()
+        if revision != self._cache_revision:
+            self._cache.clear()
+            self._cache_revision = revision
+        temp = np.asarray(temp, dtype=float)
+        key = (name, n, temp.shape, temp.tostring())
+        result = self._cache.pop(key, None)
+        if result is None:
+            result = self._evaluate(name, temp, n)
+            if len(self._cache) >= self._cache_maxsize:
+                self._cache.popitem(last=False)
+        # (Re)insert the result as the most recently used one.
+        self._cache[key] = result
+        if name == "helpers":
+            return tuple(np.copy(value) if isinstance(value, np.ndarray) else value for value in result)
+        elif isinstance(result, np.ndarray):
+            return result.copy()
+        else:
+            return result
 
     def helper(self, temp, n):
         """See :meth:`StatFys.helper`."""
-        return sum(term.helper(temp, n) for term in self.terms)
+        return self._cached("helper", temp, n)
 
     def helpert(self, temp, n):
         """See :meth:`StatFys.helpert`."""
-        return sum(term.helpert(temp, n) for term in self.terms)
+        return self._cached("helpert", temp, n)
 
     def helpertt(self, temp, n):
         """See :meth:`StatFys.helpertt`."""
-        return sum(term.helpertt(temp, n) for term in self.terms)
+        return self._cached("helpertt", temp, n)
 
     def helpern(self, temp, n):
         """See :meth:`StatFys.helpern`."""
-        return sum(term.helpern(temp, n) for term in self.terms)
+        return self._cached("helpern", temp, n)
 
     def helperv(self, temp, n):
         """See :meth:`StatFys.helperv`."""
-        return sum(term.helperv(temp, n) for term in self.terms)
+        return self._cached("helperv", temp, n)
+
+    def helpers(self, temp, n):
+        """See :meth:`StatFys.helpers`."""
+        return self._cached("helpers", temp, n)
+
+    def sensitivity(self, temp):
+        """Compute the first-order sensitivities with respect to the parameters.
+
+           Argument:
+            | ``temp`` -- the temperature or an array of temperatures, all
+                          strictly positive
+
+           Returns a :class:`Sensitivity` object with the analytic derivatives
+           with respect to the positive vibrational frequencies, the electronic
+           energy, the cancelation frequencies of the rotors and the scaling
+           factors of the frequencies and the zero-point energy. All
+           derivatives are computed in one vectorized pass. Contributions that
+           do not implement :meth:`StatFys.helpers_sensitivity` are treated as
+           independent of these parameters.
+        """
+        temp = np.asarray(temp, dtype=float)
+        columns = []
+        for term in self.terms:
+            keys, derivs = term.helpers_sensitivity(temp)
+            columns.extend(zip(keys, derivs.swapaxes(0, 1)))
+        return Sensitivity.from_columns(temp, columns)
+
+    def compile(self):
+        """Return an immutable, array-based copy of this partition function.
+
+           The parameters of all contributions are flattened into a few arrays
+           (frequencies of the harmonic oscillators, energy levels of the
+           rotors, and the constants of the analytic contributions), such that
+           all thermodynamic quantities are evaluated over arrays of
+           temperatures with a handful of vectorized operations. This is useful
+           for large numbers of evaluations, e.g. in parameter sweeps.
+
+           The compiled object does not follow later changes of this partition
+           function. A TypeError is raised when one of the contributions can
+           not be compiled.
+        """
+        compiler = _PartFunCompiler()
+        for term in self.terms:
+            term.compile_part_fun(compiler)
+        return compiler.finish(self.title, self.chemical_formula)
 
     def dump(self, f):
         """See :meth:`Info.dump`."""
@@ -1401,3 +2116,748 @@ class PartFun(Info, StatFys):
         f = file(filename, 'w')
         self.dump(f)
         f.close()
+
+    def save_checkpoint(self, filename):
+        """Write the initialized partition function to a binary file.
+
+           Argument:
+            | ``filename`` -- The name of the file to write to.
+
+           The file contains all parameters of the contributions, e.g. the
+           frequencies, the energy levels and fit coefficients of the rotors
+           and the constants of the external degrees of freedom. The partition
+           function is restored with :meth:`load_checkpoint` without computing
+           the normal modes or solving the rotors again. The memoized results
+           of the helper functions are not saved.
+
+           The file is a numpy .npz archive with a JSON header. It does not
+           rely on pickle. Only the contributions defined in TAMkin can be
+           saved.
+        """
+        checkpoint_classes = _get_checkpoint_classes()
+        arrays = {}
+        records = []
+        for term in self.terms:
+            if checkpoint_classes.get((term.__class__.__module__, term.__class__.__name__)) is not term.__class__:
+                raise TypeError("The contribution '%s' can not be written to a checkpoint." % term.name)
+            state = {}
+            for key, value in term.get_state().iteritems():
+                context = "The parameter '%s' of the contribution '%s'" % (key, term.name)
+                state[key] = _encode_value(value, arrays, context)
+            records.append({
+                "module": term.__class__.__module__,
+                "class": term.__class__.__name__,
+                "state": state,
+            })
+        header = {
+            "format": _checkpoint_format,
+            "version": _checkpoint_version,
+            "title": _encode_value(self.title, arrays, "The title"),
+            "chemical_formula": _encode_value(self.chemical_formula, arrays, "The chemical formula"),
+            "terms": records,
+        }
+        arrays["header"] = np.array(json.dumps(header))
+        f = file(filename, 'wb')
+        try:
+            np.savez(f, **arrays)
+        finally:
+            f.close()
+
+    @classmethod
+    def load_checkpoint(cls, filename):
+        """Read a partition function written by :meth:`save_checkpoint`.
+
+           Argument:
+            | ``filename`` -- The name of the file to read from.
+
+           An IOError is raised when the file is not a valid checkpoint.
+        """
+        f = file(filename, 'rb')
+        try:
+            try:
+                archive = np.load(f, allow_pickle=False)
+                arrays = dict((key, archive[key]) for key in archive.files)
+                header = json.loads(str(arrays.pop("header")[()]))
+            except (IOError, ValueError, KeyError):
+                raise IOError("The file %s is not a partition function checkpoint." % filename)
+        finally:
+            f.close()
+        if header.get("format") != _checkpoint_format:
+            raise IOError("The file %s is not a partition function checkpoint." % filename)
+        if header.get("version") != _checkpoint_version:
+            raise IOError("The partition function checkpoint %s has an unsupported version: %s." % (filename, header.get("version")))
+
+        checkpoint_classes = _get_checkpoint_classes()
+        terms = []
+        for record in header["terms"]:
+            term_cls = checkpoint_classes.get((record["module"], record["class"]))
+            if term_cls is None:
+                raise IOError("The partition function checkpoint %s contains an unknown contribution: %s.%s." % (filename, record["module"], record["class"]))
+            state = dict(
+                (str(key), _decode_value(value, arrays))
+                for key, value in record["state"].iteritems()
+            )
+            term = term_cls.__new__(term_cls)
+            term.set_state(state)
+            terms.append(term)
+
+        result = cls.__new__(cls)
+        result.terms = terms
+        result.vibrational = None
+        result.electronic = None
+        for term in terms:
+            result.__dict__[term.name] = term
+        if result.vibrational is None or result.electronic is None:
+            raise IOError("The partition function checkpoint %s lacks the vibrational or electronic contribution." % filename)
+        result.title = _decode_value(header["title"], arrays)
+        result.chemical_formula = _decode_value(header["chemical_formula"], arrays)
+        Info.__init__(result, "total")
+        result._cache = None
+        return result
+
+
+_checkpoint_format = "tamkin-partfun"
+_checkpoint_version = 1
+
+
+def _get_checkpoint_classes():
+    """Return the contributions that can be restored from a checkpoint.
+
+       The keys are the (module, class name) pairs stored in the checkpoint.
+       Only these classes are instantiated by :meth:`PartFun.load_checkpoint`,
+       such that a checkpoint can not import or call arbitrary code.
+    """
+    from tamkin.rotor import Rotor
+    return dict(
+        ((term_cls.__module__, term_cls.__name__), term_cls)
+        for term_cls in (Electronic, ExtTrans, ExtRot, PCMCorrection, Vibrations, Rotor)
+    )
+
+def _encode_value(value, arrays, context):
+    """Convert a parameter into a JSON object, arrays are added to ``arrays``."""
+    if isinstance(value, (np.ndarray, np.generic)):
+        array = np.asarray(value)
+        if array.dtype.hasobject:
+            raise TypeError("%s is an object array and can not be saved." % context)
+        label = "array%i" % len(arrays)
+        arrays[label] = array
+        return {"array": label, "scalar": isinstance(value, np.generic)}
+    elif isinstance(value, tuple):
+        return {"tuple": [_encode_value(item, arrays, context) for item in value]}
+    elif isinstance(value, list):
+        return {"list": [_encode_value(item, arrays, context) for item in value]}
+    elif value is None or isinstance(value, (bool, int, long, float, basestring)):
+        return {"value": value}
+    else:
+        raise TypeError("%s can not be saved: %s." % (context, type(value)))
+
+
+def _decode_value(record, arrays):
+    """Convert the output of _encode_value back into a parameter."""
+    if "array" in record:
+        array = arrays[record["array"]]
+        if record["scalar"]:
+            return array[()]
+        return array
+    elif "tuple" in record:
+        return tuple(_decode_value(item, arrays) for item in record["tuple"])
+    elif "list" in record:
+        return [_decode_value(item, arrays) for item in record["list"]]
+    else:
+        value = record["value"]
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        return value
+
+
+class Sensitivity(object):
+    """First-order sensitivities of thermodynamic quantities.
+
+       A sensitivity object contains the derivatives of ln(Z), T (d ln(Z)/dT)
+       and T^2 (d^2 ln(Z)/dT^2) with respect to a list of parameters. The
+       derivatives of all other quantities are derived from these. Each
+       parameter is identified by a key, i.e. a tuple whose first element is
+       the kind of parameter:
+
+       * ``"freq"`` -- a positive vibrational frequency
+       * ``"cancel_freq"`` -- the cancelation frequency of a rotor
+       * ``"energy"`` -- an electronic energy
+       * ``"freq_scaling"`` -- the frequency scaling factor
+       * ``"zp_scaling"`` -- the zero-point energy scaling factor
+
+       Instances are created with :meth:`PartFun.sensitivity` or
+       :meth:`tamkin.chemmod.BaseModel.sensitivity`. The methods below return
+       arrays whose first axis runs over the parameters and whose remaining
+       axes correspond to the temperature(s).
+    """
+
+    def __init__(self, temp, keys, derivs):
+        """
+           Arguments:
+            | ``temp`` -- the temperature or an array of temperatures
+            | ``keys`` -- a list with the keys of the parameters
+            | ``derivs`` -- an array with shape (3, len(keys)) + temp.shape
+                            with the derivatives of the three results of the
+                            fused helpers, see :meth:`StatFys.helpers`.
+        """
+        self.temp = np.asarray(temp, dtype=float)
+        self.keys = keys
+        self.derivs = derivs
+
+    @classmethod
+    def from_columns(cls, temp, columns):
+        """Create a sensitivity object from (key, column) pairs.
+
+           Arguments:
+            | ``temp`` -- the temperature or an array of temperatures
+            | ``columns`` -- a list of (key, column) pairs, where column is an
+                             array with shape (3,) + temp.shape
+
+           The columns with the same key are added.
+        """
+        temp = np.asarray(temp, dtype=float)
+        keys = []
+        indexes = {}
+        derivs = []
+        for key, column in columns:
+            index = indexes.get(key)
+            if index is None:
+                indexes[key] = len(keys)
+                keys.append(key)
+                derivs.append(np.array(column, dtype=float))
+            else:
+                derivs[index] += column
+        if len(derivs) == 0:
+            return cls(temp, keys, np.zeros((3, 0) + temp.shape))
+        return cls(temp, keys, np.array(derivs).swapaxes(0, 1))
+
+    def log(self):
+        """Derivatives of :meth:`StatFys.log`."""
+        return self.derivs[0]
+
+    def logt(self):
+        """Derivatives of :meth:`StatFys.logt`."""
+        return self.derivs[1]/self.temp
+
+    def logtt(self):
+        """Derivatives of :meth:`StatFys.logtt`."""
+        return self.derivs[2]/self.temp**2
+
+    def internal_heat(self):
+        """Derivatives of :meth:`StatFys.internal_heat`."""
+        return boltzmann*self.temp*self.derivs[1]
+
+    def heat_capacity(self):
+        """Derivatives of :meth:`StatFys.heat_capacity`."""
+        return boltzmann*(2*self.derivs[1] + self.derivs[2])
+
+    def entropy(self):
+        """Derivatives of :meth:`StatFys.entropy`."""
+        return boltzmann*(self.derivs[0] + self.derivs[1])
+
+    def free_energy(self):
+        """Derivatives of :meth:`StatFys.free_energy`.
+
+           These are also the derivatives of the chemical potential.
+        """
+        return -boltzmann*self.temp*self.derivs[0]
+
+    def propagate(self, quantity, errors):
+        """Linear propagation of independent errors on the parameters.
+
+           Arguments:
+            | ``quantity`` -- the name of the quantity, i.e. one of the
+                              methods of this object, e.g. ``"free_energy"``
+            | ``errors`` -- a dictionary with the standard deviation for each
+                            kind of parameter, e.g.
+                            ``{"freq": 10*lightspeed/centimeter}``. Kinds that
+                            are not present are considered to be exact.
+
+           Returns the standard deviation on the quantity.
+        """
+        derivs = getattr(self, quantity)()
+        sigmas = np.array([errors.get(key[0], 0.0) for key in self.keys])
+        sigmas = sigmas.reshape((-1,) + (1,)*self.temp.ndim)
+        return np.sqrt(((derivs*sigmas)**2).sum(axis=0))
+
+
+class _PartFunCompiler(object):
+    """Collects the building blocks of a CompiledPartFun object.
+
+       The logarithm of a compiled partition function has the form
+
+       .. math::
+
+           \ln(Z) = a + b \ln(T) + \frac{c}{T}
+                    - \sum_i w_i \ln\left(1 - e^{-x_i/T}\right)
+                    + \sum_s \ln\left(\sum_{j \in s} e^{-\epsilon_j/k_BT}\right)
+
+       The coefficients a and b are different for the helpers n and v.
+    """
+    def __init__(self):
+        self.consts = np.zeros(3) # helper, helpern, helperv
+        self.log_coeffs = np.zeros(3)
+        self.inv_coeff = 0.0
+        self.osc_x = []
+        self.osc_w = []
+        self.level_sets = []
+        self.level_checks = []
+
+    def add_analytic(self, const, log_coeff=0.0, inv_coeff=0.0, const_n=None, log_coeff_n=None, const_v=None, log_coeff_v=None):
+        """Add a contribution of the form a + b*ln(T) + c/T.
+
+           Arguments:
+            | ``const`` -- the constant a
+            | ``log_coeff`` -- the coefficient b
+            | ``inv_coeff`` -- the coefficient c
+
+           The optional arguments const_n, log_coeff_n, const_v and log_coeff_v
+           are the values of a and b for helpern and helperv. They default to
+           const and log_coeff.
+        """
+        if const_n is None:
+            const_n = const
+        if log_coeff_n is None:
+            log_coeff_n = log_coeff
+        if const_v is None:
+            const_v = const_n
+        if log_coeff_v is None:
+            log_coeff_v = log_coeff_n
+        self.consts += [const, const_n, const_v]
+        self.log_coeffs += [log_coeff, log_coeff_n, log_coeff_v]
+        self.inv_coeff += inv_coeff
+
+    def add_oscillators(self, freqs, classical=False, freq_scaling=1, zp_scaling=1, weight=1):
+        """Add a set of harmonic oscillators.
+
+           Arguments:
+            | ``freqs`` -- an array with frequencies
+
+           Optional arguments:
+            | ``classical``, ``freq_scaling``, ``zp_scaling`` -- see
+              :func:`helper_vibrations`
+            | ``weight`` -- a factor for the contributions of the oscillators,
+                            e.g. -1 to cancel vibrational modes. [default=1]
+        """
+        freqs = np.array(freqs, dtype=float, ndmin=1)
+        if classical:
+            self.add_analytic(
+                -weight*np.log(planck*freqs*freq_scaling/boltzmann).sum(),
+                weight*len(freqs)
+            )
+        else:
+            self.add_analytic(0.0, inv_coeff=-weight*(0.5*planck*zp_scaling/boltzmann)*freqs.sum())
+            self.osc_x.append(freqs*(freq_scaling*planck/boltzmann))
+            self.osc_w.append(np.zeros(len(freqs)) + weight)
+
+    def add_levels(self, energy_levels, check=False):
+        """Add a system with discrete energy levels.
+
+           Argument:
+            | ``energy_levels`` -- an array with energy levels
+
+           Optional argument:
+            | ``check`` -- see :func:`helper_levels`
+        """
+        energy_levels = np.sort(energy_levels)
+        self.add_analytic(0.0, inv_coeff=-energy_levels[0]/boltzmann)
+        self.level_sets.append(energy_levels - energy_levels[0])
+        self.level_checks.append(check)
+
+    def finish(self, title, chemical_formula):
+        """Return the CompiledPartFun object."""
+        if len(self.osc_x) > 0:
+            osc_x = np.concatenate(self.osc_x)
+            osc_w = np.concatenate(self.osc_w)
+        else:
+            osc_x = np.zeros(0)
+            osc_w = np.zeros(0)
+        if len(self.level_sets) > 0:
+            levels = np.concatenate(self.level_sets)
+            level_offsets = np.cumsum([0] + [len(l) for l in self.level_sets[:-1]])
+        else:
+            levels = np.zeros(0)
+            level_offsets = np.zeros(0, int)
+        return CompiledPartFun(
+            title, chemical_formula, self.consts, self.log_coeffs,
+            self.inv_coeff, osc_x, osc_w, levels, level_offsets,
+            np.array(self.level_checks, dtype=bool)
+        )
+
+
+class CompiledPartFun(StatFys):
+    """An immutable, array-based partition function.
+
+       Instances are created with :meth:`PartFun.compile`. All the methods
+       defined in StatFys are available and accept arrays of temperatures.
+       Zero temperatures are supported when the limit T -> 0 exists, e.g. to
+       compute the zero-point energy. Otherwise, a NotImplementedError is
+       raised, as in PartFun.
+    """
+    __slots__ = [
+        "name", "title", "chemical_formula", "consts", "log_coeffs",
+        "inv_coeff", "osc_x", "osc_w", "levels", "level_offsets",
+        "level_checks",
+    ]
+
+    def __init__(self, title, chemical_formula, consts, log_coeffs, inv_coeff,
+                 osc_x, osc_w, levels, level_offsets, level_checks):
+        """See :class:`_PartFunCompiler` for the meaning of the arguments."""
+        object.__setattr__(self, "name", "total")
+        values = [
+            title, chemical_formula, consts, log_coeffs, inv_coeff, osc_x,
+            osc_w, levels, level_offsets, level_checks,
+        ]
+        for key, value in zip(self.__slots__[1:], values):
+            if isinstance(value, np.ndarray):
+                value = value.copy()
+                value.setflags(write=False)
+            object.__setattr__(self, key, value)
+
+    def __setattr__(self, name, value):
+        raise TypeError("CompiledPartFun objects are immutable.")
+
+    def __delattr__(self, name):
+        raise TypeError("CompiledPartFun objects are immutable.")
+
+    def _evaluate(self, temp, order):
+        """Compute ln(Z) and its temperature derivatives up to the given order.
+
+           Arguments:
+            | ``temp`` -- a flat array with strictly positive temperatures
+            | ``order`` -- the highest order of the derivatives (0, 1 or 2)
+
+           Returns a list with order+1 arrays. The first array only contains
+           the contributions that are common to helper, helpern and helperv.
+        """
+        results = [
+            self.inv_coeff/temp,
+            -self.inv_coeff/temp**2,
+            2*self.inv_coeff/temp**3,
+        ][:order+1]
+        if len(self.osc_x) > 0:
+            u = np.outer(self.osc_x, 1.0/temp)
+            B = np.exp(-u)
+            results[0] -= np.dot(self.osc_w, np.log(1 - B))
+            if order > 0:
+                C = B/(1 - B)
+                results[1] += np.dot(self.osc_w, u*C)/temp
+            if order > 1:
+                results[2] += np.dot(self.osc_w, u*C*(u*(1 + C) - 2))/temp**2
+        if len(self.levels) > 0:
+            beta = 1.0/(boltzmann*temp)
+            bfs = np.exp(-np.outer(self.levels, beta))
+            Z = np.add.reduceat(bfs, self.level_offsets, axis=0)
+            if self.level_checks.any():
+                bfs_min = np.minimum.reduceat(bfs, self.level_offsets, axis=0)
+                if (bfs_min[self.level_checks]/Z[self.level_checks] > 0.01).any():
+                    raise ValueError('The highest energy level is occupied by more than 1%.')
+            results[0] += np.log(Z).sum(axis=0)
+            if order > 0:
+                e1 = np.add.reduceat(self.levels[:,None]*bfs, self.level_offsets, axis=0)/Z
+                results[1] += (e1.sum(axis=0))*beta/temp
+            if order > 1:
+                e2 = np.add.reduceat((self.levels**2)[:,None]*bfs, self.level_offsets, axis=0)/Z
+                results[2] += ((e2 - e1**2).sum(axis=0)*beta - 2*e1.sum(axis=0))*beta/temp**2
+        return results
+
+    def _zero_limit(self, n, order):
+        """The limit T -> 0 of T^n times a temperature derivative of ln(Z).
+
+           Arguments:
+            | ``n`` -- the power of the temperature
+            | ``order`` -- the order of the derivative (0, 1 or 2)
+
+           Only the term inv_coeff/T of ln(Z) contributes to the limit. A
+           NotImplementedError is raised when the limit does not exist.
+        """
+        if n < order + 1:
+            raise NotImplementedError("The limit T -> 0 does not exist.")
+        elif n == order + 1:
+            return [1, -1, 2][order]*self.inv_coeff
+        else:
+            return 0.0
+
+    def _helper_channel(self, temp, n, order, channel):
+        """Common part of all helper functions.
+
+           Arguments:
+            | ``temp`` -- the temperature or an array of temperatures
+            | ``n`` -- the power of the temperature
+            | ``order`` -- the highest order of the derivatives (0, 1 or 2)
+            | ``channel`` -- 0, 1 or 2 to include the constant terms of helper,
+                             helpern or helperv, respectively
+
+           Returns a list with order+1 items: T^(n+k) times the k-th
+           temperature derivative of ln(Z), for k = 0 ... order.
+        """
+        temp, shape = _flatten_temp(temp)
+        if (temp < 0).any():
+            raise ValueError("The temperatures can not be negative.")
+        zero = (temp == 0)
+        results = [np.zeros(temp.shape) for k in xrange(order+1)]
+        if zero.any():
+            for k in xrange(order+1):
+                results[k][zero] = self._zero_limit(n+k, k)
+        if not zero.all():
+            pos = temp[~zero]
+            derivs = self._evaluate(pos, order)
+            derivs[0] += self.consts[channel] + self.log_coeffs[channel]*np.log(pos)
+            if order > 0:
+                derivs[1] += self.log_coeffs[channel]/pos
+            if order > 1:
+                derivs[2] -= self.log_coeffs[channel]/pos**2
+            for k in xrange(order+1):
+                results[k][~zero] = derivs[k]*pos**(n+k)
+        return [_unflatten(result, shape) for result in results]
+
+    def helper(self, temp, n):
+        """See :meth:`StatFys.helper`."""
+        return self._helper_channel(temp, n, 0, 0)[0]
+
+    def helpern(self, temp, n):
+        """See :meth:`StatFys.helpern`."""
+        return self._helper_channel(temp, n, 0, 1)[0]
+
+    def helperv(self, temp, n):
+        """See :meth:`StatFys.helperv`."""
+        return self._helper_channel(temp, n, 0, 2)[0]
+
+    def helpert(self, temp, n):
+        """See :meth:`StatFys.helpert`."""
+        return self._helper_channel(temp, n-1, 1, 0)[1]
+
+    def helpertt(self, temp, n):
+        """See :meth:`StatFys.helpertt`."""
+        return self._helper_channel(temp, n-2, 2, 0)[2]
+
+    def helpers(self, temp, n):
+        """See :meth:`StatFys.helpers`."""
+        return tuple(self._helper_channel(temp, n, 2, 0))
+
+
+# Inverse of the linear system that maps the coefficients of a quintic
+# polynomial p(t), 0 <= t <= 1, on p(0), p'(0), p''(0), p(1), p'(1) and p''(1).
+_quintic_hermite = np.linalg.inv(np.array([
+    [1, 0, 0, 0, 0, 0],
+    [0, 1, 0, 0, 0, 0],
+    [0, 0, 2, 0, 0, 0],
+    [1, 1, 1, 1, 1, 1],
+    [0, 1, 2, 3, 4, 5],
+    [0, 0, 2, 6, 12, 20],
+], float))
+
+
+class SplinePartFun(StatFys):
+    """A piecewise polynomial surrogate for ln(Z) on a temperature interval.
+
+       The function T*ln(Z), i.e. minus the free energy divided by Boltzmann's
+       constant, is interpolated with quintic Hermite polynomials that
+       reproduce the function and its first and second order temperature
+       derivatives at the knots. (The first derivative is the entropy over
+       Boltzmann's constant.) All other quantities are derived from the
+       interpolant and its exact derivatives, such that they are mutually
+       consistent. The electronic contribution, ln(g) - E/(kT), is not
+       interpolated but added analytically. Otherwise, its large energy offset
+       would cancel in the derivatives of T*ln(Z), leaving rounding errors that
+       are amplified by the interpolation. The limit of T*ln(Z) for T -> 0 of
+       the other contributions is also subtracted before the interpolation. The
+       knots are refined adaptively until the requested tolerance is met.
+
+       Evaluations only involve a binary search for the interval and a few
+       polynomial evaluations, i.e. the cost is O(log(num_knots)) per
+       temperature, independent of the complexity of the original partition
+       function. The methods log, logt, logtt, logn, logv, internal_heat,
+       heat_capacity, entropy, free_energy and chemical_potential are supported
+       for temperatures within the interval. The derivatives of ln(Z) towards
+       the number of particles and the volume (helpern and helperv) only differ
+       from ln(Z) by the translational terms, which are represented exactly as
+       a + b*ln(T). The surrogate does not follow later changes of the original
+       partition function.
+    """
+
+    def __init__(self, pf, temp_low, temp_high, rtol=1e-8, max_knots=100000):
+        """
+           Arguments:
+            | ``pf`` -- a StatFys object, usually a PartFun object
+            | ``temp_low`` -- the lowest temperature of the interval (> 0)
+            | ``temp_high`` -- the highest temperature of the interval
+
+           Optional arguments:
+            | ``rtol`` -- the relative tolerance. The absolute error on ln(Z),
+                          i.e. the relative error on Z, and the relative errors
+                          on the entropy and the heat capacity (in units of
+                          Boltzmann's constant) are below this threshold. (The
+                          latter two are used as absolute errors when their
+                          magnitude is smaller than one.) [default=1e-8]
+            | ``max_knots`` -- the maximum number of knots. A ValueError is
+                               raised when the tolerance can not be reached
+                               with this number of knots. [default=100000]
+        """
+        if temp_low <= 0:
+            raise ValueError("The lowest temperature must be strictly positive.")
+        if temp_high <= temp_low:
+            raise ValueError("The highest temperature must be larger than the lowest temperature.")
+        if rtol <= 0:
+            raise ValueError("The relative tolerance must be strictly positive.")
+        self.name = "total"
+        self.title = getattr(pf, "title", None)
+        self.chemical_formula = getattr(pf, "chemical_formula", None)
+        self.temp_low = float(temp_low)
+        self.temp_high = float(temp_high)
+        self.rtol = rtol
+        # The electronic terms are added analytically and the other terms
+        # are interpolated.
+        self.log_multiplicity = 0.0
+        self.offset = 0.0
+        terms = []
+        for term in getattr(pf, "terms", [pf]):
+            if isinstance(term, Electronic):
+                self.log_multiplicity += np.log(term.multiplicity)
+                self.offset -= term.energy/boltzmann
+            else:
+                terms.append(term)
+        try:
+            self.offset_sampled = sum(float(term.helper(np.array([0.0]), 1)[0]) for term in terms)
+        except NotImplementedError:
+            self.offset_sampled = sum(float(term.helper(np.array([self.temp_low]), 1)[0]) for term in terms)
+
+        knots = np.exp(np.linspace(np.log(temp_low), np.log(temp_high), 9))
+        values = self._sample(terms, knots)
+        while True:
+            coeffs = self._fit(knots, values)
+            # The errors are tested at the center and the quarters of each
+            # interval. (The error on the first derivative vanishes at the
+            # center.) The exact values at the centers become new knots where
+            # the tolerance is not met.
+            width = knots[1:] - knots[:-1]
+            tests = np.concatenate([knots[:-1] + frac*width for frac in 0.5, 0.25, 0.75])
+            exact = self._sample(terms, tests)
+            approx = self._eval(knots, coeffs, tests)
+            failed = abs(approx[0] - exact[0]) > rtol*tests
+            for i in 1, 2:
+                error = abs(approx[i] - exact[i])*tests**(i-1)
+                failed |= error > rtol*np.maximum(abs(exact[i])*tests**(i-1), 1.0)
+            failed = failed.reshape(3, -1).any(axis=0)
+            centers = tests[:len(width)]
+            exact = exact[:,:len(width)]
+            if not failed.any():
+                break
+            if len(knots) + failed.sum() > max_knots:
+                raise ValueError("Could not reach the relative tolerance %s with %i knots." % (rtol, max_knots))
+            knots = np.concatenate([knots, centers[failed]])
+            order = knots.argsort()
+            knots = knots[order]
+            values = np.concatenate([values, exact[:,failed]], axis=1)[:,order]
+        self.knots = knots
+        self.coeffs = coeffs
+        self.coeffs_n = self._fit_log_linear(pf.helpern, pf, knots)
+        self.coeffs_v = self._fit_log_linear(pf.helperv, pf, knots)
+
+    def _sample(self, terms, temp):
+        """Return an array with T*ln(Z) of the interpolated terms, minus its
+           offset, and its first and second derivative."""
+        h, ht, htt = np.zeros(temp.shape), np.zeros(temp.shape), np.zeros(temp.shape)
+        for term in terms:
+            term_h, term_ht, term_htt = term.helpers(temp, 0)
+            h += term_h
+            ht += term_ht
+            htt += term_htt
+        return np.array([temp*h - self.offset_sampled, h + ht, (2*ht + htt)/temp])
+
+    def _fit_log_linear(self, helper, pf, knots):
+        """Fit the difference between a helper and pf.helper as a + b*ln(T).
+
+           A ValueError is raised when the difference is not of this form.
+        """
+        diff = helper(knots, 0) - pf.helper(knots, 0)
+        basis = np.array([np.ones(len(knots)), np.log(knots)]).T
+        coeffs = np.linalg.lstsq(basis, diff, rcond=-1)[0]
+        if abs(np.dot(basis, coeffs) - diff).max() > self.rtol*max(abs(diff).max(), 1.0):
+            raise ValueError("The partition function depends on the number of particles or the volume in a way that can not be interpolated.")
+        return coeffs
+
+    def _fit(self, knots, values):
+        """Compute the polynomial coefficients for each interval."""
+        width = knots[1:] - knots[:-1]
+        # The increments of T*ln(Z) over the intervals are not taken from the
+        # sampled values, which contain rounding errors proportional to the
+        # energy offset, e.g. the electronic energy. These errors would be
+        # amplified in the second derivative of the polynomials. Instead,
+        # the increments are obtained by integrating the first derivative with
+        # the Euler-Maclaurin formula. The value at the left knot is only added
+        # to the constant term at the end.
+        deltas = 0.5*width*(values[1][1:] + values[1][:-1]) + \
+            width**2*(values[2][:-1] - values[2][1:])/12
+        rhs = np.array([
+            np.zeros(len(width)), width*values[1][:-1], width**2*values[2][:-1],
+            deltas, width*values[1][1:], width**2*values[2][1:],
+        ])
+        coeffs = np.dot(_quintic_hermite, rhs).T
+        coeffs[:,0] += values[0][0]
+        coeffs[1:,0] += deltas.cumsum()[:-1]
+        return coeffs
+
+    def _eval(self, knots, coeffs, temp):
+        """Evaluate T*ln(Z) and its first and second order derivatives.
+
+           Arguments:
+            | ``knots`` -- the sorted array of knots
+            | ``coeffs`` -- the array with coefficients, one row per interval
+            | ``temp`` -- a flat array with temperatures
+        """
+        index = np.clip(knots.searchsorted(temp, side="right") - 1, 0, len(coeffs) - 1)
+        width = knots[index+1] - knots[index]
+        t = (temp - knots[index])/width
+        c = coeffs[index].T
+        p = c[0] + t*(c[1] + t*(c[2] + t*(c[3] + t*(c[4] + t*c[5]))))
+        dp = c[1] + t*(2*c[2] + t*(3*c[3] + t*(4*c[4] + t*5*c[5])))
+        ddp = 2*c[2] + t*(6*c[3] + t*(12*c[4] + t*20*c[5]))
+        return p, dp/width, ddp/width**2
+
+    def _evaluate(self, temp):
+        """Check the temperatures and evaluate ln(Z) and its derivatives."""
+        temp, shape = _flatten_temp(temp)
+        if (temp < self.temp_low).any() or (temp > self.temp_high).any():
+            raise ValueError("The temperature is outside the interval [%s, %s] of the surrogate." % (self.temp_low, self.temp_high))
+        g, gt, gtt = self._eval(self.knots, self.coeffs, temp)
+        log = (g + self.offset_sampled + self.offset)/temp + self.log_multiplicity
+        logt = (gt - log)/temp
+        logtt = (gtt - 2*logt)/temp
+        return temp, shape, (log, logt, logtt)
+
+    def helper(self, temp, n):
+        """See :meth:`StatFys.helper`."""
+        temp, shape, (log, logt, logtt) = self._evaluate(temp)
+        return _unflatten(log*temp**n, shape)
+
+    def helpert(self, temp, n):
+        """See :meth:`StatFys.helpert`."""
+        temp, shape, (log, logt, logtt) = self._evaluate(temp)
+        return _unflatten(logt*temp**n, shape)
+
+    def helpertt(self, temp, n):
+        """See :meth:`StatFys.helpertt`."""
+        temp, shape, (log, logt, logtt) = self._evaluate(temp)
+        return _unflatten(logtt*temp**n, shape)
+
+    def helpern(self, temp, n):
+        """See :meth:`StatFys.helpern`."""
+        temp, shape, (log, logt, logtt) = self._evaluate(temp)
+        a, b = self.coeffs_n
+        return _unflatten((log + a + b*np.log(temp))*temp**n, shape)
+
+    def helperv(self, temp, n):
+        """See :meth:`StatFys.helperv`."""
+        temp, shape, (log, logt, logtt) = self._evaluate(temp)
+        a, b = self.coeffs_v
+        return _unflatten((log + a + b*np.log(temp))*temp**n, shape)
+
+    def helpers(self, temp, n):
+        """See :meth:`StatFys.helpers`."""
+        temp, shape, (log, logt, logtt) = self._evaluate(temp)
+        return (
+            _unflatten(log*temp**n, shape),
+            _unflatten(logt*temp**(n+1), shape),
+            _unflatten(logtt*temp**(n+2), shape),
+        )
@@ -46,15 +46,35 @@ from tamkin.partf import PartFun
 __all__ = ["ThermoAnalysis", "ThermoTable", "ReactionAnalysis"]
 
 
+# Quantities that can be derived from the results of the fused helpers, i.e.
+# from helper(T, 0), helpert(T, 1) and helpertt(T, 2). These are only valid at
+# strictly positive temperatures.
+_fused_quantities = {
+    "internal_heat": (lambda temps, h, ht, htt: boltzmann*temps*ht),
+    "heat_capacity": (lambda temps, h, ht, htt: boltzmann*(2*ht + htt)),
+    "free_energy": (lambda temps, h, ht, htt: -boltzmann*temps*h),
+    "entropy": (lambda temps, h, ht, htt: boltzmann*(h + ht)),
+    "log": (lambda temps, h, ht, htt: h),
+    "logt": (lambda temps, h, ht, htt: ht/temps),
+    "logtt": (lambda temps, h, ht, htt: htt/temps**2),
+}
+
+
 class ThermoAnalysis(object):
     """Perform a regular thermochemistry analysis."""
 
-    def __init__(self, pf, temps):
+    def __init__(self, pf, temps, terms=True):
         """
            Arguments:
             | ``pf`` -- A partition function
             | ``temps`` -- An array with temperatures to consider.
 
+           Optional argument:
+            | ``terms`` -- When False, the rows for the individual terms of
+                           contributions with multiple terms, e.g. each
+                           vibrational mode, are left out of the tables.
+                           [default=True]
+
            The tables with energy, free energy, heat capacity, entropy,
            logarithm of the partition function and the first and second order
            derivative of the logarithm of the partition functions are computed
@@ -63,20 +83,27 @@ class ThermoAnalysis(object):
 
            The results can be written to a csv file with the method
            write_to_file.
+
+           When all temperatures are strictly positive, the fused helpers of
+           each contribution are evaluated only once and shared by all tables.
         """
         self.pf = pf
         self.temps = temps
+        if (numpy.asarray(temps) > 0).all():
+            fused = {}
+        else:
+            fused = None
         self.tables = [
-            ThermoTable("Internal heat", kjmol, "kJ/mol", "internal_heat", pf, temps),
-            ThermoTable("Heat capacity", joule/mol/kelvin, "J/(mol*K)", "heat_capacity", pf, temps),
-            ThermoTable("Free energy", kjmol, "kJ/mol", "free_energy", pf, temps),
-            ThermoTable("Chemical potential", kjmol, "kJ/mol", "chemical_potential", pf, temps),
-            ThermoTable("Entropy", joule/mol/kelvin, "J/(mol*K)", "entropy", pf, temps),
-            ThermoTable("ln(Z_N)/N", 1.0, "1", "log", pf, temps),
-            ThermoTable("1/N d ln(Z_N) / dT", 1.0/kelvin, "1/K", "logt", pf, temps),
-            ThermoTable("1/N d^2 ln(Z_N) / dT^2", 1.0/kelvin**2, "1/K^2", "logtt", pf, temps),
-            ThermoTable("d ln(Z_N) / dN", 1.0, "1", "logn", pf, temps),
-            ThermoTable("d ln(Z_N) / dN - log(V/N)", 1.0, "mixed: 1 or ln(bohr^-dim)", "logv", pf, temps),
+            ThermoTable("Internal heat", kjmol, "kJ/mol", "internal_heat", pf, temps, fused=fused, terms=terms),
+            ThermoTable("Heat capacity", joule/mol/kelvin, "J/(mol*K)", "heat_capacity", pf, temps, fused=fused, terms=terms),
+            ThermoTable("Free energy", kjmol, "kJ/mol", "free_energy", pf, temps, fused=fused, terms=terms),
+            ThermoTable("Chemical potential", kjmol, "kJ/mol", "chemical_potential", pf, temps, terms=terms),
+            ThermoTable("Entropy", joule/mol/kelvin, "J/(mol*K)", "entropy", pf, temps, fused=fused, terms=terms),
+            ThermoTable("ln(Z_N)/N", 1.0, "1", "log", pf, temps, fused=fused, terms=terms),
+            ThermoTable("1/N d ln(Z_N) / dT", 1.0/kelvin, "1/K", "logt", pf, temps, fused=fused, terms=terms),
+            ThermoTable("1/N d^2 ln(Z_N) / dT^2", 1.0/kelvin**2, "1/K^2", "logtt", pf, temps, fused=fused, terms=terms),
+            ThermoTable("d ln(Z_N) / dN", 1.0, "1", "logn", pf, temps, terms=terms),
+            ThermoTable("d ln(Z_N) / dN - log(V/N)", 1.0, "mixed: 1 or ln(bohr^-dim)", "logv", pf, temps, terms=terms),
         ]
 
     def write_to_file(self, filename):
@@ -104,7 +131,7 @@ class ThermoTable(object):
        specific thermodynamic quantity.
     """
 
-    def __init__(self, label, unit, unit_name, method_name, pf, temps, pf_method_name=None):
+    def __init__(self, label, unit, unit_name, method_name, pf, temps, pf_method_name=None, fused=None, terms=True):
         """This object is used by the ThermoAnalysis class and should probably
            never be used directly.
 
@@ -125,6 +152,17 @@ class ThermoTable(object):
                                     compute to quantity of interest. This
                                     workaround is required due to poor naming
                                     conventions in statistical physics.
+            | ``fused`` -- A dictionary in which the results of the fused
+                           helpers are stored. When given, quantities that can
+                           be derived from the fused helpers are computed with
+                           the results in this dictionary, which are computed
+                           first if needed. The same dictionary can be shared by
+                           multiple tables. All temperatures must be strictly
+                           positive in this case.
+            | ``terms`` -- When False, the rows for the individual terms of
+                           contributions with multiple terms are not computed.
+                           This saves memory for large numbers of terms, e.g.
+                           vibrational modes. [default=True]
 
            The results are stored in an array self.data of which the columns
            correspond to the given temperatures and the rows correspond to the
@@ -144,6 +182,12 @@ class ThermoTable(object):
         self.temps = temps
         self.pf_method_name = pf_method_name
 
+        # All temperatures are processed at once.
+        temps_array = numpy.array(temps, dtype=float).ravel()
+        derive = None
+        if fused is not None and pf_method_name == method_name:
+            derive = _fused_quantities.get(method_name)
+
         self.keys = []
         data =  []
         for term in [pf] + pf.terms:
@@ -153,20 +197,33 @@ class ThermoTable(object):
             else:
                 method = getattr(term, method_name, None)
             if isinstance(method, types.MethodType):
-                row = []
-                for temp in temps:
-                    row.append(method(temp))
-                data.append(numpy.array(row,ndmin=2))
+                if derive is None:
+                    row = method(temps_array)
+                else:
+                    row = derive(temps_array, *self._get_fused(fused, term.helpers, temps_array))
+                data.append(numpy.array(row, ndmin=2))
+            if not terms:
+                continue
             method = getattr(term, "%s_terms" % method_name, None)
             if isinstance(method, types.MethodType):
-                columns = []
                 for i in xrange(term.num_terms):
                     self.keys.append("%s (%i)" % (term.name, i))
-                for temp in temps:
-                    columns.append(method(temp))
-                data.append(numpy.array(columns).transpose())
+                if derive is None:
+                    rows = method(temps_array)
+                else:
+                    rows = derive(temps_array, *self._get_fused(fused, term.helpers_terms, temps_array))
+                data.append(numpy.reshape(rows, (term.num_terms, len(temps_array))))
         self.data = numpy.concatenate(data)
 
+    def _get_fused(self, fused, helpers, temps):
+        """Return the fused helpers, reusing earlier results from the dictionary fused."""
+        key = (helpers.__self__, helpers.__name__)
+        result = fused.get(key)
+        if result is None:
+            result = helpers(temps, 0)
+            fused[key] = result
+        return result
+
     def dump(self, f):
         """Dumps the table in csv format
 
@@ -223,15 +280,10 @@ class ReactionAnalysis(object):
         # make sure that the final temperature is included
         self.temps = numpy.arange(self.temp_low,self.temp_high+0.5*self.temp_step,self.temp_step,dtype=float)
         self.temps_inv = 1/self.temps
-        self.ln_rate_consts = numpy.array([
-            self.kinetic_model.rate_constant(temp, do_log=True)
-            for temp in self.temps
-        ])
+        self.ln_rate_consts = self.kinetic_model.rate_constant(self.temps, do_log=True)
         self.rate_consts = numpy.exp(self.ln_rate_consts)
 
-        design_matrix = numpy.zeros((len(self.temps),2), float)
-        design_matrix[:,0] = 1
-        design_matrix[:,1] = -self.temps_inv/boltzmann
+        design_matrix = self._get_design_matrix()
         expected_values = self.ln_rate_consts
         if not numpy.isfinite(expected_values).all():
             raise ValueError("non-finite rate constants. check your partition functions for errors.")
@@ -246,6 +298,13 @@ class ReactionAnalysis(object):
 
         self.covariance = None # see monte_carlo method
 
+    def _get_design_matrix(self):
+        """Return the design matrix of the Arrhenius fit."""
+        design_matrix = numpy.zeros((len(self.temps),2), float)
+        design_matrix[:,0] = 1
+        design_matrix[:,1] = -self.temps_inv/boltzmann
+        return design_matrix
+
     def dump(self, f):
         """Write the results in text format on screen or to another stream.
 
@@ -260,7 +319,10 @@ class ReactionAnalysis(object):
         print >> f
         if self.covariance is not None:
             print >> f, "Error analysis"
-            print >> f, "Number of Monte Carlo iterations = %i" % self.monte_carlo_iter
+            if self.monte_carlo_iter is None:
+                print >> f, "Linear error propagation"
+            else:
+                print >> f, "Number of Monte Carlo iterations = %i" % self.monte_carlo_iter
             print >> f, "Relative systematic error on the frequencies = %.2f" % self.freq_error
             print >> f, "Relative systematic error on the energy = %.2f" % self.energy_error
             print >> f, "Error on A [%s] = %10.5e" % (self.kinetic_model.unit_name, numpy.sqrt(self.covariance[0,0])*self.A/self.kinetic_model.unit)
@@ -278,11 +340,10 @@ class ReactionAnalysis(object):
             self.kinetic_model.tunneling.dump(f)
         print >> f, "Reaction rate constants"
         print >> f, "    T [K]    Delta_r F [kJ/mol]      k(T) [%s]" % (self.kinetic_model.unit_name)
+        delta_frees = self.kinetic_model.free_energy_change(self.temps)
         for i in xrange(len(self.temps)):
-            temp = self.temps[i]
-            delta_free = self.kinetic_model.free_energy_change(temp)
             print >> f, "% 10.2f      %8.1f             % 10.5e" % (
-                temp, delta_free/kjmol, self.rate_consts[i]/self.kinetic_model.unit
+                self.temps[i], delta_frees[i]/kjmol, self.rate_consts[i]/self.kinetic_model.unit
             )
         print >> f
         self.kinetic_model.dump(f)
@@ -364,7 +425,7 @@ class ReactionAnalysis(object):
            method.
 
            Optional argument:
-            | ``freq_error`` -- The with of the absolute gaussian distortion on
+            | ``freq_error`` -- The width of the absolute gaussian distortion on
                                 the frequencies [default=1*invcm]
             | ``energy_error`` -- The width of the relative gaussian error on
                                   the energy barrier [default=0.00]
@@ -400,6 +461,46 @@ class ReactionAnalysis(object):
 
         self.kinetic_model.restore_freqs()
 
+    def error_propagation(self, freq_error=1*(lightspeed/centimeter), energy_error=0.00):
+        """Estimate the uncertainty on the parameters with linear error propagation
+
+           This is a fast alternative for :meth:`monte_carlo` with the same
+           model for the errors. The covariance matrix of the parameters is
+           computed from the analytic derivatives of the rate constants with
+           respect to the frequencies and the energies (see
+           :meth:`tamkin.chemmod.BaseModel.sensitivity`). No partition
+           functions are recomputed.
+
+           Optional argument:
+            | ``freq_error`` -- The width of the absolute gaussian distortion on
+                                the (positive) frequencies [default=1*invcm]
+            | ``energy_error`` -- The width of the relative gaussian error on
+                                  the electronic energies [default=0.00]
+        """
+        if freq_error < 0.0:
+            raise ValueError("The argument freq_error must be positive.")
+        if energy_error < 0.0:
+            raise ValueError("The argument energy_error must be positive.")
+        self.freq_error = freq_error
+        self.energy_error = energy_error
+        self.monte_carlo_iter = None
+        self.monte_carlo_samples = None
+
+        sensitivity = self.kinetic_model.sensitivity(self.temps)
+        rows = []
+        energy_row = numpy.zeros(len(self.temps))
+        for key, row in zip(sensitivity.keys, sensitivity.log()):
+            if key[0] == "freq":
+                rows.append(freq_error*row)
+            elif key[0] == "energy":
+                # all energies are scaled by the same random factor
+                energy_row += key[1].electronic.energy*row
+        rows.append(energy_error*energy_row)
+        # linear map from ln(k) on the grid to the fitted parameters
+        fit_map = numpy.linalg.pinv(self._get_design_matrix())
+        deltas = numpy.dot(rows, fit_map.transpose())
+        self.covariance = numpy.dot(deltas.transpose(), deltas)
+
     def plot_parameters(self, filename=None, label=None, color="red", marker="o", error=True):
         """Plot the kinetic parameters.
 
@@ -461,12 +562,13 @@ class ReactionAnalysis(object):
                 self.parameters[0] + data[0] - numpy.log(self.kinetic_model.unit),
                 color=color, linestyle="-", marker="None",label=label_error
             )
-            pt.plot(
-                self.monte_carlo_samples[:,1]/kjmol,
-                self.monte_carlo_samples[:,0] - numpy.log(self.kinetic_model.unit),
-                color=color, marker=".", label=label_scatter, linestyle="None",
-                markersize=1.2
-            )
+            if self.monte_carlo_samples is not None:
+                pt.plot(
+                    self.monte_carlo_samples[:,1]/kjmol,
+                    self.monte_carlo_samples[:,0] - numpy.log(self.kinetic_model.unit),
+                    color=color, marker=".", label=label_scatter, linestyle="None",
+                    markersize=1.2
+                )
         pt.plot([self.Ea/kjmol],[numpy.log(self.A/self.kinetic_model.unit)], color=color,
                    marker=marker, label=label_point, mew=2, mec="white", ms=10)
         if label is None:
@@ -41,10 +41,12 @@
    [1] Chemical Physics, Vol. 328 (1-3) 251 - 258, 2006
 """
 
-from tamkin.partf import Info, StatFysTerms, helper_vibrations, \
-    helpert_vibrations, helpertt_vibrations, helper_levels, helpert_levels, \
-    helpertt_levels
+from tamkin.partf import Info, StatFysTerms, LevelSet, helper_vibrations, \
+    helpert_vibrations, helpertt_vibrations, helpers_vibrations, \
+    sensitivities_vibrations, \
+    helper_levels, helpert_levels, helpertt_levels, helpers_levels
 from tamkin.nma import NMA, MBH
+from tamkin.data import RotScan
 from tamkin.geom import transrot_basis
 
 from molmod import deg, kjmol, angstrom, centimeter, amu, boltzmann, \
@@ -365,10 +367,15 @@ class Rotor(Info, StatFysTerms):
        frequency of this motion as if it was treated as a harmonic oscillator.
        The corresponding contribution to the partition function is subtracted.
        (Use compute_cancel_frequency to obtain this frequency.)
+
+       More energy levels are solved when the occupation of the highest level
+       exceeds ``level_threshold`` at one of the requested temperatures.
     """
+    level_threshold = 1e-4
+
     def __init__(self, rot_scan, molecule=None, cancel_freq='mbh', suffix=None,
                  rotsym=1, even=False, num_levels=50, dofmax=5,
-                 v_threshold=0.01, large_fixed=False):
+                 v_threshold=0.01, large_fixed=False, max_levels=1600):
         """
            Arguments:
             | ``rot_scan`` -- A rotational scan object. (free or hindered rotor
@@ -391,8 +398,12 @@ class Rotor(Info, StatFysTerms):
             | ``rotsym`` -- The rotational symmetry of the rotor. [default=1]
             | ``even`` -- True of the rotor is not chiral, i.e. when it has an
                           even potential
-            | ``num_levels`` -- The number of energy levels considered in the
-                                QM treatment of the rotor [default=50]
+            | ``num_levels`` -- The initial number of energy levels considered
+                                in the QM treatment of the rotor. When the
+                                highest level becomes occupied at a requested
+                                temperature (see level_threshold), the number of
+                                levels is doubled (up to max_levels) and the
+                                levels are solved again. [default=50]
             | ``dofmax`` -- The maximum number of cosines used to represent the
                             torsional potential. if the potential is not even,
                             the same number of sines is also used. [default=5]
@@ -405,6 +416,10 @@ class Rotor(Info, StatFysTerms):
                                  rotates. (this means that the absolute moment
                                  of the rotor is used instead of the relative
                                  moment)
+            | ``max_levels`` -- The maximum number of energy levels. A
+                                ValueError is raised when the highest of these
+                                levels is still occupied by more than 1%.
+                                [default=1600]
 
            In case the Fourier expansion of the potential represents a poor fit
            (determined by v_threshold), a ValueError is raised. It means that
@@ -434,6 +449,7 @@ class Rotor(Info, StatFysTerms):
         self.rotsym = rotsym
         self.even = even
         self.num_levels = num_levels
+        self.max_levels = max_levels
         self.dofmax = dofmax
         self.v_threshold = v_threshold
         self.large_fixed = large_fixed
@@ -454,19 +470,12 @@ class Rotor(Info, StatFysTerms):
         self.moment, self.reduced_moment = compute_moments(
             nma.coordinates, nma.masses3, self.center, self.axis, self.rot_scan.top_indexes
         )
-        if self.large_fixed:
-            moment = self.moment
-        else:
-            moment = self.reduced_moment
+        moment = self._get_level_moment()
         from molmod.ic import dihed_angle
         self.nma_angle = dihed_angle(nma.coordinates[self.rot_scan.dihedral])[0]
         # the energy levels
         if self.rot_scan.potential is None:
             # free rotor
-            self.energy_levels = np.zeros(self.num_levels, float)
-            for i in xrange(self.num_levels-1):
-                index = i/2+1
-                self.energy_levels[i+1] = index**2/(2*moment)
             self.hb = None
             self.v_coeffs = None
             self.v_ref = 0.0
@@ -477,8 +486,7 @@ class Rotor(Info, StatFysTerms):
 
             self.v_coeffs = self.hb.fit_fn(angles, energies, self.dofmax,
                 self.rotsym, self.even, self.v_threshold)
-            self.energy_levels = self.hb.solve(moment, self.v_coeffs)
-            self.energy_levels = self.energy_levels[:self.num_levels]
+        self._solve_levels(self.num_levels)
 
         # the cancelation frequency based on the scan
         if self.hb is None:
@@ -510,6 +518,75 @@ class Rotor(Info, StatFysTerms):
         self.zp_scaling = partf.vibrational.zp_scaling
         self.classical = partf.vibrational.classical
 
+    def _get_level_moment(self):
+        """The moment of inertia used for the energy levels."""
+        if self.large_fixed:
+            return self.moment
+        else:
+            return self.reduced_moment
+
+    def _solve_levels(self, num_levels):
+        """Compute the first num_levels energy levels of the rotor."""
+        moment = self._get_level_moment()
+        if self.hb is None:
+            # free rotor
+            indexes = (np.arange(num_levels) + 1)/2
+            energy_levels = indexes**2/(2*moment)
+        else:
+            # hindered rotor, extend the basis if needed.
+            if self.hb.nmax < num_levels:
+                v_coeffs = np.zeros(2*num_levels+1)
+                v_coeffs[:self.hb.size] = self.v_coeffs
+                self.hb = HarmonicBasis(num_levels, 2*np.pi)
+                self.v_coeffs = v_coeffs
+            energy_levels = self.hb.solve(moment, self.v_coeffs)[:num_levels]
+        # the number of levels actually solved, num_levels is the initial value
+        self._num_solved_levels = num_levels
+        self.energy_levels = energy_levels
+        self.level_set = LevelSet(energy_levels)
+
+    def _ensure_levels(self, temp):
+        """Solve for more energy levels when the given temperatures require it.
+
+           Argument:
+            | ``temp`` -- the temperature or an array of temperatures
+        """
+        temp = np.asarray(temp, dtype=float)
+        if not (temp > 0).any():
+            return
+        temp_max = temp.max()
+        while self._num_solved_levels < self.max_levels and \
+              self.level_set.top_occupation(temp_max) > self.level_threshold:
+            self._solve_levels(min(2*self._num_solved_levels, self.max_levels))
+
+    def get_state(self):
+        """See :meth:`tamkin.partf.StatFys.get_state`"""
+        state = StatFysTerms.get_state(self)
+        del state["rot_scan"]
+        del state["hb"]
+        del state["level_set"]
+        state["scan_dihedral"] = self.rot_scan.dihedral
+        state["scan_top_indexes"] = self.rot_scan.top_indexes
+        state["scan_potential"] = self.rot_scan.potential
+        state["hb_nmax"] = None if self.hb is None else self.hb.nmax
+        return state
+
+    def set_state(self, state):
+        """See :meth:`tamkin.partf.StatFys.set_state`"""
+        state = dict(state)
+        self.rot_scan = RotScan(
+            state.pop("scan_dihedral"),
+            top_indexes=state.pop("scan_top_indexes"),
+            potential=state.pop("scan_potential"),
+        )
+        hb_nmax = state.pop("hb_nmax")
+        if hb_nmax is None:
+            self.hb = None
+        else:
+            self.hb = HarmonicBasis(hb_nmax, 2*np.pi)
+        StatFysTerms.set_state(self, state)
+        self.level_set = LevelSet(self.energy_levels)
+
     @cached
     def potential(self):
         """A tuple with angles and potential energies (hindered only)
@@ -571,7 +648,7 @@ class Rotor(Info, StatFysTerms):
             print >> f, "    Potential: Angle [deg]    Energy [kJ/mol]"
             for i in xrange(len(angles)):
                 print >> f, "              % 7.2f         %6.1f" % (angles[i]/deg, energies[i]/kjmol)
-        print >> f, "    Number of QM energy levels: %i" % self.num_levels
+        print >> f, "    Number of QM energy levels: %i" % self._num_solved_levels
         # derived quantities
         print >> f, "    Center [A]: % 8.2f % 8.2f % 8.2f" % tuple(self.center/angstrom)
         print >> f, "    Axis [1]: % 8.2f % 8.2f % 8.2f" % tuple(self.axis)
@@ -620,7 +697,7 @@ class Rotor(Info, StatFysTerms):
             eks = self.energy_levels/(temp*boltzmann)
             bfs = np.exp(-eks)
             bfs /= bfs.sum()
-            for i in xrange(self.num_levels):
+            for i in xrange(len(self.energy_levels)):
                 e = (self.energy_levels[i])/kjmol
                 pt.axhline(e, color="b", linewidth=0.5)
                 pt.axhline(e, xmax=bfs[i], color="b", linewidth=2)
@@ -647,24 +724,55 @@ class Rotor(Info, StatFysTerms):
 
     def helper_terms(self, temp, n):
         """See :meth:`tamkin.partf.StatFysTerms.helper_terms`"""
+        self._ensure_levels(temp)
         return np.array([
             -helper_vibrations(temp, n, self.cancel_freq, self.classical,
                                  self.freq_scaling, self.zp_scaling),
-            helper_levels(temp, n, self.energy_levels, check=True) - temp**n*np.log(self.rotsym),
+            helper_levels(temp, n, self.level_set, check=True) - np.power(np.asarray(temp, float), n)*np.log(self.rotsym),
         ])
 
     def helpert_terms(self, temp, n):
         """See :meth:`tamkin.partf.StatFysTerms.helpert_terms`"""
+        self._ensure_levels(temp)
         return np.array([
             -helpert_vibrations(temp, n, self.cancel_freq, self.classical,
                                   self.freq_scaling, self.zp_scaling),
-            helpert_levels(temp, n, self.energy_levels, check=True),
+            helpert_levels(temp, n, self.level_set, check=True),
         ])
 
     def helpertt_terms(self, temp, n):
         """See :meth:`tamkin.partf.StatFysTerms.helpertt_terms`"""
+        self._ensure_levels(temp)
         return np.array([
             -helpertt_vibrations(temp, n, self.cancel_freq, self.classical,
                                    self.freq_scaling, self.zp_scaling),
-            helpertt_levels(temp, n, self.energy_levels, check=True),
+            helpertt_levels(temp, n, self.level_set, check=True),
         ])
+
+    def helpers_terms(self, temp, n):
+        """See :meth:`tamkin.partf.StatFysTerms.helpers_terms`"""
+        self._ensure_levels(temp)
+        vib = helpers_vibrations(temp, n, self.cancel_freq, self.classical,
+                                 self.freq_scaling, self.zp_scaling)
+        levels = helpers_levels(temp, n, self.level_set, check=True)
+        h, ht, htt = [np.array([-v, l]) for v, l in zip(vib, levels)]
+        h[1] -= np.power(np.asarray(temp, float), n)*np.log(self.rotsym)
+        return h, ht, htt
+
+    def helpers_sensitivity(self, temp):
+        """See :meth:`tamkin.partf.StatFys.helpers_sensitivity`
+
+           The keys are ``("cancel_freq", name)``, ``("freq_scaling",)`` and
+           ``("zp_scaling",)``. The energy levels are kept fixed.
+        """
+        derivs = sensitivities_vibrations(temp, self.cancel_freq, self.classical,
+                                          self.freq_scaling, self.zp_scaling)
+        keys = [("cancel_freq", self.name), ("freq_scaling",), ("zp_scaling",)]
+        return keys, -np.array(derivs).swapaxes(0, 1)
+
+    def compile_part_fun(self, compiler):
+        """See :meth:`tamkin.partf.StatFys.compile_part_fun`"""
+        compiler.add_oscillators(self.cancel_freq, self.classical,
+                                 self.freq_scaling, self.zp_scaling, weight=-1)
+        compiler.add_levels(self.energy_levels, check=True)
+        compiler.add_analytic(-np.log(self.rotsym))
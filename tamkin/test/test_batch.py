@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# TAMkin is a post-processing toolkit for normal mode analysis, thermochemistry
+# and reaction kinetics.
+# Copyright (C) 2008-2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, An Ghysels
+# <An.Ghysels@UGent.be> and Matthias Vandichel <Matthias.Vandichel@UGent.be>
+# Center for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all
+# rights reserved unless otherwise stated.
+#
+# This file is part of TAMkin.
+#
+# TAMkin is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# In addition to the regulations of the GNU General Public License,
+# publications and communications based in parts on this program or on
+# parts of this program are required to cite the following article:
+#
+# "TAMkin: A Versatile Package for Vibrational Analysis and Chemical Kinetics",
+# An Ghysels, Toon Verstraelen, Karen Hemelsoet, Michel Waroquier and Veronique
+# Van Speybroeck, Journal of Chemical Information and Modeling, 2010, 50,
+# 1736-1750W
+# http://dx.doi.org/10.1021/ci100099g
+#
+# TAMkin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+# --
+
+
+
+from functools import partial
+import pkg_resources
+import numpy as np
+import unittest
+
+from tamkin import *
+
+
+__all__ = ["BatchTestCase"]
+
+
+class BatchTestCase(unittest.TestCase):
+    def get_jobs(self):
+        fn_fchk = pkg_resources.resource_filename(__name__, "../data/test/sterck/aa.fchk")
+        fn_cor = pkg_resources.resource_filename(__name__, "../data/test/an/ethanol.cor")
+        fn_hess = pkg_resources.resource_filename(__name__, "../data/test/an/ethanol.hess.full")
+        fn_fixed = pkg_resources.resource_filename(__name__, "../data/test/an/fixed.03.txt")
+        return [
+            (partial(load_molecule_g03fchk, fn_fchk),),
+            (partial(load_molecule_charmm, fn_cor, fn_hess), PHVA(load_indices(fn_fixed))),
+            (partial(load_molecule_g03fchk, fn_fchk), ConstrainExt(), [ExtTrans(), ExtRot()]),
+        ]
+
+    def check_batch(self, backend):
+        jobs = self.get_jobs()
+        results = dict(run_nma_batch(jobs, workers=2, backend=backend))
+        self.assertEqual(sorted(results), range(len(jobs)))
+        for index, job in enumerate(jobs):
+            treatment = job[1] if len(job) > 1 else Full()
+            nma = NMA(job[0](), treatment)
+            result = results[index]
+            if len(job) == 3:
+                self.assert_(isinstance(result, PartFun))
+                pf = PartFun(nma, [ExtTrans(), ExtRot()])
+                self.assertAlmostEqual(result.free_energy(300.0), pf.free_energy(300.0))
+                continue
+            self.assert_(isinstance(result, NMA))
+            self.assertAlmostEqual(abs(result.freqs - nma.freqs).max()/abs(nma.freqs).max(), 0.0)
+            self.assertEqual(sorted(result.zeros), sorted(nma.zeros))
+            self.assertEqual(result.title, nma.title)
+            self.assertEqual(result.chemical_formula, nma.chemical_formula)
+            self.assertAlmostEqual(result.energy, nma.energy)
+            modes = np.asarray(nma.modes)
+            for i in xrange(len(nma.freqs)):
+                if i not in nma.zeros:
+                    self.assertAlmostEqual(abs(abs(np.dot(result.modes[:,i], modes[:,i])) - 1), 0.0, 5)
+
+    def test_process(self):
+        self.check_batch("process")
+
+    def test_thread(self):
+        self.check_batch("thread")
+
+    def test_molecule_without_modes(self):
+        molecule = self.get_jobs()[0][0]()
+        results = list(run_nma_batch([molecule, (molecule, Full(), [])], workers=1, backend="thread", do_modes=False))
+        self.assertEqual(len(results), 2)
+        self.assert_(results[0][1].modes is None)
+        # the arguments are checked before the first result is requested
+        self.assertRaises(ValueError, run_nma_batch, [molecule], backend="foo")
+        self.assertRaises(ValueError, run_nma_batch, [molecule], workers=0)
+        self.assertRaises(ValueError, run_nma_batch, [molecule], blas_threads=0)
+
+    def test_blas_threads(self):
+        from tamkin.batch import _get_blas_thread_functions, _set_blas_threads
+        functions = _get_blas_thread_functions()
+        old_threads = [getter() for getter, setter in functions]
+        restore = _set_blas_threads(1)
+        self.assertEqual([getter() for getter, setter in functions], [1]*len(functions))
+        for setter, num_threads in restore:
+            setter(num_threads)
+        self.assertEqual([getter() for getter, setter in functions], old_threads)
@@ -230,6 +230,32 @@ def test_get_external_basis_new2():
     assert error < 1e-5
 
 
+def test_raise_constrain_ext_low_rank():
+    import scipy.sparse
+    mol = load_molecule_g03fchk(
+        pkg_resources.resource_filename(__name__, "../data/test/sterck/aa.fchk"))
+    # reference: explicit dense projectors
+    U, W, Vt = np.linalg.svd(mol.external_basis.transpose(), full_matrices=False)
+    D = U[:,:(abs(W) > abs(W[0])*1e-5).sum()]
+    proj = np.dot(D, D.transpose())
+    sqrt_masses3 = np.sqrt(mol.masses3)
+    proj_shift = proj*sqrt_masses3*sqrt_masses3.reshape((-1,1))
+    projR = np.identity(len(D)) - proj*sqrt_masses3/sqrt_masses3.reshape((-1,1))
+    hessian_raised = mol.hessian + 2.0*proj_shift
+    hessian_constrained = np.dot(np.dot(projR.transpose(), mol.hessian), projR)
+    gradient_constrained = np.dot(projR.transpose(), mol.gradient.ravel())
+    sparse_mol = mol.copy_with(hessian=scipy.sparse.csr_matrix(mol.hessian))
+    for m in mol, sparse_mol:
+        raised = m.raise_ext(shift=2.0)
+        assert abs(raised.hessian - hessian_raised).max() < 1e-8
+        assert (raised.gradient == mol.gradient).all()
+        constrained = m.constrain_ext()
+        assert abs(constrained.hessian - hessian_constrained).max() < 1e-10
+        assert abs(constrained.gradient.ravel() - gradient_constrained).max() < 1e-10
+    # the original Hessian is left untouched
+    assert abs(sparse_mol.hessian.toarray() - mol.hessian).max() == 0.0
+
+
 def test_rot_scan_ts():
     # The select dihedral angles do not allow an automatic assignment of the top
     # indexes.
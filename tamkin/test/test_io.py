@@ -516,6 +516,42 @@ class IOTestCase(unittest.TestCase):
         assert abs(mol0.gradient - mol1.gradient).max() < 1e-8
         assert abs(mol0.hessian - mol1.hessian).max() < 1e-8
 
+    def test_load_molecule_g03fchk_phva_fixed(self):
+        fn_fchk = pkg_resources.resource_filename(__name__, "../data/test/mat5T/react.fchk")
+        molecule = load_molecule_g03fchk(fn_fchk)
+        # scattered and contiguous fixed atoms
+        for fixed in [0, 3, 4, 9], range(5, molecule.size):
+            mol_free = load_molecule_g03fchk(fn_fchk, phva_fixed=fixed)
+            self.assert_(mol_free.hessian_is_sparse)
+            free = [i for i in xrange(molecule.size) if i not in fixed]
+            free3 = np.array([3*i+j for i in free for j in xrange(3)])
+            hessian = mol_free.get_dense_hessian()
+            self.assertAlmostEqual(abs(hessian[free3][:,free3] - molecule.hessian[free3][:,free3]).max(), 0.0)
+            self.assertEqual(mol_free.hessian.nnz, len(free3)**2)
+            nma = NMA(molecule, PHVA(fixed))
+            nma_free = NMA(mol_free, PHVA(fixed))
+            self.assertAlmostEqual(abs(nma.freqs - nma_free.freqs).max()/abs(nma.freqs).max(), 0.0)
+            # the missing Hessian blocks are recorded and checked
+            self.assertEqual(mol_free.hessian_skipped.tolist(), sorted(fixed))
+            nma = NMA(molecule, PHVA(fixed + [1]))
+            nma_free = NMA(mol_free, PHVA(fixed + [1]))
+            self.assertAlmostEqual(abs(nma.freqs - nma_free.freqs).max()/abs(nma.freqs).max(), 0.0)
+            self.assertRaises(ValueError, NMA, mol_free, PHVA(fixed[1:]))
+            self.assertRaises(ValueError, NMA, mol_free, Full())
+            self.assertRaises(ValueError, NMA, mol_free, ConstrainExt())
+            self.assertRaises(ValueError, mol_free.constrain_ext)
+            submolecule = mol_free.get_submolecule(range(3, 12))
+            self.assertEqual(submolecule.hessian_skipped.tolist(), [i-3 for i in fixed if 3 <= i < 12])
+        # the punch file
+        fn_fchk = pkg_resources.resource_filename(__name__, "../data/test/punch/gaussian.fchk")
+        fn_punch = pkg_resources.resource_filename(__name__, "../data/test/punch/fort.7")
+        molecule = load_molecule_g03fchk(fn_fchk)
+        mol_free = load_molecule_g03fchk(fn_fchk, fn_punch=fn_punch, phva_fixed=[0])
+        free3 = np.arange(3, 3*molecule.size)
+        hessian = mol_free.get_dense_hessian()
+        assert abs(hessian[free3][:,free3] - molecule.hessian[free3][:,free3]).max() < 1e-8
+        assert abs(hessian[:3]).max() == 0.0
+
     def test_dftd3(self):
         assert load_dftd3(
             pkg_resources.resource_filename(__name__, "../data/test/dftd3/dftd3.out")) == -0.00330057
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# TAMkin is a post-processing toolkit for normal mode analysis, thermochemistry
+# and reaction kinetics.
+# Copyright (C) 2008-2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, An Ghysels
+# <An.Ghysels@UGent.be> and Matthias Vandichel <Matthias.Vandichel@UGent.be>
+# Center for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all
+# rights reserved unless otherwise stated.
+#
+# This file is part of TAMkin.
+#
+# TAMkin is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# In addition to the regulations of the GNU General Public License,
+# publications and communications based in parts on this program or on
+# parts of this program are required to cite the following article:
+#
+# "TAMkin: A Versatile Package for Vibrational Analysis and Chemical Kinetics",
+# An Ghysels, Toon Verstraelen, Karen Hemelsoet, Michel Waroquier and Veronique
+# Van Speybroeck, Journal of Chemical Information and Modeling, 2010, 50,
+# 1736-1750W
+# http://dx.doi.org/10.1021/ci100099g
+#
+# TAMkin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+# --
+
+
+import numpy as np
+import pkg_resources
+import unittest
+
+from molmod.units import kjmol, centimeter
+from molmod.constants import boltzmann, lightspeed, planck
+
+from tamkin import *
+
+
+__all__ = ["MicrocanonicalTestCase"]
+
+
+class MicrocanonicalTestCase(unittest.TestCase):
+    def test_count_states_harmonic(self):
+        # two degenerate oscillators: 1, 2, 3, ... states per level
+        counts = np.zeros(20)
+        counts[0] = 1
+        count_states_harmonic(counts, np.array([3.0, 3.0]), planck)
+        expected = np.zeros(20)
+        expected[::3] = np.arange(1, 8)
+        self.assertAlmostEqual(abs(counts - expected).max(), 0.0)
+        remove_states_harmonic(counts, 3.0, planck)
+        expected[::3] = 1
+        self.assertAlmostEqual(abs(counts - expected).max(), 0.0)
+
+    def test_convolve_counts(self):
+        counts = np.random.uniform(0, 1, 100)
+        other = np.random.uniform(0, 1, 100)
+        expected = np.convolve(counts, other)[:100]
+        self.assertAlmostEqual(abs(convolve_counts(counts, other) - expected).max(), 0.0)
+        self.assertAlmostEqual(abs(convolve_counts(counts, other, 0) - expected).max(), 0.0)
+
+    def test_ethane_hindered(self):
+        molecule = load_molecule_g03fchk(
+            pkg_resources.resource_filename(__name__, "../data/test/ethane/gaussian.fchk"))
+        nma = NMA(molecule)
+        rot_scan = load_rotscan_g03log(
+            pkg_resources.resource_filename(__name__, "../data/test/rotor/gaussian.log"))
+        rotor = Rotor(rot_scan, molecule, rotsym=3, even=True)
+        pf = PartFun(nma, [ExtTrans(), ExtRot(6), rotor])
+        dos = DensityOfStates(pf, 0.01*kjmol, 300*kjmol)
+        self.assertEqual(dos.counts.shape, dos.energies.shape)
+        self.assertAlmostEqual(dos.sum_of_states[-1]/dos.counts.sum(), 1.0)
+        zpe = pf.vibrational.zero_point_energy() + rotor.zero_point_energy()
+        for temp in 300.0, 600.0:
+            expected = pf.vibrational.log(temp) + rotor.log(temp) + zpe/(boltzmann*temp)
+            self.assertAlmostEqual(dos.log_partition(temp), expected, 2)
+        # the FFT and the direct convolution must give the same result
+        dos_fft = DensityOfStates(pf, 0.01*kjmol, 300*kjmol, fft_threshold=0)
+        self.assertAlmostEqual(abs(dos_fft.counts - dos.counts).max()/dos.counts.max(), 0.0)
+
+    def test_coarse_grain(self):
+        molecule = load_molecule_g03fchk(
+            pkg_resources.resource_filename(__name__, "../data/test/ethane/gaussian.fchk"))
+        pf = PartFun(NMA(molecule), [])
+        self.assertRaises(ValueError, DensityOfStates, pf, 1e3*lightspeed/centimeter*planck, 1.0)
@@ -34,6 +34,7 @@
 # --
 
 
+import copy
 import os
 import numpy as np
 import pkg_resources
@@ -352,7 +353,8 @@ class NMATestCase(unittest.TestCase):
             nma1 = NMA(mol1, treatment)
             self.check_ortho(nma1.modes)
 
-            mol2 = mol1.copy_with(masses=mol1.masses*np.random.uniform(0.9,1.1,mol1.size))
+            random = np.random.RandomState(1)
+            mol2 = mol1.copy_with(masses=mol1.masses*random.uniform(0.9,1.1,mol1.size))
             nma2 = NMA(mol2, treatment)
             self.check_ortho(nma2.modes)
 
@@ -515,6 +517,219 @@ class NMATestCase(unittest.TestCase):
                3653.7642078 ])
         self.check_freqs(expected_freqs, nma, 4, check_zeros=True)
 
+    def test_vsa_factorizations(self):
+        molecule = load_molecule_charmm(
+            pkg_resources.resource_filename(__name__, "../data/test/an/ethanol.cor"),
+            pkg_resources.resource_filename(__name__, "../data/test/an/ethanol.hess.full"))
+        subs = load_indices(
+            pkg_resources.resource_filename(__name__, "../data/test/an/fixed.03.txt"))
+        subs3 = np.array([i for i in xrange(3*molecule.size) if i//3 in subs])
+        envi3 = np.array([i for i in xrange(3*molecule.size) if i//3 not in subs])
+        # an environment block that is not positive definite
+        hessian = molecule.hessian.copy()
+        hessian[envi3[0], envi3[0]] -= 1.0
+        indefinite = molecule.copy_with(hessian=hessian)
+        self.assert_(np.linalg.eigvalsh(hessian[envi3][:,envi3]).min() < 0)
+        for mol in molecule, indefinite:
+            for cls in VSA, VSANoMass:
+                treatment = cls(subs)
+                nma1 = NMA(mol, treatment)
+                nma2 = NMA(mol, cls(subs, sparse=True))
+                self.assertAlmostEqual(abs(nma1.freqs - nma2.freqs).max()/abs(nma1.freqs).max(), 0.0)
+                # compare with the explicit inverse
+                hessian_es = mol.hessian[envi3][:,subs3]
+                hessian_small = mol.hessian[subs3][:,subs3] - np.dot(hessian_es.transpose(),
+                    np.dot(np.linalg.inv(mol.hessian[envi3][:,envi3]), hessian_es))
+                treatment.compute_hessian(mol, False)
+                self.assertAlmostEqual(abs(treatment.hessian_small - hessian_small).max(), 0.0)
+
+    def test_analysis_context(self):
+        molecule = load_molecule_charmm(
+            pkg_resources.resource_filename(__name__, "../data/test/an/ethanol.cor"),
+            pkg_resources.resource_filename(__name__, "../data/test/an/ethanol.hess.full"))
+        subs = load_indices(
+            pkg_resources.resource_filename(__name__, "../data/test/an/fixed.03.txt"))
+        blocks = [[0, 1, 2, 3], [3, 4, 5]]
+        context = molecule.analysis_context
+        self.assert_(context is molecule.analysis_context)
+        treatments = [
+            lambda: Full(), lambda: VSA(subs), lambda: VSANoMass(subs),
+            lambda: MBH(blocks), lambda: ConstrainExt(gradient_threshold=1.0),
+        ]
+        nmas1 = [NMA(molecule, treatment()) for treatment in treatments]
+        self.assertEqual(context.hits, 1) # VSANoMass reuses the VSA factorization
+        misses = context.misses
+        nmas2 = [NMA(molecule, treatment()) for treatment in treatments]
+        self.assertEqual(context.misses, misses)
+        for nma1, nma2 in zip(nmas1, nmas2):
+            self.assertEqual(nma1.freqs.tolist(), nma2.freqs.tolist())
+            self.assertEqual(nma1.modes.tolist(), nma2.modes.tolist())
+        # cached arrays are shared, hence read-only
+        self.assertRaises(ValueError, context.get_external_basis_svd()[2].__setitem__, (0, 0), 0.0)
+        # arrays with the size of the full Hessian are not cached
+        keys = set(key[0] for key in context._results)
+        self.assertEqual(keys, set(["external_basis_svd", "schur_complement", "mbh"]))
+        # the results do not depend on the cache
+        for treatment, nma1 in zip(treatments, nmas1):
+            context.clear()
+            self.assertEqual(len(context), 0)
+            nma3 = NMA(molecule, treatment())
+            self.assertEqual(nma1.freqs.tolist(), nma3.freqs.tolist())
+        # least recently used results are discarded first
+        NMA(molecule, VSA(subs))
+        vsa_nbytes = context.nbytes
+        NMA(molecule, MBH(blocks))
+        context.max_bytes = context.nbytes - 1
+        NMA(molecule, PHVA(subs))
+        self.assert_(context.nbytes <= context.max_bytes)
+        misses = context.misses
+        NMA(molecule, MBH(blocks))
+        self.assertEqual(context.misses, misses)
+        NMA(molecule, VSA(subs))
+        self.assertEqual(context.misses, misses + 1)
+        # results that do not fit are not cached
+        context.clear()
+        context.max_bytes = vsa_nbytes - 1
+        NMA(molecule, VSA(subs))
+        self.assertEqual(len(context), 0)
+        context.max_bytes = 0
+        NMA(molecule, MBH(blocks))
+        self.assertEqual((len(context), context.nbytes), (0, 0))
+        # a modified molecule has its own context
+        self.assert_(molecule.copy_with(energy=1.0).analysis_context is not context)
+
+    def test_isotopologues(self):
+        molecule = load_molecule_charmm(
+            pkg_resources.resource_filename(__name__, "../data/test/an/ethanol.cor"),
+            pkg_resources.resource_filename(__name__, "../data/test/an/ethanol.hess.full"))
+        subs = load_indices(
+            pkg_resources.resource_filename(__name__, "../data/test/an/fixed.03.txt"))
+        masses = molecule.masses.copy()
+        masses[0] *= 13.0/12.0
+        masses[3:5] *= 2
+        isotopologues = [molecule.masses, masses, {1: molecule.masses[1]*1.1}]
+        treatments = [
+            Full(), VSA(subs), MBH([[0, 1, 2, 3], [3, 4, 5]]),
+            PHVA_MBH([6, 7, 8], [[0, 1, 2, 3], [3, 4, 5]]),
+            ConstrainExt(gradient_threshold=1.0),
+        ]
+        for treatment in treatments:
+            context = molecule.analysis_context
+            context.clear()
+            nmas = compute_isotopologues(molecule, isotopologues, treatment)
+            self.assertEqual(len(nmas), 3)
+            if isinstance(treatment, VSA):
+                # the environment is factorized only once and the
+                # mass-dependent results of the isotopologues are not cached
+                keys = [key[0] for key in context._results]
+                self.assertEqual(keys, ["schur_complement"])
+                self.assertEqual(context.hits, 2)
+            # one problem per chunk and only frequencies
+            nmas_single = compute_isotopologues(molecule, isotopologues, treatment, memory_budget=0)
+            nmas_freqs = compute_isotopologues(molecule, isotopologues, treatment, do_modes=False)
+            for nma1, nma_single, nma_freqs in zip(nmas, nmas_single, nmas_freqs):
+                self.assertEqual(nma1.freqs.tolist(), nma_single.freqs.tolist())
+                self.assertAlmostEqual(abs(nma1.freqs - nma_freqs.freqs).max()/abs(nma1.freqs).max(), 0.0)
+                self.assertEqual(sorted(nma1.zeros), sorted(nma_freqs.zeros))
+                self.assert_(nma_freqs.modes is None)
+            for isotopologue, nma1 in zip(isotopologues, nmas):
+                if isinstance(isotopologue, dict):
+                    masses = molecule.masses.copy()
+                    masses[1] = isotopologue[1]
+                else:
+                    masses = isotopologue
+                nma2 = NMA(molecule.copy_with(masses=masses), copy.deepcopy(treatment))
+                self.assertEqual(nma1.masses.tolist(), masses.tolist())
+                self.assertAlmostEqual(abs(nma1.freqs - nma2.freqs).max()/abs(nma2.freqs).max(), 0.0)
+                self.assertEqual(sorted(nma1.zeros), sorted(nma2.zeros))
+                # the zero modes are (nearly) degenerate, compare the others
+                nonzero = [i for i in xrange(len(nma1.freqs)) if i not in nma1.zeros]
+                self.assertAlmostEqual(abs(abs(nma1.modes[:,nonzero]) - abs(nma2.modes[:,nonzero])).max(), 0.0, 5)
+        self.assertRaises(ValueError, compute_isotopologues, molecule, [masses[:-1]])
+
+    def test_generalized_eigh(self):
+        molecule = load_molecule_charmm(
+            pkg_resources.resource_filename(__name__, "../data/test/an/ethanol.cor"),
+            pkg_resources.resource_filename(__name__, "../data/test/an/ethanol.hess.full"))
+        subs = load_indices(
+            pkg_resources.resource_filename(__name__, "../data/test/an/fixed.03.txt"))
+        for treatment in VSA(subs), VSANoMass(subs), MBH([[0, 1, 2, 3], [3, 4, 5]]):
+            nma = NMA(molecule, treatment)
+            # compare with the explicit mass-weighting
+            result = treatment(molecule, True)
+            hessian_small_mw = result.mass_matrix_small.get_weighted_hessian(result.hessian_small)
+            evals, modes_small_mw = np.linalg.eigh(hessian_small_mw)
+            freqs = np.sqrt(abs(evals))/(2*np.pi)*((evals > 0)*2-1)
+            self.assertAlmostEqual(abs(nma.freqs - freqs).max()/abs(freqs).max(), 0.0)
+            result.transform.make_weighted(result.mass_matrix_small)
+            modes = result.transform(modes_small_mw)*np.sqrt(molecule.masses3).reshape((-1,1))
+            nonzero = [i for i in xrange(len(nma.freqs)) if i not in nma.zeros]
+            self.assertAlmostEqual(abs(abs(nma.modes[:,nonzero]) - abs(modes[:,nonzero])).max(), 0.0)
+
+    def test_shared_treatment(self):
+        molecule = load_molecule_charmm(
+            pkg_resources.resource_filename(__name__, "../data/test/an/ethanol.cor"),
+            pkg_resources.resource_filename(__name__, "../data/test/an/ethanol.hess.full"))
+        treatment = PHVA_MBH([0, 1, 2], [[3, 4, 5], [5, 6, 7]])
+        result = treatment(molecule, True)
+        self.assert_(isinstance(result, TreatmentResult))
+        self.assertRaises(AttributeError, setattr, result, "num_zeros", 0)
+        # the treatment itself is left untouched
+        self.assertEqual(treatment.blocks, [[3, 4, 5], [5, 6, 7]])
+        self.assert_(not hasattr(treatment, "hessian_small"))
+        nma1 = NMA(molecule, treatment)
+        nma2 = NMA(molecule, treatment)
+        self.assertAlmostEqual(abs(nma1.freqs - nma2.freqs).max()/abs(nma1.freqs).max(), 0.0)
+        # one treatment shared by several threads
+        import threading
+        molecules = [molecule.copy_with(energy=float(i)) for i in xrange(4)]
+        nmas = [None]*len(molecules)
+        def run(index):
+            nmas[index] = NMA(molecules[index], treatment)
+        threads = [threading.Thread(target=run, args=(i,)) for i in xrange(len(molecules))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for nma in nmas:
+            self.assertAlmostEqual(abs(nma.freqs - nma1.freqs).max()/abs(nma1.freqs).max(), 0.0)
+            self.assertEqual(sorted(nma.zeros), sorted(nma1.zeros))
+
+    def test_lazy_modes(self):
+        molecule = load_molecule_charmm(
+            pkg_resources.resource_filename(__name__, "../data/test/an/ethanol.cor"),
+            pkg_resources.resource_filename(__name__, "../data/test/an/ethanol.hess.full"))
+        subs = load_indices(
+            pkg_resources.resource_filename(__name__, "../data/test/an/fixed.03.txt"))
+        for treatment in Full(), PHVA(subs), VSA(subs), MBH([[0, 1, 2, 3], [3, 4, 5]]):
+            nma = NMA(molecule, treatment)
+            self.assert_(isinstance(nma.modes, Modes))
+            modes = nma.modes.to_array()
+            self.assertEqual(modes.shape, nma.modes.shape)
+            self.assertEqual(modes.shape, (3*molecule.size, len(nma.freqs)))
+            # indexing
+            self.assertAlmostEqual(abs(nma.modes[:,3] - modes[:,3]).max(), 0.0)
+            self.assertAlmostEqual(abs(nma.modes[:,-1] - modes[:,-1]).max(), 0.0)
+            self.assertAlmostEqual(abs(nma.modes[:,[4,1]] - modes[:,[4,1]]).max(), 0.0)
+            self.assertAlmostEqual(abs(nma.modes[:,2:7:2] - modes[:,2:7:2]).max(), 0.0)
+            self.assertAlmostEqual(abs(nma.modes[3:6,5] - modes[3:6,5]).max(), 0.0)
+            self.assertAlmostEqual(abs(nma.modes[3] - modes[3]).max(), 0.0)
+            # chunks
+            chunks = list(nma.modes.iter_chunks(4))
+            self.assertEqual(len(chunks), (modes.shape[1]+3)/4)
+            self.assertAlmostEqual(abs(np.concatenate(chunks, axis=1) - modes).max(), 0.0)
+            # array-like behavior
+            self.assertAlmostEqual(abs(np.asarray(nma.modes) - modes).max(), 0.0)
+            self.assertAlmostEqual(abs(np.dot(nma.modes.transpose(), modes) - np.dot(modes.transpose(), modes)).max(), 0.0)
+            self.assertAlmostEqual(abs(compute_overlap(nma.modes, modes) - np.dot(modes.transpose(), modes)).max(), 0.0)
+            # checkpoint files contain plain arrays
+            with tmpdir(__name__, 'test_lazy_modes') as dn:
+                fn = os.path.join(dn, 'nma.chk')
+                nma.write_to_file(fn)
+                nma_read = NMA.read_from_file(fn)
+            self.assert_(isinstance(nma_read.modes, np.ndarray))
+            self.assertAlmostEqual(abs(nma_read.modes - modes).max(), 0.0)
+
     def test_vsa_no_mass(self):
         # Modes are a priori known to be non-orthogonal, so no 'self.check_ortho(nma.modes)'
         molecule = load_molecule_charmm(
@@ -572,6 +787,61 @@ class NMATestCase(unittest.TestCase):
         non_zero = [i for i in xrange(7) if i not in nma.zeros][0]
         self.assertAlmostEqual(nma.freqs[non_zero]/lightspeed*centimeter, 314, 0)
 
+    def test_mbh_transform(self):
+        molecule = load_molecule_g03fchk(
+            pkg_resources.resource_filename(__name__, "../data/test/mat5T/react.fchk"))
+        # nonlinear, linear and free atoms
+        blocks = [[0, 1, 2, 3], [4, 5, 6], [7, 8], [9, 10]]
+        blkinfo = Blocks([list(block) for block in blocks], molecule, 1e-5)
+        self.assertEqual((blkinfo.nb_nlin, blkinfo.nb_lin), (2, 2))
+        mbhdim1 = 6*2 + 5*2 + 3*len(blkinfo.free)
+        U = MBH(blocks)._construct_U(molecule, mbhdim1, blkinfo)
+        self.assertEqual(U.shape, (3*molecule.size, mbhdim1))
+        # at most one 3 x dim block per atom
+        self.assert_(U.nnz <= 3*(6*7 + 5*4 + len(blkinfo.free)))
+        # the columns of a nonlinear block are its external degrees of freedom
+        D = transrot_basis(molecule.coordinates)
+        block3 = np.array([[3*at, 3*at+1, 3*at+2] for at in blocks[0]]).ravel()
+        U0 = U[:,:6].toarray()
+        self.assertAlmostEqual(abs(U0[block3] - D[:,block3].transpose()).max(), 0.0)
+        U0[block3] = 0.0
+        self.assertEqual(abs(U0).max(), 0.0)
+        # free atoms keep their Cartesian coordinates
+        free3 = 3*blkinfo.free[0]
+        self.assertEqual(U[free3:free3+3,22:25].toarray().tolist(), np.identity(3).tolist())
+
+    def test_mbh_linked_nullspace(self):
+        molecule = load_molecule_g03fchk(
+            pkg_resources.resource_filename(__name__, "../data/test/mat5T/react.fchk"))
+        D = transrot_basis(molecule.coordinates)
+        def check(blocks, num_removed, links):
+            blkinfo = Blocks([list(block) for block in blocks], molecule, 1e-5)
+            self.assertEqual((blkinfo.nb_nlin, blkinfo.nb_lin), (len(blocks), 0))
+            mbhdim1 = 6*len(blocks) + 3*len(blkinfo.free)
+            nullspace = MBH(blocks)._construct_nullspace_K(molecule, mbhdim1, blkinfo)
+            self.assertEqual(nullspace.shape, (mbhdim1, mbhdim1 - num_removed))
+            # the basis vectors are linearly independent
+            n = nullspace.toarray()
+            self.assertEqual(np.linalg.matrix_rank(n), n.shape[1])
+            # the shared atoms move in the same way in both blocks
+            for at, b0, b1 in links:
+                D3 = D[:,3*at:3*at+3].transpose()
+                self.assertAlmostEqual(abs(
+                    np.dot(D3, n[6*b0:6*b0+6]) - np.dot(D3, n[6*b1:6*b1+6])
+                ).max(), 0.0)
+            return nullspace
+        # a chain of three linked blocks and one isolated block, each link
+        # removes three degrees of freedom
+        nullspace = check([[0, 1, 2, 3], [3, 4, 5, 6], [6, 7, 8, 9], [20, 21, 22]],
+                          6, [(3, 0, 1), (6, 1, 2)])
+        # only the linked blocks are mixed
+        self.assert_(nullspace.nnz <= 18*12 + 6 + 3*(molecule.size - 13))
+        # a ring of blocks, the last link closes a cycle
+        check([[0, 1, 2, 3], [3, 4, 5, 6], [6, 7, 8, 0]],
+              9, [(3, 0, 1), (6, 1, 2), (0, 0, 2)])
+        # two blocks that share two atoms are connected by a hinge
+        check([[0, 1, 2, 3], [2, 3, 4, 5]], 5, [(2, 0, 1), (3, 0, 1)])
+
     def test_mbhconstrainext(self):
         # load the plain Hessian
         molecule = load_molecule_g03fchk(
@@ -676,6 +946,159 @@ class NMATestCase(unittest.TestCase):
         with tmpdir(__name__, 'test_constrain2') as dn:
             dump_modes_molden(os.path.join(dn, "ethanol.constr.molden.log"), nma)
 
+    def test_constrain_angles(self):
+        molecule = load_molecule_charmm(
+            pkg_resources.resource_filename(__name__, "../data/test/an/ethanol.cor"),
+            pkg_resources.resource_filename(__name__, "../data/test/an/ethanol.hess.full"))
+        gradient = np.random.RandomState(1).normal(0, 1e-3, molecule.gradient.shape)
+        molecule = molecule.copy_with(gradient=gradient)
+        constraints = [[1,2], [0,5,6], [2,8,7,1]]
+        nma = NMA(molecule, Constrain(constraints))
+        self.check_ortho(nma.modes)
+        self.assertEqual(nma.modes.shape, (27, 24))
+        self.assertRaises(ValueError, Constrain, [[1]])
+        # compare the gradient correction with an explicit evaluation in the
+        # full Cartesian space.
+        treatment = Constrain(constraints)
+        treatment.compute_hessian(molecule, False)
+        uncorrected = Constrain(constraints, do_gradient_correction=False)
+        uncorrected.compute_hessian(molecule, False)
+        from molmod.ic import bond_length, bend_angle, dihed_angle
+        size = molecule.size
+        K = []
+        correction = np.zeros((3*size, 3*size))
+        Qs = []
+        for constraint in constraints:
+            rs = molecule.coordinates[constraint]
+            if len(constraint) == 2:
+                # half the squared distance
+                value, grad, hess = bond_length(rs, deriv=2)
+                hess = value*hess + np.einsum("ij,kl->ijkl", grad, grad)
+                grad = value*grad
+            elif len(constraint) == 3:
+                value, grad, hess = bend_angle(rs, deriv=2)
+            else:
+                value, grad, hess = dihed_angle(rs, deriv=2)
+            row = np.zeros((size, 3))
+            row[constraint] = grad
+            K.append(row.ravel())
+            Q = np.zeros((size, 3, size, 3))
+            Q[np.ix_(constraint, range(3), constraint, range(3))] = hess
+            Qs.append(Q.reshape((3*size, 3*size)))
+        K = np.array(K)
+        mu = np.linalg.lstsq(K.T, gradient.ravel(), rcond=-1)[0]
+        nullspace = np.linalg.svd(K, full_matrices=True)[2][len(constraints):].T
+        expected = -sum(m*np.dot(nullspace.T, np.dot(Q, nullspace)) for m, Q in zip(mu, Qs))
+        self.assertAlmostEqual(abs(treatment.hessian_small - uncorrected.hessian_small - expected).max(), 0.0, 12)
+
+    def test_partial_spectrum(self):
+        molecule = load_molecule_g03fchk(
+            pkg_resources.resource_filename(__name__, "../data/test/mat5T/react.fchk"))
+        nma = NMA(molecule)
+        invcm = lightspeed/centimeter
+        # lowest modes, the zeros are included
+        nma_low = NMA(molecule, num_modes=12)
+        self.assert_(nma_low.partial)
+        self.assertEqual(nma_low.modes.shape, (len(molecule.masses3), 12))
+        self.assertAlmostEqual(abs(nma_low.freqs - nma.freqs[:12]).max()/invcm, 0.0, 5)
+        overlaps = abs((nma_low.modes*nma.modes[:,:12]).sum(axis=0))
+        self.assertAlmostEqual(abs(overlaps[6:] - 1).max(), 0.0, 5)
+        self.assertEqual(sorted(nma_low.zeros), sorted(nma.zeros))
+        self.check_ortho(nma_low.modes)
+        nma_low = NMA(molecule, do_modes=False, num_modes=12)
+        self.assertEqual(nma_low.modes, None)
+        self.assertAlmostEqual(abs(nma_low.freqs - nma.freqs[:12]).max()/invcm, 0.0, 5)
+        self.assertEqual(len(nma_low.zeros), 6)
+        # frequency window without zeros
+        freq_window = (300*invcm, 1500*invcm)
+        mask = (nma.freqs > freq_window[0]) & (nma.freqs < freq_window[1])
+        for do_modes in True, False:
+            nma_window = NMA(molecule, do_modes=do_modes, freq_window=freq_window)
+            self.assertAlmostEqual(abs(nma_window.freqs - nma.freqs[mask]).max()/invcm, 0.0, 5)
+            self.assertEqual(len(nma_window.zeros), 0)
+        # a partial spectrum is not suitable for a partition function
+        self.assertRaises(ValueError, PartFun, nma_window)
+        self.assertRaises(ValueError, NMA, molecule, num_modes=12, freq_window=freq_window)
+
+    def test_zeros_without_modes(self):
+        molecule = load_molecule_g03fchk(
+            pkg_resources.resource_filename(__name__, "../data/test/mat5T/react.fchk"))
+        # one of the zero modes is not among the six lowest frequencies
+        nma = NMA(molecule)
+        self.assertEqual(sorted(nma.zeros), [0, 1, 2, 3, 4, 6])
+        nma_freqs = NMA(molecule, do_modes=False)
+        self.assertEqual(nma_freqs.modes, None)
+        self.assertEqual(sorted(nma_freqs.zeros), sorted(nma.zeros))
+        self.assertAlmostEqual(abs(nma_freqs.freqs - nma.freqs).max()/abs(nma.freqs).max(), 0.0)
+        # generalized eigenvalue problems and treatments with fixed atoms
+        molecule = load_molecule_charmm(
+            pkg_resources.resource_filename(__name__, "../data/test/an/ethanol.cor"),
+            pkg_resources.resource_filename(__name__, "../data/test/an/ethanol.hess.full"))
+        subs = load_indices(
+            pkg_resources.resource_filename(__name__, "../data/test/an/fixed.03.txt"))
+        treatments = [VSA(subs), MBH([[0, 1, 2, 3], [3, 4, 5]]), PHVA([6, 7])]
+        for treatment in treatments:
+            nma = NMA(molecule, treatment)
+            nma_freqs = NMA(molecule, treatment, do_modes=False)
+            self.assertEqual(sorted(nma_freqs.zeros), sorted(nma.zeros))
+            self.assertAlmostEqual(abs(nma_freqs.freqs - nma.freqs).max()/abs(nma.freqs).max(), 0.0)
+        # PHVA with two fixed atoms leaves one rotation
+        self.assertEqual(len(nma.zeros), 1)
+
+    def test_zeros_without_modes_window(self):
+        from tamkin.nma import _eigvalsh_selectable, _find_zeros, \
+            _get_modes_transform, _get_small_external_basis
+        molecule = load_molecule_g03fchk(
+            pkg_resources.resource_filename(__name__, "../data/test/mat5T/react.fchk"))
+        # generalized eigenvalue problems
+        for treatment in VSA(range(10)), MBH([range(0, 5), range(4, 10), range(10, 16)]):
+            result = treatment(molecule, True)
+            transform = _get_modes_transform(result, True)
+            basis = _get_small_external_basis(result, transform, molecule.masses3)
+            evals, get_modes, basis = _eigvalsh_selectable(
+                result.hessian_small, result.mass_matrix_small.mass_block.copy(), basis)
+            # the eigenvectors are orthonormal
+            modes = get_modes(0, len(evals) - 1)
+            self.assertAlmostEqual(abs(np.dot(modes.T, modes) - np.identity(len(evals))).max(), 0.0)
+            computed = []
+            def counting_get_modes(lo, hi):
+                computed.append(hi - lo + 1)
+                return get_modes(lo, hi)
+            zeros = _find_zeros(evals, basis, result.num_zeros, get_modes=counting_get_modes)
+            self.assertEqual(sorted(zeros), sorted(NMA(molecule, treatment).zeros))
+            # the window stops at twice the number of zeros
+            self.assertEqual(sum(computed), 2*result.num_zeros)
+
+    def test_sparse_hessian(self):
+        molecule = load_molecule_g03fchk(
+            pkg_resources.resource_filename(__name__, "../data/test/mat5T/react.fchk"))
+        mol_dense = create_enm_molecule(molecule, rcut=8.0)
+        mol_sparse = create_enm_molecule(molecule, rcut=8.0, sparse=True)
+        self.assert_(mol_sparse.hessian_is_sparse)
+        self.assert_(not mol_dense.hessian_is_sparse)
+        treatments = [
+            Full(), PHVA(range(5)), MBH([range(0, 5), range(4, 10), range(10, 16)]),
+            VSA(range(10)), VSANoMass(range(10)), ConstrainExt(),
+            PHVA_MBH(range(4), [range(4, 10), range(10, 16)]),
+        ]
+        for treatment in treatments:
+            nma_dense = NMA(mol_dense, treatment)
+            nma_sparse = NMA(mol_sparse, treatment)
+            self.assertEqual(len(nma_dense.zeros), len(nma_sparse.zeros))
+            # the zero frequencies are just numerical noise
+            mask = np.ones(len(nma_dense.freqs), bool)
+            mask[nma_dense.zeros] = False
+            freq_max = nma_dense.freqs.max()
+            self.assertAlmostEqual(abs(nma_dense.freqs[mask] - nma_sparse.freqs[mask]).max()/freq_max, 0.0, 6)
+        # sparse iterative solver for the lowest modes
+        nma_dense = NMA(mol_dense)
+        nma_low = NMA(mol_sparse, num_modes=12)
+        self.assertAlmostEqual(abs(nma_low.freqs[6:] - nma_dense.freqs[6:12]).max()/nma_dense.freqs.max(), 0.0, 6)
+        # submolecules remain sparse
+        sub = mol_sparse.get_submolecule(range(10))
+        self.assert_(sub.hessian_is_sparse)
+        self.assertAlmostEqual(abs(sub.get_dense_hessian() - mol_dense.get_submolecule(range(10)).hessian).max(), 0.0)
+
     def test_sandra(self):
         cases = [
             (pkg_resources.resource_filename(__name__, "../data/test/sandra/F_freq.fchk"),
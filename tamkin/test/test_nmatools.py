@@ -200,3 +200,8 @@ class NMAToolsTestCase(unittest.TestCase):
 
         mol = create_enm_molecule(molecule.coordinates, selected, masses=np.ones(molecule.size)*2.0, rcut=5)
         nma = NMA(mol)
+
+        mol_sparse = create_enm_molecule(molecule.coordinates, selected, masses=np.ones(molecule.size)*2.0, rcut=5, sparse=True)
+        self.assert_(mol_sparse.hessian_is_sparse)
+        self.assertEqual(mol_sparse.hessian.blocksize, (3,3))
+        self.assertAlmostEqual(abs(mol_sparse.hessian.toarray() - mol.hessian).max(), 0.0)
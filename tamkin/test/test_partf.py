@@ -35,6 +35,7 @@
 
 
 import os
+import json
 import pkg_resources
 import numpy as np
 import unittest
@@ -575,6 +576,15 @@ class PartFunTestCase(unittest.TestCase):
         # check the sum
         self.assertAlmostEqual(zpe_sum, pf.zero_point_energy())
 
+    def test_levels_zero_temperature(self):
+        energy_levels = np.array([0.002, 0.002, 0.005, 0.01])
+        temp = np.array([0.0, 1.0])
+        # T ln(Z) -> -E_0/k + T ln(g_0) for T -> 0
+        expected = -energy_levels[0]/boltzmann + temp*np.log(2)
+        self.assertAlmostEqual(abs(helper_levels(temp, 1, energy_levels) - expected).max(), 0.0, 5)
+        h, ht, htt = helpers_levels(temp, 1, energy_levels)
+        self.assertAlmostEqual(abs(h - expected).max(), 0.0, 5)
+
     def test_freq_threshold(self):
         molecule = load_molecule_g03fchk(
             pkg_resources.resource_filename(__name__, "../data/test/ethane/gaussian.fchk"))
@@ -584,3 +594,358 @@ class PartFunTestCase(unittest.TestCase):
         pf = PartFun(nma, [ExtTrans(), ExtRot(), Vibrations(freq_threshold=1e-3)])
         assert len(pf.vibrational.zero_freqs) == 12
         assert (pf.vibrational.positive_freqs > 1e-3).all()
+
+    def test_temperature_array(self):
+        molecule = load_molecule_g03fchk(
+            pkg_resources.resource_filename(__name__, "../data/test/ethane/gaussian.fchk"))
+        nma = NMA(molecule)
+        rotscan = load_rotscan_g03log(
+            pkg_resources.resource_filename(__name__, "../data/test/rotor/gaussian.log"))
+        rotor = Rotor(rotscan, molecule, rotsym=3, even=True)
+        pf = PartFun(nma, [ExtTrans(), ExtRot(), rotor, PCMCorrection((-5*kjmol,300), (-10*kjmol,600))])
+        temps = np.array([[100.0, 200.0, 300.0], [400.0, 500.0, 800.0]])
+        for term in [pf] + pf.terms:
+            for method_name in "log", "logt", "logtt", "logn", "logv", \
+                               "internal_heat", "heat_capacity", "entropy", \
+                               "free_energy", "chemical_potential":
+                values = getattr(term, method_name)(temps)
+                self.assertEqual(values.shape, temps.shape)
+                for index, temp in np.ndenumerate(temps):
+                    expected = getattr(term, method_name)(temp)
+                    self.assertAlmostEqual(values[index], expected, delta=abs(expected)*1e-10)
+        for term in pf.vibrational, rotor:
+            values = term.entropy_terms(temps)
+            self.assertEqual(values.shape, (term.num_terms,) + temps.shape)
+            for index, temp in np.ndenumerate(temps):
+                expected = term.entropy_terms(temp)
+                self.assertAlmostEqual(abs(values[(slice(None),) + index] - expected).max(), 0.0)
+        # mixture of zero and non-zero temperatures
+        temps = np.array([0.0, 300.0])
+        self.assertAlmostEqual(pf.chemical_potential(temps)[0], pf.zero_point_energy())
+        self.assertAlmostEqual(pf.chemical_potential(temps)[1], pf.chemical_potential(300.0))
+        self.assertAlmostEqual(pf.electronic.helpert(0.0, 2), pf.electronic.energy/boltzmann)
+        self.assertAlmostEqual(pf.vibrational.internal_heat(temps)[0], pf.vibrational.zero_point_energy())
+        self.assertRaises(NotImplementedError, pf.vibrational.logt, temps)
+
+    def test_fused_helpers(self):
+        molecule = load_molecule_g03fchk(
+            pkg_resources.resource_filename(__name__, "../data/test/ethane/gaussian.fchk"))
+        nma = NMA(molecule)
+        rotscan = load_rotscan_g03log(
+            pkg_resources.resource_filename(__name__, "../data/test/rotor/gaussian.log"))
+        rotor = Rotor(rotscan, molecule, rotsym=3, even=True)
+        pf = PartFun(nma, [ExtTrans(), ExtRot(), rotor])
+        temps = np.array([0.0, 50.0, 300.0, 1000.0])
+        for term in [pf] + pf.terms:
+            for n in 1, 2:
+                h, ht, htt = term.helpers(temps, n)
+                for temp, hi, hti, htti in zip(temps, h, ht, htt):
+                    self.assertAlmostEqual(hi, term.helper(temp, n), delta=abs(hi)*1e-10)
+                    self.assertAlmostEqual(hti, term.helpert(temp, n+1), delta=abs(hti)*1e-10)
+                    self.assertAlmostEqual(htti, term.helpertt(temp, n+2), delta=abs(htti)*1e-10)
+        for term in pf.vibrational, rotor:
+            h, ht, htt = term.helpers_terms(temps[1:], 0)
+            self.assertAlmostEqual(abs(h - term.helper_terms(temps[1:], 0)).max(), 0.0)
+            self.assertAlmostEqual(abs(ht - term.helpert_terms(temps[1:], 1)).max(), 0.0)
+            self.assertAlmostEqual(abs(htt - term.helpertt_terms(temps[1:], 2)).max(), 0.0)
+        # the derived quantities must match the unfused implementation
+        temp = 300.0
+        self.assertAlmostEqual(
+            pf.entropy(temp),
+            pf.entropy(temp, pf.helper, pf.helpert)
+        )
+        self.assertAlmostEqual(
+            pf.heat_capacity(temp),
+            pf.heat_capacity(temp, pf.helpert, pf.helpertt)
+        )
+        ta = ThermoAnalysis(pf, [200.0, 300.0, 400.0])
+        for table in ta.tables:
+            unfused = ThermoTable(table.label, table.unit, table.unit_name,
+                                  table.method_name, pf, ta.temps)
+            self.assertEqual(table.keys, unfused.keys)
+            for row, row_unfused in zip(table.data, unfused.data):
+                for value, value_unfused in zip(row, row_unfused):
+                    self.assertAlmostEqual(value, value_unfused, delta=abs(value)*1e-10)
+
+    def test_cache(self):
+        molecule = load_molecule_g03fchk(
+            pkg_resources.resource_filename(__name__, "../data/test/ethane/gaussian.fchk"))
+        rotscan = load_rotscan_g03log(
+            pkg_resources.resource_filename(__name__, "../data/test/rotor/gaussian.log"))
+        rotor = Rotor(rotscan, molecule, rotsym=3, even=True)
+        pcm = PCMCorrection((-5*kjmol,300), (-10*kjmol,600))
+        pf = PartFun(NMA(molecule), [ExtTrans(), ExtRot(), rotor, pcm])
+        temps = np.array([300.0, 400.0])
+        free = pf.free_energy(300.0)
+        logs = pf.log(temps)
+        pf.enable_cache(maxsize=4)
+        self.assertAlmostEqual(pf.free_energy(300.0), free)
+        self.assertAlmostEqual(abs(pf.log(temps) - logs).max(), 0.0)
+        # returned arrays are copies
+        pf.log(temps)[:] = 0.0
+        self.assertAlmostEqual(abs(pf.log(temps) - logs).max(), 0.0)
+        # in-place modifications of the arrays are detected
+        pf.vibrational.positive_freqs[:] *= 1.1
+        pf.disable_cache()
+        free_scaled = pf.free_energy(300.0)
+        pf.enable_cache(maxsize=4)
+        self.assertNotAlmostEqual(free_scaled, free)
+        self.assertAlmostEqual(pf.free_energy(300.0), free_scaled)
+        pf.vibrational.positive_freqs[:] /= 1.1
+        self.assertAlmostEqual(pf.free_energy(300.0), free)
+        # least recently used results are discarded
+        for temp in 500.0, 600.0, 700.0, 800.0:
+            pf.free_energy(temp)
+        self.assertEqual(len(pf._cache), 4)
+        self.assert_(np.array(300.0).tostring() not in [key[3] for key in pf._cache])
+        pf.clear_cache()
+        self.assertEqual(len(pf._cache), 0)
+        self.assertAlmostEqual(pf.free_energy(300.0), free)
+        # a modification of the parameters invalidates the cache
+        km = ThermodynamicModel([pf], [pf])
+        km.backup_freqs()
+        km.alter_freqs(100*lightspeed/(0.01*meter), 1.1)
+        self.assertNotAlmostEqual(pf.free_energy(300.0), free)
+        km.restore_freqs()
+        self.assertAlmostEqual(pf.free_energy(300.0), free)
+        for term, name, value in [
+                (pf.electronic, "energy", pf.electronic.energy + 0.01),
+                (pf.translational, "pressure", 2*atm),
+                (rotor, "rotsym", 6),
+                (rotor, "cancel_freq", 1.1*rotor.cancel_freq),
+                (pcm, "point1", (-6*kjmol, 300))]:
+            backup = getattr(term, name)
+            setattr(term, name, value)
+            self.assertNotAlmostEqual(pf.free_energy(300.0), free)
+            setattr(term, name, backup)
+            self.assertAlmostEqual(pf.free_energy(300.0), free)
+        # also deleting an attribute invalidates the cache
+        free = pf.free_energy(400.0)
+        pcm.point2 = None
+        self.assertNotAlmostEqual(pf.free_energy(400.0), free)
+        del pcm.point2
+        self.assertRaises(AttributeError, pf.free_energy, 400.0)
+        pcm.point2 = (-10*kjmol,600)
+        self.assertAlmostEqual(pf.free_energy(400.0), free)
+        pf.disable_cache()
+        self.assertAlmostEqual(pf.free_energy(400.0), free)
+
+    def test_compile(self):
+        molecule = load_molecule_g03fchk(
+            pkg_resources.resource_filename(__name__, "../data/test/ethane/gaussian.fchk"))
+        nma = NMA(molecule)
+        rotscan = load_rotscan_g03log(
+            pkg_resources.resource_filename(__name__, "../data/test/rotor/gaussian.log"))
+        rotor = Rotor(rotscan, molecule, rotsym=3, even=True)
+        temps = np.array([50.0, 300.0, 1000.0])
+        for terms in [
+            [ExtTrans(), ExtRot(), rotor, PCMCorrection((-5*kjmol,300), (-10*kjmol,600))],
+            [ExtTrans(cp=False), ExtRot(), Vibrations(classical=True)],
+        ]:
+            pf = PartFun(nma, terms)
+            cpf = pf.compile()
+            for method_name in "log", "logt", "logtt", "logn", "logv", \
+                               "internal_heat", "heat_capacity", "entropy", \
+                               "free_energy", "chemical_potential":
+                values = getattr(cpf, method_name)(temps)
+                expected = getattr(pf, method_name)(temps)
+                for value, expected in zip(values, expected):
+                    self.assertAlmostEqual(value, expected, delta=abs(expected)*1e-10)
+            self.assertAlmostEqual(cpf.zero_point_energy(), pf.zero_point_energy())
+            self.assertAlmostEqual(cpf.free_energy(300.0), pf.free_energy(300.0))
+            # the limits for T -> 0 are the same as for PartFun
+            for method_name in "helper", "helpert", "helpertt", "helpern", "helperv":
+                for n in xrange(5):
+                    try:
+                        expected = getattr(pf, method_name)(0.0, n)
+                    except NotImplementedError:
+                        self.assertRaises(NotImplementedError, getattr(cpf, method_name), 0.0, n)
+                        continue
+                    value = getattr(cpf, method_name)(0.0, n)
+                    self.assertAlmostEqual(value, expected, delta=abs(expected)*1e-10)
+            self.assertAlmostEqual(cpf.internal_heat(0.0), pf.internal_heat(0.0))
+            free = cpf.free_energy(np.array([0.0, 300.0]))
+            self.assertAlmostEqual(free[0], pf.zero_point_energy())
+            self.assertAlmostEqual(free[1], pf.free_energy(300.0))
+            self.assertRaises(ValueError, cpf.free_energy, -1.0)
+            self.assertRaises(TypeError, setattr, cpf, "consts", None)
+            self.assertRaises(ValueError, cpf.osc_x.__setitem__, 0, 1.0)
+            self.assertFalse(hasattr(cpf, "__dict__"))
+
+    def test_spline(self):
+        molecule = load_molecule_g03fchk(
+            pkg_resources.resource_filename(__name__, "../data/test/ethane/gaussian.fchk"))
+        nma = NMA(molecule)
+        rotscan = load_rotscan_g03log(
+            pkg_resources.resource_filename(__name__, "../data/test/rotor/gaussian.log"))
+        rotor = Rotor(rotscan, molecule, rotsym=3, even=True)
+        pf = PartFun(nma, [ExtTrans(), ExtRot(), rotor])
+        spf = SplinePartFun(pf, 100.0, 1000.0, rtol=1e-8)
+        temps = np.linspace(100.0, 1000.0, 37)
+        for method_name in "log", "internal_heat", "heat_capacity", "entropy", \
+                           "free_energy":
+            values = getattr(spf, method_name)(temps)
+            expected = getattr(pf, method_name)(temps)
+            for value, expected in zip(values, expected):
+                self.assertAlmostEqual(value, expected, delta=abs(expected)*1e-7)
+        self.assertAlmostEqual(spf.entropy(300.0), pf.entropy(300.0), delta=pf.entropy(300.0)*1e-7)
+        self.assertRaises(ValueError, spf.log, 50.0)
+        self.assertRaises(ValueError, SplinePartFun, pf, 0.0, 1000.0)
+        self.assertRaises(ValueError, SplinePartFun, pf, 100.0, 1000.0, 1e-8, 10)
+        # the default tolerance, with and without the translational contribution
+        for terms in [ExtTrans(), ExtRot(), Vibrations()], \
+                     [ExtTrans(cp=False), ExtRot(), Vibrations()], \
+                     [ExtRot(), Vibrations()], [Vibrations()]:
+            pf = PartFun(nma, terms)
+            spf = SplinePartFun(pf, 100.0, 1000.0)
+            for method_name in "log", "logn", "logv", "heat_capacity", \
+                               "free_energy", "chemical_potential":
+                values = getattr(spf, method_name)(temps)
+                expected = getattr(pf, method_name)(temps)
+                for value, expected in zip(values, expected):
+                    self.assertAlmostEqual(value, expected, delta=abs(expected)*1e-7)
+
+    def test_memory_budget(self):
+        molecule = load_molecule_g03fchk(
+            pkg_resources.resource_filename(__name__, "../data/test/ethane/gaussian.fchk"))
+        nma = NMA(molecule)
+        temps = np.linspace(10.0, 1000.0, 101)
+        pf = PartFun(nma, [ExtTrans(), ExtRot()])
+        pf_budget = PartFun(nma, [ExtTrans(), ExtRot(), Vibrations(memory_budget=1000)])
+        self.assertEqual(pf_budget.vibrational._get_block_sizes(len(temps)), (15, 1))
+        pf_budget.vibrational.memory_budget = 8*8*100
+        self.assertEqual(pf_budget.vibrational._get_block_sizes(len(temps)), (18, 5))
+        for method_name in "log", "logt", "logtt", "internal_heat", \
+                           "heat_capacity", "entropy", "free_energy", \
+                           "chemical_potential":
+            values = getattr(pf_budget, method_name)(temps)
+            expected = getattr(pf, method_name)(temps)
+            self.assertEqual(values.shape, expected.shape)
+            for value, expected in zip(values, expected):
+                self.assertAlmostEqual(value, expected, delta=abs(expected)*1e-12)
+        self.assertAlmostEqual(pf_budget.zero_point_energy(), pf.zero_point_energy())
+        self.assertAlmostEqual(pf_budget.free_energy(300.0), pf.free_energy(300.0))
+
+    def test_sensitivity(self):
+        molecule = load_molecule_g03fchk(
+            pkg_resources.resource_filename(__name__, "../data/test/ethane/gaussian.fchk"))
+        nma = NMA(molecule)
+        rotscan = load_rotscan_g03log(
+            pkg_resources.resource_filename(__name__, "../data/test/rotor/gaussian.log"))
+        rotor = Rotor(rotscan, molecule, rotsym=3, even=True)
+        vib = Vibrations(freq_scaling=0.97, zp_scaling=0.95)
+        pf = PartFun(nma, [ExtTrans(), ExtRot(6), rotor, vib])
+        temps = np.array([100.0, 300.0, 800.0])
+        sensitivity = pf.sensitivity(temps)
+        quantities = ["log", "logt", "entropy", "heat_capacity", "free_energy", "internal_heat"]
+
+        def set_freq(value):
+            freqs = vib.positive_freqs.copy()
+            freqs[5] = value
+            vib.positive_freqs = freqs
+
+        def set_energy(value):
+            pf.electronic.energy = value
+
+        def set_freq_scaling(value):
+            vib.freq_scaling = value
+            rotor.freq_scaling = value
+
+        def set_cancel_freq(value):
+            rotor.cancel_freq = value
+
+        for key, setter, value, eps in [
+            (("freq", 5), set_freq, vib.positive_freqs[5], 1e-3*vib.positive_freqs[5]),
+            (("energy",), set_energy, pf.electronic.energy, 1e-5),
+            (("freq_scaling",), set_freq_scaling, vib.freq_scaling, 1e-4),
+            (("cancel_freq", rotor.name), set_cancel_freq, rotor.cancel_freq, 1e-3*rotor.cancel_freq),
+        ]:
+            index = sensitivity.keys.index(key)
+            setter(value + eps)
+            plus = [getattr(pf, name)(temps) for name in quantities]
+            setter(value - eps)
+            minus = [getattr(pf, name)(temps) for name in quantities]
+            setter(value)
+            for name, p, m in zip(quantities, plus, minus):
+                derivs = getattr(sensitivity, name)()[index]
+                for deriv, fd in zip(derivs, (p - m)/(2*eps)):
+                    self.assertAlmostEqual(deriv, fd, delta=abs(derivs).max()*1e-5)
+        errors = sensitivity.propagate("free_energy", {"freq": lightspeed/(0.01*meter)})
+        self.assertEqual(errors.shape, temps.shape)
+        self.assertTrue((errors > 0).all())
+
+    def test_level_set(self):
+        energy_levels = np.array([3.0, 1.0, 2.0, 1.0, 5.0])*kjmol + 1.0
+        level_set = LevelSet(energy_levels)
+        self.assertEqual(level_set.degeneracy, 2)
+        self.assertAlmostEqual(level_set.ground, 1*kjmol + 1.0)
+        # very low temperatures would underflow without the log-sum-exp trick
+        temps = np.array([0.0, 1e-3, 1.0, 300.0])
+        h, ht, htt = helpers_levels(temps, 1, energy_levels)
+        self.assertAlmostEqual(h[0], -level_set.ground/boltzmann)
+        self.assertAlmostEqual(h[1], 1e-3*np.log(2) - level_set.ground/boltzmann)
+        self.assertTrue(np.isfinite(ht).all())
+        self.assertTrue(np.isfinite(htt).all())
+        self.assertAlmostEqual(ht[1]/level_set.ground*boltzmann, 1.0)
+        # compare with a direct evaluation at room temperature
+        bfs = np.exp(-(energy_levels - level_set.ground)/(boltzmann*300.0))
+        self.assertAlmostEqual(h[3], 300.0*np.log(bfs.sum()) - level_set.ground/boltzmann)
+        self.assertAlmostEqual(helper_levels(300.0, 1, level_set), h[3])
+        self.assertAlmostEqual(helpert_levels(300.0, 2, level_set), ht[3])
+        self.assertAlmostEqual(helpertt_levels(300.0, 3, level_set), htt[3])
+        # truncation of irrelevant levels
+        self.assertEqual(level_set.get_num_relevant(1.0), 2)
+        self.assertEqual(level_set.get_num_relevant(1e4), 5)
+        self.assertRaises(ValueError, helper_levels, 1e4, 0, energy_levels, True)
+
+    def test_checkpoint(self):
+        molecule = load_molecule_g03fchk(
+            pkg_resources.resource_filename(__name__, "../data/test/ethane/gaussian.fchk"))
+        nma = NMA(molecule)
+        rot_scan = load_rotscan_g03log(
+            pkg_resources.resource_filename(__name__, "../data/test/rotor/gaussian.log"))
+        rotor = Rotor(rot_scan, molecule, rotsym=3, even=True)
+        pf = PartFun(nma, [
+            ExtTrans(), ExtRot(6), rotor, Vibrations(freq_scaling=0.9),
+            PCMCorrection((-5*kjmol, 300), (-10*kjmol, 600)),
+        ])
+        temps = np.array([50.0, 300.0, 1000.0])
+        with tmpdir(__name__, 'test_checkpoint') as dn:
+            fn = os.path.join(dn, "partf.npz")
+            pf.save_checkpoint(fn)
+            pf_copy = PartFun.load_checkpoint(fn)
+            # a text file is not a checkpoint
+            fn_txt = os.path.join(dn, "partf.txt")
+            pf.write_to_file(fn_txt)
+            self.assertRaises(IOError, PartFun.load_checkpoint, fn_txt)
+            # only the contributions of TAMkin are restored
+            archive = np.load(fn)
+            arrays = dict((key, archive[key]) for key in archive.files)
+            archive.close()
+            header = json.loads(str(arrays["header"][()]))
+            header["terms"][0]["module"] = "os"
+            header["terms"][0]["class"] = "system"
+            arrays["header"] = np.array(json.dumps(header))
+            fn_bad = os.path.join(dn, "bad.npz")
+            np.savez(fn_bad, **arrays)
+            self.assertRaises(IOError, PartFun.load_checkpoint, fn_bad)
+            class MyExtRot(ExtRot):
+                pass
+            pf_custom = PartFun(nma, [ExtTrans(), MyExtRot(6)])
+            self.assertRaises(TypeError, pf_custom.save_checkpoint, fn_bad)
+        self.assertEqual(pf_copy.title, pf.title)
+        self.assertEqual(pf_copy.chemical_formula, pf.chemical_formula)
+        self.assertEqual([term.name for term in pf_copy.terms], [term.name for term in pf.terms])
+        self.assertEqual(pf_copy.vibrational.freq_scaling, 0.9)
+        self.assertEqual(pf_copy.vibrational.zero_freqs.tolist(), pf.vibrational.zero_freqs.tolist())
+        rotor_copy = pf_copy.hindered_rotor_3_4_5
+        self.assertEqual(rotor_copy.energy_levels.tolist(), rotor.energy_levels.tolist())
+        self.assertEqual(rotor_copy.v_coeffs.tolist(), rotor.v_coeffs.tolist())
+        self.assertEqual(rotor_copy.rot_scan.top_indexes.tolist(), rotor.rot_scan.top_indexes.tolist())
+        for name in "free_energy", "internal_heat", "heat_capacity", "entropy":
+            self.assertAlmostEqual(abs(getattr(pf_copy, name)(temps) - getattr(pf, name)(temps)).max(), 0.0)
+        self.assertAlmostEqual(pf_copy.zero_point_energy(), pf.zero_point_energy())
+        # the restored rotor still solves more levels on demand
+        self.assertAlmostEqual(pf_copy.entropy(3000.0), pf.entropy(3000.0))
+        self.assertEqual(rotor_copy.num_levels, rotor.num_levels)
+        self.assertEqual(len(rotor_copy.energy_levels), len(rotor.energy_levels))
@@ -76,6 +76,54 @@ class PFToolsTestCase(unittest.TestCase):
             ra.write_to_file(os.path.join(dn, "reaction_aa.txt"))
             ra.plot_parameters(os.path.join(dn, "parameters_aa.png"))
 
+    def test_rate_constant_sensitivity(self):
+        pf_react1 = PartFun(NMA(load_molecule_g03fchk(
+            pkg_resources.resource_filename(__name__, "../data/test/sterck/aa.fchk"))),
+            [ExtTrans(cp=False), ExtRot(1)])
+        pf_react2 = PartFun(NMA(load_molecule_g03fchk(
+            pkg_resources.resource_filename(__name__, "../data/test/sterck/aarad.fchk"))),
+            [ExtTrans(cp=False), ExtRot(1)])
+        pf_ts = PartFun(NMA(load_molecule_g03fchk(
+            pkg_resources.resource_filename(__name__, "../data/test/sterck/paats.fchk"))),
+            [ExtTrans(cp=False), ExtRot(1)])
+        km = KineticModel([pf_react1, pf_react2], pf_ts)
+        temps = np.array([280.0, 320.0, 360.0])
+        sensitivity = km.sensitivity(temps)
+        derivs = km.rate_constant_sensitivity(temps, do_log=True)
+        self.assertEqual(derivs.shape, (len(sensitivity.keys), len(temps)))
+        # finite differences for one frequency of the reactant and the energy
+        # of the transition state
+        vib = pf_react1.vibrational
+        freq = vib.positive_freqs[3]
+        eps = 1e-3*freq
+        for delta in +eps, -eps:
+            freqs = vib.positive_freqs.copy()
+            freqs[3] = freq + delta
+            vib.positive_freqs = freqs
+            if delta > 0:
+                plus = km.rate_constant(temps, do_log=True)
+            else:
+                minus = km.rate_constant(temps, do_log=True)
+        freqs[3] = freq
+        vib.positive_freqs = freqs
+        index = sensitivity.keys.index(("freq", pf_react1, 3))
+        for deriv, fd in zip(derivs[index], (plus - minus)/(2*eps)):
+            self.assertAlmostEqual(deriv, fd, delta=abs(fd)*1e-5)
+        index = sensitivity.keys.index(("energy", pf_ts))
+        for deriv, temp in zip(derivs[index], temps):
+            self.assertAlmostEqual(deriv, -1/(boltzmann*temp))
+        derivs_k = km.rate_constant_sensitivity(temps)
+        for deriv_k, deriv, k in zip(derivs_k[index], derivs[index], km.rate_constant(temps)):
+            self.assertAlmostEqual(deriv_k/k, deriv)
+
+        ra = ReactionAnalysis(km, 280, 360)
+        ra.error_propagation(energy_error=0.001)
+        self.assertEqual(ra.covariance.shape, (2, 2))
+        self.assertTrue(ra.covariance[1,1] > 0)
+        with tmpdir(__name__, 'test_rate_constant_sensitivity') as dn:
+            ra.write_to_file(os.path.join(dn, "reaction_aa.txt"))
+            ra.plot_parameters(os.path.join(dn, "parameters_aa.png"))
+
     def test_reaction_analysis_mat(self):
         pf_react = PartFun(NMA(load_molecule_g03fchk(
             pkg_resources.resource_filename(__name__, "../data/test/mat5T/react.fchk"))), [])
@@ -126,3 +174,16 @@ class PFToolsTestCase(unittest.TestCase):
         ta = ThermoAnalysis(pf, [200,300,400,500,600,700,800,900])
         with tmpdir(__name__, 'test_thermo_analysis_mat') as dn:
             ta.write_to_file(os.path.join(dn, "thermo_mat2.csv"))
+
+    def test_thermo_analysis_no_terms(self):
+        pf = PartFun(NMA(load_molecule_g03fchk(
+            pkg_resources.resource_filename(__name__, "../data/test/mat5T/react.fchk"))),
+            [ExtTrans(), ExtRot(1)])
+        temps = [200,300,400,500,600,700,800,900]
+        ta_full = ThermoAnalysis(pf, temps)
+        ta = ThermoAnalysis(pf, temps, terms=False)
+        for table, table_full in zip(ta.tables, ta_full.tables):
+            self.assertEqual(table.keys, [term.name for term in [pf] + pf.terms])
+            for key, row in zip(table.keys, table.data):
+                row_full = table_full.data[table_full.keys.index(key)]
+                self.assertAlmostEqual(abs(row - row_full).max(), 0.0)
@@ -397,3 +397,27 @@ class RotorTestCase(unittest.TestCase):
             pkg_resources.resource_filename(__name__, "../data/test/rotor/margot.log"))
         assert rot_scan.potential.shape == (2, 1)
         assert (rot_scan.dihedral == [2, 3, 4, 5]).all()
+
+    def test_ethane_more_levels(self):
+        molecule = load_molecule_g03fchk(
+            pkg_resources.resource_filename(__name__, "../data/test/ethane/gaussian.fchk"))
+        nma = NMA(molecule)
+        rot_scan = load_rotscan_g03log(
+            pkg_resources.resource_filename(__name__, "../data/test/rotor/gaussian.log"))
+        rotor = Rotor(rot_scan, molecule, rotsym=3, even=True, num_levels=5)
+        pf = PartFun(nma, [ExtTrans(), ExtRot(6), rotor])
+        self.assertEqual(len(rotor.energy_levels), 5)
+        # five levels are not sufficient at 1000K, more are solved on the fly
+        entropy = pf.entropy(1000.0)
+        self.assertTrue(len(rotor.energy_levels) > 5)
+        # the configured number of levels is not changed
+        self.assertEqual(rotor.num_levels, 5)
+        self.assertTrue(rotor.level_set.top_occupation(1000.0) < rotor.level_threshold)
+        rotor_ref = Rotor(rot_scan, molecule, rotsym=3, even=True, num_levels=200)
+        pf_ref = PartFun(nma, [ExtTrans(), ExtRot(6), rotor_ref])
+        self.assertAlmostEqual(entropy/pf_ref.entropy(1000.0), 1.0, 4)
+        # the maximum number of levels is respected
+        rotor = Rotor(rot_scan, molecule, rotsym=3, even=True, num_levels=5, max_levels=8)
+        pf = PartFun(nma, [ExtTrans(), ExtRot(6), rotor])
+        self.assertRaises(ValueError, pf.entropy, 1000.0)
+        self.assertEqual(len(rotor.energy_levels), 8)